@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+#################################################
+#   Title: Import time benchmark
+# Project: TLE Match
+#    Date: Jan 2018
+#  Author: Zach Leffke, KJ4QLP
+#    Desc:
+#       Measures the import time of the utilities modules and scripts, each
+#       in a fresh interpreter, and which heavy packages each one pulls in.
+#       Headless matching should never load matplotlib.
+#################################################
+import os
+import sys
+import json
+import argparse
+import subprocess
+import datetime as dt
+
+modules_default = ['utilities.propagator', 'utilities.columnar', 'utilities.catalog',
+                   'utilities.cache', 'utilities.match', 'utilities.poly',
+                   'utilities.gr_doppler', 'utilities.satellite', 'utilities.pipeline',
+                   'tle_match', 'tle_pipeline', 'generate_doppler', 'utilities.plotting']
+heavy = ['numpy', 'pandas', 'scipy', 'matplotlib', 'ephem', 'pytz']
+
+probe = """
+import sys, time, json
+t0 = time.time()
+import {:s}
+t = time.time() - t0
+print json.dumps({{'elapsed':t, 'loaded':[m for m in {:s} if m in sys.modules]}})
+"""
+
+def time_import(module, cwd):
+    #one fresh interpreter per measurement, the import cache is per process
+    out = subprocess.check_output([sys.executable, '-c', probe.format(module, repr(heavy))], cwd=cwd)
+    return json.loads(out.strip().splitlines()[-1])
+
+def main():
+    """ Main entry point """
+    startup_ts = dt.datetime.utcnow().strftime("%Y%m%d_%H%M%S")
+    #--------START Command Line argument parser------------------------------------------------------
+    parser = argparse.ArgumentParser(description="Import time benchmark",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--modules',
+                        dest='modules',
+                        type=str,
+                        default=','.join(modules_default),
+                        help="Comma separated modules to import, relative to the pyephem folder",
+                        action="store")
+    parser.add_argument('--repeat',
+                        dest='repeat',
+                        type=int,
+                        default=5,
+                        help="Fresh interpreter imports per module, best time is reported",
+                        action="store")
+    parser.add_argument('--out',
+                        dest='out',
+                        type=str,
+                        default=None,
+                        help="Write results to this JSON file",
+                        action="store")
+    args = parser.parse_args()
+    #--------END Command Line argument parser------------------------------------------------------
+
+    cwd = os.path.dirname(os.path.dirname(os.path.abspath(__file__))) #pyephem folder
+    results = []
+    print '{:<24s}{:>10s}{:>10s}  {:s}'.format('Module', 'Best [ms]', 'Med [ms]', 'Heavy imports')
+    for module in args.modules.split(','):
+        runs = [time_import(module, cwd) for i in range(args.repeat)]
+        times = sorted([r['elapsed'] for r in runs])
+        res = {}
+        res['module'] = module
+        res['best'] = times[0]
+        res['median'] = times[len(times)//2]
+        res['loaded'] = runs[-1]['loaded']
+        results.append(res)
+        print '{:<24s}{:>10.1f}{:>10.1f}  {:s}'.format(module, res['best']*1e3, res['median']*1e3, \
+                                                      ','.join(res['loaded']))
+
+    if args.out:
+        report = {'timestamp':startup_ts, 'python':sys.version.split()[0], 'repeat':args.repeat, \
+                  'results':results}
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=4)
+        print 'Results written to: {:s}'.format(args.out)
+
+if __name__ == '__main__':
+    main()
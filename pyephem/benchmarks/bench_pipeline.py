@@ -0,0 +1,298 @@
+#!/usr/bin/env python
+#################################################
+#   Title: Pipeline stage benchmark
+# Project: TLE Match
+#    Date: Jan 2018
+#  Author: Zach Leffke, KJ4QLP
+#    Desc:
+#       Times each pipeline stage on synthetic launch scale workloads.
+#       Candidates are perturbed copies of the TLE file (mean anomaly and
+#       RAAN), the measurement is the Doppler of one catalog object plus
+#       noise and a transmitter bias, written as a GNU Radio .f32 file at
+#       the requested pass length and sample rate.  Each workload runs in
+#       a fresh interpreter so peak memory is per workload.
+#
+#       Stages: import (.f32 read + time stamps), generate (candidate
+#       Doppler), serialize (.dcol write + read back), fit (polynomial
+#       regression), match (ranking).
+#################################################
+import os
+import sys
+import json
+import time
+import math
+import shutil
+import argparse
+import platform
+import resource
+import tempfile
+import subprocess
+import datetime as dt
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) #pyephem folder
+
+deg2rad = math.pi / 180
+rad2deg = 180 / math.pi
+
+def peak_rss_mb():
+    #peak resident set size of this process [MB], ru_maxrss is KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def synth_candidates(cat, n, rs):
+    #desc:  n catalog entries, the originals first, then perturbed copies
+    #       with shifted mean anomaly and RAAN and new NORAD IDs
+    from utilities import propagator
+    from utilities import orbit_fit
+    entries = []
+    for i in range(n):
+        base = cat.entries[i % len(cat.entries)]
+        if i < len(cat.entries):
+            entries.append(base)
+            continue
+        el = propagator.tle_elements(base['line1'], base['line2'])
+        el['mo'] = el['mo'] + rs.uniform(-2.0, 2.0) * deg2rad
+        el['nodeo'] = el['nodeo'] + rs.uniform(-0.5, 0.5) * deg2rad
+        norad = '{:05d}'.format(90000 + i)
+        line1, line2 = orbit_fit.format_tle(norad.join([base['line1'][:2], base['line1'][7:]]), \
+                                            norad.join([base['line2'][:2], base['line2'][7:]]), el)
+        entry = dict(base)
+        entry['name'] = 'SYN-{:05d}'.format(i)
+        entry['norad_id'] = norad
+        entry['line1'], entry['line2'] = line1, line2
+        entries.append(entry)
+    return entries
+
+def synth_measurement(folder, entry, gs, tca, minutes, rate, rx_freq, rs):
+    #desc:  Doppler of entry over a pass centered on tca, noise and bias added,
+    #       written as a GNU Radio .f32 file named like a real recording
+    #output: file name
+    from utilities import propagator
+    n = int(minutes * 60 * rate)
+    start = np.datetime64(tca, 'ns') - np.timedelta64(int(minutes * 30e9), 'ns')
+    ts = start + (np.arange(n) * (1e9 / rate)).astype('timedelta64[ns]')
+    s = propagator.sgp4_init(propagator.tle_elements(entry['line1'], entry['line2']))
+    rr = propagator.range_rate_batch(s, ts, gs['gs_lat']*deg2rad, gs['gs_lon']*deg2rad, gs['gs_alt'])
+    dop = -rr / propagator.c * rx_freq + 50.0 + rs.normal(0.0, 10.0, n)
+    t0 = start.astype('datetime64[us]').astype(dt.datetime)
+    fn = 'SYNTH_USRP_{:s}_UTC_{:d}sps.f32'.format(t0.strftime('%Y%m%d_%H%M%S.%f'), rate)
+    dop.astype('<f4').tofile('/'.join([folder, fn]))
+    return fn
+
+def run_workload(cfg):
+    #desc:  one workload, in this process, returns the result dict
+    from utilities import catalog
+    from utilities import columnar
+    from utilities import pipeline
+    from utilities import match
+    from utilities import instrument
+    instrument.setup_logging('warning') #stage output would be timed too
+    rs = np.random.RandomState(cfg['seed'])
+    gs = {'gs_lat':cfg['gs_lat'], 'gs_lon':cfg['gs_lon'], 'gs_alt':cfg['gs_alt']}
+    cat = catalog.tle_catalog_input(cfg['tle_folder'], cfg['tle_file'])
+    truth = [e for e in cat.entries if e['name'] == cfg['truth']][0]
+    folder = tempfile.mkdtemp(prefix='bench_')
+    res = dict(cfg)
+    stages = []
+    try:
+        fn = synth_measurement(folder, truth, gs, cfg['tca'], cfg['minutes'], cfg['rate'], cfg['rx_freq'], rs)
+        sats = pipeline.satellites(synth_candidates(cat, cfg['candidates'], rs))
+        rss0 = peak_rss_mb()
+
+        t0 = time.time()
+        df, md = pipeline.load_measurement(folder, fn, cfg['rx_freq'], 0, 0, gs)
+        stages.append(('import', time.time() - t0, len(df), peak_rss_mb()))
+
+        t0 = time.time()
+        dopplers = pipeline.generate(sats, md, df['timestamp'].values, cfg['engine'], cfg['workers'], \
+                                     -90.0, 0.0, None)
+        stages.append(('generate', time.time() - t0, len(df) * len(dopplers), peak_rss_mb()))
+
+        t0 = time.time()
+        nbytes = 0
+        for i, dop in enumerate(dopplers):
+            path = '/'.join([folder, '{:05d}'.format(i) + columnar.ext])
+            columnar.write_columnar(path, dop)
+            nbytes += os.path.getsize(path)
+            columnar.read_doppler(path)
+        stages.append(('serialize', time.time() - t0, len(df) * len(dopplers), peak_rss_mb()))
+
+        t0 = time.time()
+        poly_data = pipeline.fit([df] + dopplers, 1, cfg['degree'])
+        stages.append(('fit', time.time() - t0, len(df) * (len(dopplers) + 1), peak_rss_mb()))
+
+        t0 = time.time()
+        table, keys, rank_by = match.match_poly_data(poly_data[0], poly_data[1:], cfg['rank_by'])
+        stages.append(('match', time.time() - t0, len(dopplers), peak_rss_mb()))
+    finally:
+        shutil.rmtree(folder)
+    res['samples'] = len(df)
+    res['serialized_mb'] = nbytes / 1e6
+    res['best'] = table[0]['name'] if len(table) > 0 else None
+    res['rss_base_mb'] = rss0
+    res['stages'] = []
+    for name, elapsed, items, rss in stages:
+        res['stages'].append({'stage':name, 'elapsed':elapsed, 'items':items, \
+                              'throughput':items / elapsed if elapsed > 0 else None, 'peak_rss_mb':rss})
+    res['peak_rss_mb'] = peak_rss_mb()
+    return res
+
+def git_rev(cwd):
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=cwd, \
+                                       stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    """ Main entry point """
+    startup_ts = dt.datetime.utcnow().strftime("%Y%m%d_%H%M%S")
+    cwd = os.path.dirname(os.path.dirname(os.path.abspath(__file__))) #pyephem folder
+    #--------START Command Line argument parser------------------------------------------------------
+    parser = argparse.ArgumentParser(description="Pipeline stage benchmark, synthetic workloads",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    wl = parser.add_argument_group('Workload Related Configurations')
+    wl.add_argument('--candidates',
+                        dest='candidates',
+                        type=str,
+                        default='34,200',
+                        help="Comma separated candidate counts, perturbed copies beyond the TLE file",
+                        action="store")
+    wl.add_argument('--minutes',
+                        dest='minutes',
+                        type=str,
+                        default='5,15',
+                        help="Comma separated pass lengths [min]",
+                        action="store")
+    wl.add_argument('--rates',
+                        dest='rates',
+                        type=str,
+                        default='1,10,100,1000',
+                        help="Comma separated sample rates [sps]",
+                        action="store")
+    wl.add_argument('--engines',
+                        dest='engines',
+                        type=str,
+                        default='batch,interp',
+                        help="Comma separated Doppler engines",
+                        action="store")
+    wl.add_argument('--workers',
+                        dest='workers',
+                        type=int,
+                        default=1,
+                        help="Doppler generation worker processes",
+                        action="store")
+    wl.add_argument('--degree',
+                        dest='degree',
+                        type=int,
+                        default=3,
+                        help="Regression polynomial degree",
+                        action="store")
+    wl.add_argument('--rank_by',
+                        dest='rank_by',
+                        type=str,
+                        default='tca_delta',
+                        help="Score the candidates are ranked on",
+                        action="store")
+    wl.add_argument('--max_cells',
+                        dest='max_cells',
+                        type=float,
+                        default=4e7,
+                        help="Skip workloads with more candidates x samples than this, ~75 bytes of peak memory each "
+                             "(34 candidates x 15 min x 1000 sps fits, ~2.3 GB); skips are listed in the results file",
+                        action="store")
+    wl.add_argument('--seed',
+                        dest='seed',
+                        type=int,
+                        default=0,
+                        help="Random seed for perturbations and noise",
+                        action="store")
+    wl.add_argument('--tle_file',
+                        dest='tle_file',
+                        type=str,
+                        default='pslv40_st.tle',
+                        help="TLE file the candidates are derived from",
+                        action="store")
+    wl.add_argument('--tle_folder',
+                        dest='tle_folder',
+                        type=str,
+                        default='/'.join([cwd, 'tle']),
+                        help="Folder containing TLE file",
+                        action="store")
+    wl.add_argument('--truth',
+                        dest='truth',
+                        type=str,
+                        default='2018-004AC',
+                        help="Catalog object the synthetic measurement is generated from",
+                        action="store")
+    parser.add_argument('--out',
+                        dest='out',
+                        type=str,
+                        default=None,
+                        help="Write results to this JSON file",
+                        action="store")
+    parser.add_argument('--workload',
+                        dest='workload',
+                        type=str,
+                        default=None,
+                        help=argparse.SUPPRESS, #internal, JSON workload run in a child process
+                        action="store")
+    args = parser.parse_args()
+    #--------END Command Line argument parser------------------------------------------------------
+    import warnings
+    warnings.filterwarnings('ignore')
+
+    if args.workload: #child process
+        res = run_workload(json.loads(args.workload))
+        print json.dumps(res)
+        return
+
+    base = {'gs_lat':37.229976, 'gs_lon':-80.439627, 'gs_alt':610.0, 'rx_freq':145.880e6, \
+            'tca':'2018-01-13T16:14:29', 'tle_file':args.tle_file, 'tle_folder':args.tle_folder, \
+            'truth':args.truth, 'workers':args.workers, 'degree':args.degree, 'rank_by':args.rank_by, 'seed':args.seed}
+    results = []
+    skipped = [] #workloads not run, with the reason, so gaps in the matrix are visible
+    hdr = '{:>6s}{:>5s}{:>6s}{:>8s}{:>9s}'.format('Cands', 'Min', 'sps', 'Engine', 'Samples') + \
+          ''.join(['{:>11s}'.format(s) for s in ['import', 'generate', 'serialize', 'fit', 'match']]) + \
+          '{:>10s}'.format('RSS [MB]')
+    print hdr
+    print '-' * len(hdr)
+    for n in [int(x) for x in args.candidates.split(',')]:
+        for minutes in [float(x) for x in args.minutes.split(',')]:
+            for rate in [int(x) for x in args.rates.split(',')]:
+                for engine in args.engines.split(','):
+                    cfg = dict(base)
+                    cfg.update({'candidates':n, 'minutes':minutes, 'rate':rate, 'engine':engine})
+                    samples = int(minutes * 60 * rate)
+                    wl_id = {'candidates':n, 'minutes':minutes, 'rate':rate, 'engine':engine, 'samples':samples}
+                    if n * samples > args.max_cells:
+                        print '{:>6d}{:>5.0f}{:>6d}{:>8s}{:>9d}  skipped, above --max_cells'.format( \
+                                n, minutes, rate, engine, samples)
+                        skipped.append(dict(wl_id, reason='candidates x samples {:d} above --max_cells {:.0f}'.format( \
+                                                           n * samples, args.max_cells)))
+                        continue
+                    try:
+                        out = subprocess.check_output([sys.executable, os.path.abspath(__file__), \
+                                                       '--workload', json.dumps(cfg)], cwd=cwd)
+                    except subprocess.CalledProcessError as e: #ex: MemoryError in the worker
+                        print '{:>6d}{:>5.0f}{:>6d}{:>8s}{:>9d}  failed, exit status {:d}'.format( \
+                                n, minutes, rate, engine, samples, e.returncode)
+                        skipped.append(dict(wl_id, reason='worker failed, exit status {:d}'.format(e.returncode)))
+                        continue
+                    res = json.loads(out.strip().splitlines()[-1])
+                    results.append(res)
+                    print '{:>6d}{:>5.0f}{:>6d}{:>8s}{:>9d}'.format(n, minutes, rate, engine, res['samples']) + \
+                          ''.join(['{:>11.3f}'.format(s['elapsed']) for s in res['stages']]) + \
+                          '{:>10.1f}'.format(res['peak_rss_mb'])
+
+    if args.out:
+        report = {'timestamp':startup_ts, 'python':sys.version.split()[0], 'numpy':np.__version__, \
+                  'platform':platform.platform(), 'git':git_rev(cwd), 'args':vars(args), 'results':results, \
+                  'skipped':skipped}
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=4)
+        print 'Results written to: {:s}'.format(args.out)
+
+if __name__ == '__main__':
+    main()
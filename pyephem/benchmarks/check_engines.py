@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+#################################################
+#   Title: Doppler engine regression check
+# Project: TLE Match
+#    Date: Jan 2018
+#  Author: Zach Leffke, KJ4QLP
+#    Desc:
+#       Generates Doppler for a few catalog objects over the measurement
+#       time grid with the per sample pyephem reference (gen_doppler,
+#       engine 'ephem') and the vectorized engines ('batch', 'interp'), and
+#       fails if any engine differs from the reference by more than the
+#       tolerance.  Exit status 1 on failure.
+#################################################
+import os
+import sys
+import json
+import math
+import argparse
+import datetime as dt
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) #pyephem folder
+
+import utilities.catalog
+import utilities.columnar
+import utilities.satellite
+
+deg2rad = math.pi / 180
+rad2deg = 180 / math.pi
+
+def main():
+    """ Main entry point """
+    cwd = os.path.dirname(os.path.dirname(os.path.abspath(__file__))) #pyephem folder
+    #--------START Command Line argument parser------------------------------------------------------
+    parser = argparse.ArgumentParser(description="Doppler engine regression check against pyephem",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--engines',
+                        dest='engines',
+                        type=str,
+                        default='batch,interp',
+                        help="Comma separated engines compared to the 'ephem' reference",
+                        action="store")
+    parser.add_argument('--objects',
+                        dest='objects',
+                        type=int,
+                        default=5,
+                        help="Number of catalog objects checked, first in name order",
+                        action="store")
+    parser.add_argument('--tol',
+                        dest='tol',
+                        type=float,
+                        default=0.5,
+                        help="Maximum allowed Doppler difference [Hz]",
+                        action="store")
+    parser.add_argument('--tle_file',
+                        dest='tle_file',
+                        type=str,
+                        default='pslv40_st.tle',
+                        help="TLE file of the checked objects",
+                        action="store")
+    parser.add_argument('--tle_folder',
+                        dest='tle_folder',
+                        type=str,
+                        default='/'.join([cwd, 'tle']),
+                        help="Folder containing TLE file",
+                        action="store")
+    parser.add_argument('--meas_data',
+                        dest='meas_data',
+                        type=str,
+                        default='DOPPLER_FOX-1D_20180113_161201.862011_UTC_10sps.dcol',
+                        help="Converted measurement, provides the time grid",
+                        action="store")
+    parser.add_argument('--meas_md',
+                        dest='meas_md',
+                        type=str,
+                        default='DOPPLER_FOX-1D_20180113_161201.862011_UTC_10sps.md',
+                        help="Measurement metadata file, ground station and center frequency",
+                        action="store")
+    parser.add_argument('--meas_folder',
+                        dest='meas_folder',
+                        type=str,
+                        default='/'.join([cwd, 'measurements']),
+                        help="Converted measurement file location",
+                        action="store")
+    args = parser.parse_args()
+    #--------END Command Line argument parser------------------------------------------------------
+    import warnings
+    warnings.filterwarnings('ignore')
+
+    with open('/'.join([args.meas_folder, args.meas_md]), 'r') as f:
+        md = json.load(f)
+    df = utilities.columnar.read_doppler('/'.join([args.meas_folder, args.meas_data]))
+    cat = utilities.catalog.tle_catalog_input(args.tle_folder, args.tle_file)
+    engines = args.engines.split(',')
+
+    hdr = '{:<20s}'.format('Object') + ''.join(['{:>14s}'.format(e + ' [Hz]') for e in engines])
+    print 'Max |engine - ephem| over {:d} samples, tolerance {:3.3f} [Hz]'.format(len(df), args.tol)
+    print hdr
+    print '-' * len(hdr)
+    worst = 0.0
+    for entry in cat.entries[:args.objects]:
+        job = {}
+        job['sat_name'] = entry['name']
+        job['norad_id'] = entry['norad_id']
+        job['line1']    = entry['line1']
+        job['line2']    = entry['line2']
+        job['gs_lat']   = md['gs_lat']*deg2rad
+        job['gs_lon']   = md['gs_lon']*deg2rad
+        job['gs_alt']   = md['gs_alt']
+        job['timestamp']= df['timestamp'].values
+        job['rx_freq']  = md['rx_center_freq']
+        job['engine']   = 'ephem'
+        ref = utilities.satellite.Gen_Doppler_Job(job)['doppler']['doppler_offset'].values
+        errs = []
+        for engine in engines:
+            job['engine'] = engine
+            dop = utilities.satellite.Gen_Doppler_Job(job)['doppler']['doppler_offset'].values
+            errs.append(float(np.max(np.abs(dop - ref))))
+        worst = max([worst] + errs)
+        print '{:<20s}'.format(entry['name']) + ''.join(['{:>14.4f}'.format(e) for e in errs])
+
+    if worst > args.tol:
+        print 'ERROR: engines differ from the pyephem reference by {:3.4f} [Hz] > {:3.4f} [Hz]'.format(worst, args.tol)
+        sys.exit(1)
+    print 'OK: max difference {:3.4f} [Hz]'.format(worst)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+#################################################
+#   Title: Auto trim regression check
+# Project: TLE Match
+#    Date: Jan 2018
+#  Author: Zach Leffke, KJ4QLP
+#    Desc:
+#       Runs gr_doppler.Auto_Trim on synthetic passes, a +/- pass of clean
+#       FLL lock with out of lock noise at both ends, at several lock noise
+#       levels down to a clean high SNR capture, plus one pass with a lock
+#       slip (single sample step) in the middle.  Fails if the trimmed span
+#       misses the lock span by more than the tolerance.  Exit status 1 on
+#       failure.
+#################################################
+import os
+import sys
+import argparse
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) #pyephem folder
+
+import utilities.gr_doppler
+
+def synthetic_pass(samp_rate, length, lock, doppler, sigma, seed=1):
+    #desc:  synthetic Doppler offset stream, tanh shaped pass centered in the
+    #       recording, uniform noise outside the lock span
+    #input:
+    #   samp_rate : samples per second
+    #   length    : recording length [s]
+    #   lock      : (start, stop) lock span [samples]
+    #   doppler   : peak Doppler offset [Hz]
+    #   sigma     : lock noise standard deviation [Hz]
+    #output: offset array [Hz]
+    rs = np.random.RandomState(seed)
+    t = np.arange(int(length * samp_rate)) / float(samp_rate)
+    x = -doppler * np.tanh((t - length / 2.0) / 60.0) + sigma * rs.randn(len(t))
+    x[:lock[0]] = rs.uniform(-20e3, 20e3, lock[0])
+    x[lock[1]:] = rs.uniform(-20e3, 20e3, len(t) - lock[1])
+    return x
+
+def main():
+    """ Main entry point """
+    #--------START Command Line argument parser------------------------------------------------------
+    parser = argparse.ArgumentParser(description="Auto trim regression check on synthetic passes",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--sigmas',
+                        dest='sigmas',
+                        type=str,
+                        default='0.05,0.2,1.0,5.0',
+                        help="Comma separated lock noise levels [Hz]",
+                        action="store")
+    parser.add_argument('--doppler',
+                        dest='doppler',
+                        type=float,
+                        default=3500.0,
+                        help="Peak Doppler offset of the synthetic pass [Hz]",
+                        action="store")
+    parser.add_argument('--samp_rate',
+                        dest='samp_rate',
+                        type=float,
+                        default=10.0,
+                        help="Sample rate [sps]",
+                        action="store")
+    parser.add_argument('--length',
+                        dest='length',
+                        type=float,
+                        default=1100.0,
+                        help="Recording length [s], 100 s out of lock at both ends",
+                        action="store")
+    parser.add_argument('--tol',
+                        dest='tol',
+                        type=float,
+                        default=2.0,
+                        help="Maximum allowed trim bound error [s]",
+                        action="store")
+    args = parser.parse_args()
+    #--------END Command Line argument parser------------------------------------------------------
+
+    n = int(args.length * args.samp_rate)
+    lock = (int(100 * args.samp_rate), n - int(100 * args.samp_rate))
+    tol = int(args.tol * args.samp_rate)
+    cases = []
+    for sigma in [float(s) for s in args.sigmas.split(',')]:
+        x = synthetic_pass(args.samp_rate, args.length, lock, args.doppler, sigma)
+        cases.append(('sigma {:3.2f} Hz'.format(sigma), x, lock))
+    #lock slip: 50 Hz step early in the pass, longest clean run follows it
+    sigma = float(args.sigmas.split(',')[0])
+    x = synthetic_pass(args.samp_rate, args.length, lock, args.doppler, sigma)
+    slip = lock[0] + (lock[1] - lock[0]) // 4
+    x[slip:lock[1]] += 50.0
+    cases.append(('slip sigma {:3.2f} Hz'.format(sigma), x, (slip, lock[1])))
+
+    hdr = '{:<22s}{:>10s}{:>10s}{:>10s}{:>10s}'.format('Case', 'start', 'expected', 'stop', 'expected')
+    print 'Auto_Trim bounds [samples], tolerance {:d} samples'.format(tol)
+    print hdr
+    print '-' * len(hdr)
+    failed = 0
+    for name, x, exp in cases:
+        trim = utilities.gr_doppler.Auto_Trim(x, args.samp_rate)
+        ok = abs(trim['start'] - exp[0]) <= tol and abs(trim['stop'] - exp[1]) <= tol
+        if not ok: failed += 1
+        print '{:<22s}{:>10d}{:>10d}{:>10d}{:>10d}{:s}'.format(name, trim['start'], exp[0], \
+                                                             trim['stop'], exp[1], '' if ok else '  FAIL')
+
+    if failed > 0:
+        print 'ERROR: {:d} of {:d} trims off by more than {:3.1f} [s]'.format(failed, len(cases), args.tol)
+        sys.exit(1)
+    print 'OK: all {:d} trims within {:3.1f} [s]'.format(len(cases), args.tol)
+
+if __name__ == '__main__':
+    main()
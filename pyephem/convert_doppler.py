@@ -15,13 +15,62 @@ import json
 import argparse
 import datetime as dt
 
+import numpy as np
+import pandas as pd
+
 import utilities.gr_doppler #GNU Radio specific doppler utilities
-import utilities.satellite  #General Satellite utilities, including doppler func
+import utilities.columnar   #binary columnar Doppler file format
+import utilities.instrument #logging setup
 #from utilities import *
 
 deg2rad = math.pi / 180
 rad2deg = 180 / math.pi
 
+def Build_Metadata(args, file_md):
+    #--metadata file content, measurement file name info plus gs arguments
+    md = {}
+    md['sat_name']      = file_md['sat_name']
+    md['receiver']      = file_md['receiver']
+    md['samp_rate_str'] = file_md['samp_rate_str']
+    md['samp_rate']     = file_md['samp_rate']
+    md['rx_center_freq']= args.rx_center_freq
+    for key in vars(args).keys(): #cycle through argparser keys
+        if 'gs' in key: #for gs items
+            if vars(args)[key]: #if the value isn't None
+                md[key] = vars(args)[key]
+    return md
+
+def Convert_Burst(args, file_md):
+    #--burst measurements are small (one offset per packet), no streaming needed
+    if args.auto_trim:
+        print 'WARNING: --auto_trim needs a uniform sample rate, ignored for burst files'
+    df = utilities.gr_doppler.Import_Burst_Data(args.meas_folder, args.meas_file, args.start, args.stop)
+    print 'Imported {:d} burst Doppler measurements from: {:s}'.format(len(df), args.meas_file)
+    if len(df) < 4:
+        print 'ERROR: too few burst measurements for a cubic fit'
+        sys.exit()
+    df['measured_freq'] = df['doppler_offset'] + args.rx_center_freq
+    ts = df['timestamp'].iloc[0].strftime("%Y%m%d_%H%M%S.%f_UTC")
+    fn = '_'.join(['DOPPLER',file_md['sat_name'], ts,file_md['samp_rate_str']])
+    fp = '/'.join([args.meas_folder,fn])
+
+    md = Build_Metadata(args, file_md)
+    md['samples'] = len(df)
+    md['trim_mode'] = 'manual'
+    md['trim_start'] = args.start
+    md['trim_stop'] = args.stop
+    print "                  Exporting Metadata to: {:s}".format(fp + '.md')
+    with open(fp + '.md', 'w') as of:
+        json.dump(md, of)
+    print "  Exporting Doppler Measurement File: {:s}".format(fp + utilities.columnar.ext)
+    utilities.columnar.write_columnar(fp + utilities.columnar.ext, df)
+    if args.text_export:
+        print "Exporting JSON Doppler Measurement File: {:s}".format(fp + '.json')
+        df.to_json(fp + '.json', orient='records', date_format='iso', date_unit = 'us')
+        print " Exporting CSV Doppler Measurement File: {:s}".format(fp + '.csv')
+        df.to_csv(fp + '.csv', index_label ="index", float_format="%.10f", \
+                  date_format='%Y-%m-%dT%H:%M:%S.%fZ')
+
 def main():
     """ Main entry point """
     os.system('reset')
@@ -37,7 +86,7 @@ def main():
                         dest='meas_file',
                         type=str,
                         default='FOX-1D_USRP_20180113_161106.862011_UTC_10sps.f32',
-                        help="Doppler offset measurement file from GNU Radio",
+                        help="Doppler offset measurement file from GNU Radio, .f32 stream or _burst.csv per packet offsets",
                         action="store")
     meas.add_argument('--meas_folder',
                         dest='meas_folder',
@@ -55,7 +104,7 @@ def main():
                         dest='start',
                         type=int,
                         default=0,
-                        help="Start Sample Offset from meas_file start for start of valid data",
+                        help="Start Sample Offset from meas_file start for start of valid data, packets for burst files",
                         action="store")
     meas.add_argument('--stop',
                         dest='stop',
@@ -63,6 +112,36 @@ def main():
                         default=0,
                         help="Stop Sample Offset from meas_file end for valid data",
                         action="store")
+    meas.add_argument('--auto_trim',
+                        dest='auto_trim',
+                        type=int,
+                        default=0,
+                        help="Find the valid lock span automatically inside --start/--stop, 0=N, 1=Y",
+                        action="store")
+    meas.add_argument('--trim_window',
+                        dest='trim_window',
+                        type=float,
+                        default=3.0,
+                        help="Auto trim rolling window length [s]",
+                        action="store")
+    meas.add_argument('--trim_k',
+                        dest='trim_k',
+                        type=float,
+                        default=4.0,
+                        help="Auto trim threshold, multiple of the rolling std noise floor",
+                        action="store")
+    meas.add_argument('--chunk_size',
+                        dest='chunk_size',
+                        type=int,
+                        default=1048576,
+                        help="Samples per block when streaming the measurement file",
+                        action="store")
+    meas.add_argument('--text_export',
+                        dest='text_export',
+                        type=int,
+                        default=0,
+                        help="Also export legacy JSON and CSV files, 0=N, 1=Y",
+                        action="store")
 
     gs = parser.add_argument_group('Ground Station Related Configurations')
     gs.add_argument('--gs_lat',
@@ -105,47 +184,71 @@ def main():
                         action="store",
                         required=False)
 
+    parser.add_argument('--log_level',
+                        dest='log_level',
+                        type=str,
+                        default='info',
+                        choices=utilities.instrument.log_levels,
+                        help="Console detail, debug adds per sample import detail",
+                        action="store")
+
     args = parser.parse_args()
     #--------END Command Line argument parser------------------------------------------------------
 
 
     import warnings
     warnings.filterwarnings('ignore')
-    #--Read in Doppler Measurement File
-    dop_df = utilities.gr_doppler.Import_Doppler_Data(args.meas_folder, args.meas_file)
-    dop_df['measured_freq'] = dop_df['doppler_offset'] + args.rx_center_freq
+    utilities.instrument.setup_logging(args.log_level)
+    #--Measurement file is streamed in blocks, never fully loaded
+    fp_meas = '/'.join([args.meas_folder, args.meas_file])
+    if not os.path.isfile(fp_meas):
+        print "ERROR: Invalid Doppler Measurement source file: " + fp_meas
+        sys.exit()
+    file_md = utilities.gr_doppler.Get_Meas_File_Metadata(args.meas_file)
+    if file_md['samp_rate'] == 0: #burst measurement, irregular time stamps
+        Convert_Burst(args, file_md)
+        return
+    num_samples = os.path.getsize(fp_meas) // 4 #float32
+    print 'Streaming Doppler data from: {:s}'.format(fp_meas)
+    print '      Recording Start Time [UTC]: {:s}'.format(str(file_md['start_ts']))
+    print 'Recording Sample Rate [samp/sec]: {:d}'.format(file_md['samp_rate'])
+    print '    Samples in Recording [samps]: {:d}'.format(num_samples)
 
     #--Extract valid start, stop samples
     start = args.start
-    stop = len(dop_df)-args.stop
+    stop = num_samples-args.stop
+    if stop <= start:
+        print 'ERROR: no samples left after trimming'
+        sys.exit()
+    trim = None
+    if args.auto_trim:
+        data_pts = utilities.gr_doppler.gr_f32_file_mmap(fp_meas)
+        try:
+            trim = utilities.gr_doppler.Auto_Trim(data_pts[start:stop], file_md['samp_rate'], \
+                                                  args.trim_window, args.trim_k)
+        except ValueError as e:
+            print 'ERROR: auto trim failed, {:s}'.format(str(e))
+            sys.exit()
+        start, stop = start + trim['start'], start + trim['stop']
+        print 'Auto trim noise floor [Hz]: {:3.3f}, threshold [Hz]: {:3.3f}'.format(trim['floor'], trim['threshold'])
+        print 'Auto trim bounds: --start {:d} --stop {:d}'.format(start, num_samples - stop)
     print 'Extracting Data Points: [{:d}:{:d}]'.format(start, stop)
-    dop_df = dop_df[start:stop]
-    dop_df = dop_df.reset_index()
-    del dop_df['index']
 
     #--Generate Output File Names and Paths--
-    file_md = utilities.gr_doppler.Get_Meas_File_Metadata(args.meas_file)
-    ts = dt.datetime.strftime(dop_df['timestamp'][0], "%Y%m%d_%H%M%S.%f_UTC")
-    fn_json = '_'.join(['DOPPLER',file_md['sat_name'], ts,file_md['samp_rate_str']]) + '.json'
-    fn_csv  = fn_json.replace('json', 'csv')
-    fn_md  = fn_json.replace('json', 'md')
-    fp_json = '/'.join([args.meas_folder,fn_json])
-    fp_csv  = '/'.join([args.meas_folder,fn_csv])
-    fp_md   = '/'.join([args.meas_folder,fn_md])
+    ts = utilities.gr_doppler.Meas_Time_Stamps(file_md, start, 1)[0]
+    ts = pd.Timestamp(ts).strftime("%Y%m%d_%H%M%S.%f_UTC")
+    fn = '_'.join(['DOPPLER',file_md['sat_name'], ts,file_md['samp_rate_str']])
+    fp_dcol = '/'.join([args.meas_folder,fn]) + utilities.columnar.ext
+    fp_json = '/'.join([args.meas_folder,fn]) + '.json'
+    fp_csv  = '/'.join([args.meas_folder,fn]) + '.csv'
+    fp_md   = '/'.join([args.meas_folder,fn]) + '.md'
 
     #--Generate Metadata information
-    md = {}
-    md['sat_name']      = file_md['sat_name']
-    md['receiver']      = file_md['receiver']
-    md['samp_rate_str'] = file_md['samp_rate_str']
-    md['samp_rate']     = file_md['samp_rate']
-    md['rx_center_freq']= args.rx_center_freq
-    #print vars(args)
-    for key in vars(args).keys(): #cycle through argparser keys
-        if 'gs' in key: #for gs items
-            if vars(args)[key]: #if the value isn't None
-                #print key, vars(args)[key]
-                md[key] = vars(args)[key]
+    md = Build_Metadata(args, file_md)
+    md['trim_mode'] = 'auto' if trim else 'manual'
+    md['trim_start'] = start                #samples dropped at start, as --start
+    md['trim_stop'] = num_samples - stop    #samples dropped at end, as --stop
+    if trim: md['trim_threshold'] = trim['threshold']
 
     #--Export Metadata File
     print "                  Exporting Metadata to: {:s}".format(fp_md)
@@ -153,19 +256,48 @@ def main():
         json.dump(md, of)
         of.close()
 
-    #--Export JSON Doppler File
-    print "Exporting JSON Doppler Measurement File: {:s}".format(fp_json)
-    dop_df.to_json( fp_json, \
-                    orient='records', \
-                    date_format='iso', \
-                    date_unit = 'us')
-
-    #--Export CSV Doppler File
-    print " Exporting CSV Doppler Measurement File: {:s}".format(fp_csv)
-    dop_df.to_csv(  fp_csv, \
-                    index_label ="index", \
-                    float_format="%.10f", \
-                    date_format='%Y-%m-%dT%H:%M:%S.%fZ')
+    #--Export Doppler Files, one block at a time
+    print "  Exporting Doppler Measurement File: {:s}".format(fp_dcol)
+    columns = [('doppler_offset', '<f8'), ('timestamp', '<M8[ns]'), ('measured_freq', '<f8')]
+    dcol = utilities.columnar.columnar_writer(fp_dcol, file_md['sat_name'], columns, stop - start)
+    f_json, f_csv = None, None
+    if args.text_export:
+        print "Exporting JSON Doppler Measurement File: {:s}".format(fp_json)
+        print " Exporting CSV Doppler Measurement File: {:s}".format(fp_csv)
+        f_json = open(fp_json, 'w')
+        f_json.write('[')
+        f_csv = open(fp_csv, 'w')
+    blocks = utilities.gr_doppler.Stream_Doppler_Data(args.meas_folder, args.meas_file, \
+                                                      start, num_samples - stop, args.chunk_size)
+    count = 0
+    for ts, offsets in blocks:
+        offsets = offsets.astype(float)
+        dcol.write(count, { 'doppler_offset':offsets,
+                            'timestamp':ts,
+                            'measured_freq':offsets + args.rx_center_freq})
+        if args.text_export:
+            dop_df = pd.DataFrame(  { 'doppler_offset':offsets,
+                                      'timestamp':ts,
+                                      'measured_freq':offsets + args.rx_center_freq},
+                                    columns=['doppler_offset', 'timestamp', 'measured_freq'],
+                                    index=np.arange(count, count + len(offsets)))
+            records = dop_df.to_json(orient='records', \
+                                     date_format='iso', \
+                                     date_unit = 'us')
+            if count > 0: f_json.write(',')
+            f_json.write(records[1:-1]) #strip enclosing brackets
+            dop_df.to_csv(  f_csv, \
+                            header = (count == 0), \
+                            index_label ="index", \
+                            float_format="%.10f", \
+                            date_format='%Y-%m-%dT%H:%M:%S.%fZ')
+        count += len(offsets)
+    dcol.close()
+    if args.text_export:
+        f_json.write(']')
+        f_json.close()
+        f_csv.close()
+    print "Exported {:d} Doppler Measurements".format(count)
 
 
     #fig_cnt = utilities.plotting.plot_offset_idx(0, dop, args.fig_path, args.fig_save)
@@ -11,27 +11,24 @@ import math
 import ephem
 import argparse
 import json
+import logging
 import datetime as dt
 
 import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
 
 
 import utilities.satellite
-import utilities.plotting
+import utilities.columnar
 import utilities.poly
+import utilities.pipeline
+import utilities.instrument
 #from utilities import *
 
 deg2rad = math.pi / 180
 rad2deg = 180 / math.pi
 
-def json_serial(obj):
-    """JSON serializer for objects not serializable by default json code"""
-
-    if isinstance(obj, dt.datetime):
-        return obj.__str__()
-    raise TypeError ("Type %s not serializable" % type(obj))
+log = logging.getLogger(__name__)
 
 def main():
     """ Main entry point """
@@ -48,13 +45,39 @@ def main():
                         default=1.0,
                         help="Regression interpolation factor",
                         action="store")
+    parser.add_argument('--degree',
+                        dest='degree',
+                        type=int,
+                        default=3,
+                        help="Regression polynomial degree, 0=pick per curve by --criterion",
+                        action="store")
+    parser.add_argument('--criterion',
+                        dest='criterion',
+                        type=str,
+                        default='bic',
+                        choices=['aic', 'bic'],
+                        help="Information criterion for --degree 0",
+                        action="store")
+    parser.add_argument('--robust',
+                        dest='robust',
+                        type=str,
+                        default=None,
+                        choices=['huber', 'bisquare'],
+                        help="Outlier resistant fit of the measurement, default plain least squares",
+                        action="store")
     meas = parser.add_argument_group('Measurement Related Configurations')
     meas_fp_default = '/'.join([cwd, 'measurements'])
+    meas.add_argument('--meas_data',
+                        dest='meas_data',
+                        type=str,
+                        default='DOPPLER_FOX-1D_20180113_161201.862011_UTC_10sps.dcol',
+                        help="Converted Doppler offset measurement file, binary columnar format",
+                        action="store")
     meas.add_argument('--meas_json',
                         dest='meas_json',
                         type=str,
-                        default='DOPPLER_FOX-1D_20180113_161201.862011_UTC_10sps.json',
-                        help="Converted Doppler offset measurement file, JSON format",
+                        default=None,
+                        help="Converted Doppler offset measurement file, JSON format, overrides --meas_data",
                         action="store")
     meas.add_argument('--meas_csv',
                         dest='meas_csv',
@@ -99,11 +122,40 @@ def main():
                         help="Save Figure Flag, 0=N, 1=Y",
                         action="store")
 
+    ins = parser.add_argument_group('Instrumentation Related Configurations')
+    ins.add_argument('--log_level',
+                        dest='log_level',
+                        type=str,
+                        default='info',
+                        choices=utilities.instrument.log_levels,
+                        help="Console detail, debug adds per curve fit output and the polynomial JSON",
+                        action="store")
+    ins.add_argument('--report',
+                        dest='report',
+                        type=str,
+                        default=None,
+                        help="Write a JSON run report (stage spans, counters, peak memory) to this file",
+                        action="store")
+    ins.add_argument('--profile',
+                        dest='profile',
+                        type=str,
+                        default=None,
+                        choices=utilities.instrument.profilers,
+                        help="Profile the polynomial fits, default none",
+                        action="store")
+    ins.add_argument('--profile_out',
+                        dest='profile_out',
+                        type=str,
+                        default=None,
+                        help="Profile output file (pstats for cprofile, text for pyinstrument), default log the top functions",
+                        action="store")
 
     args = parser.parse_args()
     #--------END Command Line argument parser------------------------------------------------------
     import warnings
     warnings.filterwarnings('ignore')
+    utilities.instrument.setup_logging(args.log_level)
+    report = utilities.instrument.run_report('doppler_polynomial')
 
     #--Read in Measurement metadata
     fp_md = '/'.join([args.meas_folder,args.meas_md])
@@ -116,54 +168,66 @@ def main():
         md = json.load(f)
 
     for k in md.keys():
-        print k, md[k]
+        log.debug('%s %s', k, md[k])
 
     #Read in Doppler Measurement File
-    fp_meas = '/'.join([args.meas_folder,args.meas_json])
-    print 'Importing measurement metadata from: {:s}'.format(fp_meas)
-    df = pd.read_json(fp_meas, orient='records')
-    df.name = md['sat_name']
-    df['dop_norm'] = df['doppler_offset'] / md['rx_center_freq']
-
-    #Read in Generated Doppler Files
-    gen_files = utilities.poly.Find_File_Names(args.gen_folder)
-    gen_files = [ x for x in gen_files if ".csv" not in x ]
-
-    dop_df = [] #list containing doppler data, might not be needed
-    dop_df.append(df)
-    for gen_f in gen_files:
-        #print gen_f
-        fp_gen = '/'.join([args.gen_folder,gen_f])
-        if os.path.isfile(fp_gen) == True:
-            print 'Importing generated doppler data from: {:s}'.format(fp_gen)
-            dop_df.append(pd.read_json(fp_gen, orient='records'))
-            dop_df[-1].name = gen_f.split('_')[1]
-            dop_df[-1]['dop_norm'] = dop_df[-1]['doppler_offset'] / md['rx_center_freq']
-            #print dop_df
-        else:
-            'ERROR: invalid generated doppler file: {:s}'.format(fp_gen)
-
-    print md['rx_center_freq']
-
+    if args.meas_json: fp_meas = '/'.join([args.meas_folder,args.meas_json])
+    else: fp_meas = '/'.join([args.meas_folder,args.meas_data])
+    print 'Importing measurement data from: {:s}'.format(fp_meas)
+    with report.span('import') as sp:
+        df = utilities.columnar.read_doppler(fp_meas)
+        df.name = md['sat_name']
+        df['dop_norm'] = df['doppler_offset'] / md['rx_center_freq']
+
+        #Read in Generated Doppler Files
+        gen_files = utilities.columnar.find_doppler_files(args.gen_folder)
+
+        dop_df = [] #list containing doppler data, might not be needed
+        dop_df.append(df)
+        for gen_f in gen_files:
+            fp_gen = '/'.join([args.gen_folder,gen_f])
+            if os.path.isfile(fp_gen) == True:
+                log.debug('Importing generated doppler data from: %s', fp_gen)
+                dop_df.append(utilities.columnar.read_doppler(fp_gen))
+                dop_df[-1].name = gen_f.split('_')[1]
+                dop_df[-1]['dop_norm'] = dop_df[-1]['doppler_offset'] / md['rx_center_freq']
+            else:
+                log.warning('invalid generated doppler file: %s', fp_gen)
+        sp['counts']['samples'] = len(df)
+        sp['counts']['curves'] = len(dop_df)
+    print 'Imported {:d} generated doppler files from: {:s}'.format(len(dop_df) - 1, args.gen_folder)
+    report.count('samples', len(df))
+    report.count('candidates', len(dop_df) - 1)
+    report.count('candidate_samples', sum([len(d) for d in dop_df[1:]]))
 
     #utilities.plotting.plot_multi_doppler_ts(0,dop_df, args.fig_path, args.fig_save)
     #utilities.poly.Doppler_Regression(df)
-    poly_data = []
-    for dop in dop_df:
-        dop_poly = {}
-        dop_poly['name'] = dop.name
-        dop_poly['pf'] = utilities.poly.Doppler_Poly_Regression_idx(dop,args.interp)
-        poly_data.append(dop_poly)
-
-    print poly_data
+    #shared time grid fits all at once, robust fit only for the measurement
+    try:
+        with utilities.instrument.profile(args.profile, args.profile_out):
+            with report.span('fit', curves=len(dop_df), samples=sum([len(d) for d in dop_df])):
+                poly_data = utilities.pipeline.fit(dop_df, args.interp, args.degree, args.criterion, args.robust)
+    except (ImportError, ValueError) as e:
+        print 'ERROR: {:s}'.format(str(e))
+        sys.exit()
+
     #fig_cnt = utilities.plotting.plot_offset(0, df, args.fig_path, args.fig_save)
 
 
     out_fp = md['sat_name'] + '.' + 'json'
 
-    print json.dumps(poly_data, indent=4, default=json_serial)
-    with open(out_fp, 'w') as outfile:
-        json.dump(poly_data, outfile, indent=4, default=json_serial)
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug(json.dumps(poly_data, indent=4, default=utilities.pipeline.json_serial))
+    with report.span('export'):
+        with open(out_fp, 'w') as outfile:
+            json.dump(poly_data, outfile, indent=4, default=utilities.pipeline.json_serial)
+    print 'Exported polynomial data to: {:s}'.format(out_fp)
+
+    if args.report:
+        report.info['sat_name'] = md['sat_name']
+        report.info['polynomial_file'] = out_fp
+        report.save(args.report)
+        print 'Run report written to: {:s}'.format(args.report)
 
 if __name__ == '__main__':
     main()
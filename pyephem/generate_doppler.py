@@ -11,23 +11,27 @@
 import os
 import sys
 import math
-import ephem
 import argparse
 import json
+import time
+import logging
 import datetime as dt
 
-import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
 
-import utilities.pyephem
+import utilities.catalog
+import utilities.cache
 import utilities.satellite
-import utilities.plotting
+import utilities.columnar
+import utilities.pipeline
+import utilities.instrument
 #from utilities import *
 
 deg2rad = math.pi / 180
 rad2deg = 180 / math.pi
 
+log = logging.getLogger(__name__)
+
 def main():
     """ Main entry point """
     os.system('reset')
@@ -52,14 +56,32 @@ def main():
                     default=tle_fp_default,
                     help="Folder containing TLE file",
                     action="store")
+    tle.add_argument('--norad',
+                    dest='norad',
+                    type=str,
+                    default=None,
+                    help="Comma separated NORAD IDs to use as candidates, default all",
+                    action="store")
+    tle.add_argument('--intl_des',
+                    dest='intl_des',
+                    type=str,
+                    default=None,
+                    help="International designator prefix of candidates, ex: 2018-004",
+                    action="store")
 
     meas = parser.add_argument_group('Measurement Related Configurations')
     meas_fp_default = '/'.join([cwd, 'measurements'])
+    meas.add_argument('--meas_data',
+                        dest='meas_data',
+                        type=str,
+                        default='DOPPLER_FOX-1D_20180113_161201.862011_UTC_10sps.dcol',
+                        help="Converted Doppler offset measurement file, binary columnar format",
+                        action="store")
     meas.add_argument('--meas_json',
                         dest='meas_json',
                         type=str,
-                        default='DOPPLER_FOX-1D_20180113_161201.862011_UTC_10sps.json',
-                        help="Converted Doppler offset measurement file, JSON format",
+                        default=None,
+                        help="Converted Doppler offset measurement file, JSON format, overrides --meas_data",
                         action="store")
     meas.add_argument('--meas_csv',
                         dest='meas_csv',
@@ -101,6 +123,60 @@ def main():
                         help="Generated Doppler offset measurement file, CSV format",
                         action="store")
 
+    gen.add_argument('--engine',
+                        dest='engine',
+                        type=str,
+                        default='batch',
+                        choices=['batch', 'interp', 'ephem'],
+                        help="Doppler engine, batch=vectorized SGP4, interp=Chebyshev ephemeris from coarse SGP4, \
+                              ephem=per sample pyephem reference",
+                        action="store")
+    gen.add_argument('--workers',
+                        dest='workers',
+                        type=int,
+                        default=1,
+                        help="Number of worker processes for candidate Doppler generation, 1=serial",
+                        action="store")
+    gen.add_argument('--el_mask',
+                        dest='el_mask',
+                        type=float,
+                        default=0.0,
+                        help="Elevation mask [deg], candidates never above it during the measurement are skipped",
+                        action="store")
+    gen.add_argument('--screen_step',
+                        dest='screen_step',
+                        type=float,
+                        default=30.0,
+                        help="Time step of the coarse visibility screen [s], 0=no screening",
+                        action="store")
+    gen.add_argument('--text_export',
+                        dest='text_export',
+                        type=int,
+                        default=0,
+                        help="Also export legacy JSON and CSV files, 0=N, 1=Y",
+                        action="store")
+
+    cache = parser.add_argument_group('Doppler Cache Related Configurations')
+    cache_fp_default = '/'.join([cwd, 'cache'])
+    cache.add_argument('--cache',
+                        dest='cache',
+                        type=int,
+                        default=1,
+                        help="Reuse previously generated Doppler curves, 0=N, 1=Y",
+                        action="store")
+    cache.add_argument('--cache_folder',
+                        dest='cache_folder',
+                        type=str,
+                        default=cache_fp_default,
+                        help="Doppler cache location",
+                        action="store")
+    cache.add_argument('--cache_size',
+                        dest='cache_size',
+                        type=float,
+                        default=512.0,
+                        help="Doppler cache size limit [MB], least recently used curves are evicted",
+                        action="store")
+
     plot = parser.add_argument_group('Plotting Related Configurations')
     fig_fp_default = '/'.join([cwd, 'figures'])
     plot.add_argument('--fig_path',
@@ -116,11 +192,40 @@ def main():
                         help="Save Figure Flag, 0=N, 1=Y",
                         action="store")
 
+    ins = parser.add_argument_group('Instrumentation Related Configurations')
+    ins.add_argument('--log_level',
+                        dest='log_level',
+                        type=str,
+                        default='info',
+                        choices=utilities.instrument.log_levels,
+                        help="Console detail, debug adds per candidate progress and file output",
+                        action="store")
+    ins.add_argument('--report',
+                        dest='report',
+                        type=str,
+                        default=None,
+                        help="Write a JSON run report (stage spans, counters, peak memory) to this file",
+                        action="store")
+    ins.add_argument('--profile',
+                        dest='profile',
+                        type=str,
+                        default=None,
+                        choices=utilities.instrument.profilers,
+                        help="Profile the Doppler generation, default none",
+                        action="store")
+    ins.add_argument('--profile_out',
+                        dest='profile_out',
+                        type=str,
+                        default=None,
+                        help="Profile output file (pstats for cprofile, text for pyinstrument), default log the top functions",
+                        action="store")
 
     args = parser.parse_args()
     #--------END Command Line argument parser------------------------------------------------------
     import warnings
     warnings.filterwarnings('ignore')
+    utilities.instrument.setup_logging(args.log_level)
+    report = utilities.instrument.run_report('generate_doppler')
 
     #--Read in Measurement metadata
     fp_md = '/'.join([args.meas_folder,args.meas_md])
@@ -133,67 +238,115 @@ def main():
         md = json.load(f)
 
     for k in md.keys():
-        print k, md[k]
+        log.debug('%s %s', k, md[k])
     #with open
 
     #--Read in TLE Files--
-    tle = utilities.pyephem.tle_file_input(args.tle_folder, args.tle_file)
-    #print tle
+    try:
+        cat = utilities.catalog.tle_catalog_input(args.tle_folder, args.tle_file)
+    except IOError as e:
+        print 'ERROR: {:s}'.format(str(e))
+        sys.exit()
+    norad_ids = args.norad.split(',') if args.norad else None
+    candidates = cat.select(norad_ids=norad_ids, intl_des=args.intl_des)
+    print "Selected {:d} candidate satellites".format(len(candidates))
+    if len(candidates) == 0:
+        print 'ERROR: no candidate satellites selected'
+        sys.exit()
 
     #--create list of satellite objects with pyephem--
-    sats = [] #list of satellite objects
-    for sat in tle.keys():
-        ephem_sat = ephem.readtle(sat, tle[sat]['line1'], tle[sat]['line2'])
-        norad_id = tle[sat]['line1'][2:7]
-        sats.append(utilities.satellite.satellite(ephem_sat,sat, norad_id))
-
-    #--create ground station object with pyephem--
-    gs = ephem.Observer()
-    gs.lat, gs.lon, gs.elevation =  md['gs_lat']*deg2rad, \
-                                    md['gs_lon']*deg2rad, \
-                                    md['gs_alt']
+    sats = utilities.pipeline.satellites(candidates) #ordered by name so output is deterministic
 
     #Read in Doppler Measurement File
     #This data is needed to get the relevant time stamps
-    fp_meas = '/'.join([args.meas_folder,args.meas_json])
-    print 'Importing measurement metadata from: {:s}'.format(fp_meas)
-    df = pd.read_json(fp_meas, orient='records')
+    if args.meas_json: fp_meas = '/'.join([args.meas_folder,args.meas_json])
+    else: fp_meas = '/'.join([args.meas_folder,args.meas_data])
+    print 'Importing measurement data from: {:s}'.format(fp_meas)
+    df = utilities.columnar.read_doppler(fp_meas)
     df.name = md['sat_name']
 
-    dopplers = [] #list containing doppler data, might not be needed
-    for sat in sats:
-        print "Generating Doppler data for {:s}_{:s}".format(sat.sat_name, sat.norad_id)
-        print "Downlink Center Freq [MHz]: {:3.6f}".format(md['rx_center_freq']/1e6)
-        dop_df = sat.gen_doppler(   gs, \
-                                    df['timestamp'].values.tolist(), \
-                                    md['rx_center_freq'])
-
-        dopplers.append(dop_df)
-
-    for dop in dopplers:
-        ts = dop['timestamp'][0].strftime("%Y%m%d_%H%M%S.%f_UTC")
-        fn = '_'.join(['DOPPLER', dop.name, ts, md['samp_rate_str']])
-        fp_json = '/'.join([args.gen_folder,fn]) + '.json'
-        fp_csv  = '/'.join([args.gen_folder,fn]) + '.csv'
+    #--cached curves are reused, only the misses are propagated
+    dcache = None
+    if args.cache:
+        dcache = utilities.cache.doppler_cache(args.cache_folder, int(args.cache_size*1024*1024))
 
-        #--Export JSON Doppler File
-        print "Exporting JSON Doppler Measurement File: {:s}".format(fp_json)
-        dop.to_json(fp_json, \
-                    orient='records', \
-                    date_format='iso', \
-                    date_unit = 'us')
-
-        #--Export CSV Doppler File
-        print " Exporting CSV Doppler Measurement File: {:s}".format(fp_csv)
-        dop.to_csv( fp_csv, \
-                    index_label ="index", \
-                    float_format="%.10f", \
-                    date_format='%Y-%m-%dT%H:%M:%S.%fZ')
+    #--coarse visibility screen, cache lookup and generation, see utilities.pipeline.generate
+    print "Downlink Center Freq [MHz]: {:3.6f}".format(md['rx_center_freq']/1e6)
+    print "Generating Doppler data for {:d} candidates, {:d} worker(s)".format(len(sats), args.workers)
+    t0 = time.time()
+    stats = {}
+    try:
+        with utilities.instrument.profile(args.profile, args.profile_out), \
+             report.span('generate', samples=len(df), candidates=len(sats)) as sp:
+            dopplers = utilities.pipeline.generate(sats, md, df['timestamp'].values, args.engine, \
+                                                   args.workers, args.el_mask, args.screen_step, \
+                                                   dcache, stats)
+            timing = stats['elapsed']
+            sp['counts']['cached'] = stats['cached']
+            sp['counts']['generated'] = len(timing)
+            sp['counts']['candidate_samples'] = len(df) * len(timing)
+    except ImportError as e:
+        print 'ERROR: {:s}'.format(str(e))
+        sys.exit()
+    t_total = time.time() - t0
+    if 'max_el' in stats:
+        print "Visibility screen: {:d} of {:d} candidates above {:3.1f} [deg]".format(len(stats['visible']), \
+                                                                    len(sats), args.el_mask)
+        for sat, el in zip(sats, stats['max_el']):
+            if el < args.el_mask:
+                log.debug("    Skipping %s(%s), max elevation %3.1f [deg]", sat.sat_name, sat.norad_id, el)
+    if dcache is not None:
+        print "Doppler cache: {:d} hit(s), {:d} miss(es), {:s}".format(dcache.hits, dcache.misses, args.cache_folder)
+    report.count('samples', len(df))
+    report.count('candidates', len(sats))
+    report.count('generated', len(timing))
+    report.count('candidate_samples', len(df) * len(timing))
+    print "Doppler generation summary:"
+    print "      Candidates: {:d}".format(len(timing))
+    print "          Cached: {:d}".format(stats['cached'])
+    print "  Wall Clock [s]: {:3.3f}".format(t_total)
+    if len(timing) > 0:
+        print "  Candidate [s]: min {:3.3f}, mean {:3.3f}, max {:3.3f}".format(min(timing), \
+                                                    sum(timing)/len(timing), max(timing))
+    if len(stats['interp_err']) > 0:
+        print "  Max ephemeris interpolation error [Hz]: {:3.6f}".format(max(stats['interp_err']) / \
+                                                    utilities.satellite.c * md['rx_center_freq'])
 
+    with report.span('export', curves=len(dopplers)):
+        for dop in dopplers:
+            ts = dop['timestamp'][0].strftime("%Y%m%d_%H%M%S.%f_UTC")
+            fn = '_'.join(['DOPPLER', dop.name, ts, md['samp_rate_str']])
+            fp_dcol = '/'.join([args.gen_folder,fn]) + utilities.columnar.ext
+            fp_json = '/'.join([args.gen_folder,fn]) + '.json'
+            fp_csv  = '/'.join([args.gen_folder,fn]) + '.csv'
 
+            #--Export binary columnar Doppler File
+            log.debug("     Exporting Doppler Data File: %s", fp_dcol)
+            utilities.columnar.write_columnar(fp_dcol, dop)
+            if not args.text_export: continue
 
+            #--Export JSON Doppler File
+            log.debug("Exporting JSON Doppler Measurement File: %s", fp_json)
+            dop.to_json(fp_json, \
+                        orient='records', \
+                        date_format='iso', \
+                        date_unit = 'us')
 
+            #--Export CSV Doppler File
+            log.debug(" Exporting CSV Doppler Measurement File: %s", fp_csv)
+            dop.to_csv( fp_csv, \
+                        index_label ="index", \
+                        float_format="%.10f", \
+                        date_format='%Y-%m-%dT%H:%M:%S.%fZ')
+    print "Exported {:d} Doppler files to: {:s}".format(len(dopplers), args.gen_folder)
 
+    if args.report:
+        report.info['sat_name'] = md['sat_name']
+        report.info['engine'] = args.engine
+        report.info['workers'] = args.workers
+        if dcache is not None: report.info['cache'] = {'hits':dcache.hits, 'misses':dcache.misses}
+        report.save(args.report)
+        print 'Run report written to: {:s}'.format(args.report)
 
 if __name__ == '__main__':
     main()
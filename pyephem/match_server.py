@@ -0,0 +1,332 @@
+#!/usr/bin/env python
+#################################################
+#   Title: TLE Match Server
+# Project: TLE Match
+#    Date: Jan 2018
+#  Author: Zach Leffke, KJ4QLP
+#    Desc:
+#       Long running match service.  TLE catalogs, satellite objects and
+#       recently generated Doppler curves stay in memory between jobs.
+#       The TLE folder is polled and changed files are re-parsed, standing
+#       in for an external TLE feed.
+#
+#       GET  /status : loaded catalogs, cache statistics
+#       POST /match  : JSON job, ranked candidates returned as JSON
+#           meas_file                  : GNU Radio .f32 recording, with
+#               rx_center_freq, gs_lat, gs_lon, gs_alt, start, stop
+#           or meas_data + meas_md     : converted measurement and metadata
+#           meas_folder                : default --meas_folder
+#           tle_file                   : default --tle_file
+#           norad, intl_des            : candidate selection, as generate_doppler
+#           rank_by, top, el_mask, screen_step : as tle_pipeline
+#################################################
+import os
+import sys
+import math
+import json
+import time
+import logging
+import argparse
+import threading
+import SocketServer
+import BaseHTTPServer
+import datetime as dt
+
+import utilities.catalog
+import utilities.cache
+import utilities.pipeline
+import utilities.instrument
+
+deg2rad = math.pi / 180
+rad2deg = 180 / math.pi
+
+log = logging.getLogger(__name__)
+
+tle_ext = ['.tle', '.txt']
+
+class match_service(object):
+    def __init__(self, tle_folder, tle_file, meas_folder, dcache, engine='batch', workers=1):
+        self.tle_folder = tle_folder
+        self.tle_file = tle_file
+        self.meas_folder = meas_folder
+        self.dcache = dcache
+        self.engine = engine
+        self.workers = workers
+        self.catalogs = {}  #file name -> (mtime, tle_catalog)
+        self.sats = {}      #(line1, line2) -> satellite object, reused across jobs
+        self.jobs = 0
+        self._lock = threading.Lock()       #catalogs / sats
+        self._job_lock = threading.Lock()   #one match at a time, pyephem objects are shared
+        self.reload()
+
+    def reload(self):
+        #desc:  parse new or modified TLE files, drop deleted ones
+        #output: list of reloaded file names
+        found = {}
+        for fn in os.listdir(self.tle_folder):
+            if os.path.splitext(fn)[1] in tle_ext:
+                found[fn] = os.path.getmtime('/'.join([self.tle_folder, fn]))
+        reloaded = []
+        for fn in sorted(found.keys()):
+            if fn in self.catalogs and self.catalogs[fn][0] == found[fn]: continue
+            cat = utilities.catalog.tle_catalog()
+            try:
+                cat.load('/'.join([self.tle_folder, fn]))
+            except IOError as e: #removed while loading, pick it up next poll
+                print 'WARNING: {:s}'.format(str(e))
+                continue
+            with self._lock:
+                self.catalogs[fn] = (found[fn], cat)
+            reloaded.append(fn)
+            print '{:s} Loaded TLE file: {:s}, {:d} satellites, {:d} skipped'.format( \
+                    dt.datetime.utcnow().isoformat(), fn, len(cat), len(cat.errors))
+        with self._lock:
+            for fn in self.catalogs.keys():
+                if fn not in found: del self.catalogs[fn]
+            if len(reloaded) > 0: #forget satellites no catalog refers to anymore
+                lines = set()
+                for mtime, cat in self.catalogs.values():
+                    lines.update([(e['line1'], e['line2']) for e in cat.entries])
+                for k in self.sats.keys():
+                    if k not in lines: del self.sats[k]
+        return reloaded
+
+    def watch(self, poll):
+        #TLE folder polling loop, run in a daemon thread
+        while True:
+            time.sleep(poll)
+            try:
+                self.reload()
+            except OSError as e:
+                print 'WARNING: TLE folder poll failed: {:s}'.format(str(e))
+
+    def candidates(self, tle_file, norad_ids=None, intl_des=None):
+        #satellite objects for the selection, built once per TLE set
+        with self._lock:
+            if tle_file not in self.catalogs:
+                raise ValueError('Unknown TLE file: {:s}'.format(tle_file))
+            cat = self.catalogs[tle_file][1]
+            sats = []
+            for entry in cat.select(norad_ids=norad_ids, intl_des=intl_des):
+                key = (entry['line1'], entry['line2'])
+                if key not in self.sats:
+                    self.sats[key] = utilities.pipeline.satellites([entry])[0]
+                sats.append(self.sats[key])
+        return sats
+
+    def match(self, job):
+        #desc:  run one match job
+        #input:  job dict, see module header
+        #output: JSON serializable result dict
+        t0 = time.time()
+        meas_folder = job.get('meas_folder', self.meas_folder)
+        if 'meas_file' in job:
+            gs = {}
+            for k in ['gs_lat', 'gs_lon', 'gs_alt']:
+                if k not in job: raise ValueError('missing job field: {:s}'.format(k))
+                gs[k] = float(job[k])
+            df, md = utilities.pipeline.load_measurement(meas_folder, job['meas_file'], \
+                                                         float(job.get('rx_center_freq', 145.880e6)), \
+                                                         int(job.get('start', 0)), int(job.get('stop', 0)), gs)
+        elif 'meas_data' in job and 'meas_md' in job:
+            df, md = utilities.pipeline.load_converted(meas_folder, job['meas_data'], job['meas_md'])
+        else:
+            raise ValueError('job needs meas_file or meas_data and meas_md')
+        norad = job.get('norad', None)
+        if isinstance(norad, basestring): norad = norad.split(',')
+        tle_file = job.get('tle_file', self.tle_file)
+        sats = self.candidates(tle_file, norad, job.get('intl_des', None))
+        t_import = time.time() - t0
+        with self._job_lock:
+            res = utilities.pipeline.match_measurement(df, md, sats, self.engine, self.workers, \
+                                                       float(job.get('el_mask', 0.0)), \
+                                                       float(job.get('screen_step', 30.0)), \
+                                                       self.dcache, 1, job.get('rank_by', 'tca_delta'))
+            self.jobs += 1
+        timing = [('import', t_import)] + res['timing']
+        top = job.get('top', None)
+        result = {}
+        result['name'] = md['sat_name']
+        result['tle_file'] = tle_file
+        result['candidates'] = len(res['table'])
+        result['rank_by'] = res['rank_by']
+        result['keys'] = res['keys']
+        result['table'] = res['table'] if top is None else res['table'][:int(top)]
+        result['match'] = res['table'][0]['name'] if len(res['table']) > 0 else None
+        result['timing'] = dict(timing)
+        result['counters'] = res['report'].counters
+        result['peak_rss_mb'] = utilities.instrument.peak_rss_mb()
+        result['elapsed'] = time.time() - t0
+        return result
+
+    def status(self):
+        st = {}
+        with self._lock:
+            st['catalogs'] = dict([(fn, len(cat)) for fn, (mtime, cat) in self.catalogs.items()])
+            st['satellites'] = len(self.sats)
+        st['jobs'] = self.jobs
+        if self.dcache is not None:
+            st['cache'] = {'hits':self.dcache.hits, 'misses':self.dcache.misses, 'path':self.dcache.path}
+        return st
+
+class match_handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def _reply(self, code, obj):
+        body = json.dumps(obj, indent=4)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/status':
+            self._reply(200, self.server.service.status())
+        else:
+            self._reply(404, {'error':'unknown path: {:s}'.format(self.path)})
+
+    def do_POST(self):
+        if self.path != '/match':
+            self._reply(404, {'error':'unknown path: {:s}'.format(self.path)})
+            return
+        try:
+            length = int(self.headers.getheader('content-length', 0))
+            job = json.loads(self.rfile.read(length))
+            result = self.server.service.match(job)
+        except (ValueError, IOError, KeyError) as e: #bad job
+            self._reply(400, {'error':str(e)})
+            return
+        except Exception as e: #anything else still gets a response, the server keeps running
+            log.exception('match job failed')
+            self._reply(500, {'error':'{:s}: {:s}'.format(type(e).__name__, str(e))})
+            return
+        self._reply(200, result)
+
+class match_server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    def __init__(self, addr, service):
+        BaseHTTPServer.HTTPServer.__init__(self, addr, match_handler)
+        self.service = service
+
+def main():
+    """ Main entry point """
+    startup_ts = dt.datetime.utcnow().strftime("%Y%m%d_%H%M%S")
+    cwd = os.getcwd()
+    #--------START Command Line argument parser------------------------------------------------------
+    parser = argparse.ArgumentParser(description="TLE Doppler Match Server",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    srv = parser.add_argument_group('Server Related Configurations')
+    srv.add_argument('--host',
+                        dest='host',
+                        type=str,
+                        default='127.0.0.1',
+                        help="Address to listen on",
+                        action="store")
+    srv.add_argument('--port',
+                        dest='port',
+                        type=int,
+                        default=8080,
+                        help="Port to listen on",
+                        action="store")
+    srv.add_argument('--poll',
+                        dest='poll',
+                        type=float,
+                        default=10.0,
+                        help="TLE folder poll interval [s], 0=no polling",
+                        action="store")
+
+    tle = parser.add_argument_group('TLE related configurations')
+    tle_fp_default = '/'.join([cwd, 'tle'])
+    tle.add_argument('--tle_file',
+                    dest='tle_file',
+                    type=str,
+                    default='pslv40_st.tle',
+                    help="Default TLE File of candidate satellites",
+                    action="store")
+    tle.add_argument('--tle_folder',
+                    dest='tle_folder',
+                    type=str,
+                    default=tle_fp_default,
+                    help="Watched folder containing TLE files",
+                    action="store")
+
+    meas = parser.add_argument_group('Measurement Related Configurations')
+    meas_fp_default = '/'.join([cwd, 'measurements'])
+    meas.add_argument('--meas_folder',
+                        dest='meas_folder',
+                        type=str,
+                        default=meas_fp_default,
+                        help="Default measurement file location",
+                        action="store")
+
+    gen = parser.add_argument_group('Generated Doppler Related Configurations')
+    gen.add_argument('--engine',
+                        dest='engine',
+                        type=str,
+                        default='batch',
+                        choices=['batch', 'interp', 'ephem'],
+                        help="Doppler engine, batch=vectorized SGP4, interp=Chebyshev ephemeris from coarse SGP4, \
+                              ephem=per sample pyephem reference",
+                        action="store")
+    gen.add_argument('--workers',
+                        dest='workers',
+                        type=int,
+                        default=1,
+                        help="Number of worker processes for candidate Doppler generation, 1=serial",
+                        action="store")
+    gen.add_argument('--cache_folder',
+                        dest='cache_folder',
+                        type=str,
+                        default='/'.join([cwd, 'cache']),
+                        help="Doppler cache location",
+                        action="store")
+    gen.add_argument('--cache_size',
+                        dest='cache_size',
+                        type=float,
+                        default=512.0,
+                        help="Doppler cache size limit [MB], least recently used curves are evicted",
+                        action="store")
+    gen.add_argument('--mem_size',
+                        dest='mem_size',
+                        type=float,
+                        default=256.0,
+                        help="Size limit of recent Doppler curves kept in memory [MB], 0=none",
+                        action="store")
+
+    parser.add_argument('--log_level',
+                        dest='log_level',
+                        type=str,
+                        default='info',
+                        choices=utilities.instrument.log_levels,
+                        help="Console detail, debug adds per job and per candidate detail",
+                        action="store")
+
+    args = parser.parse_args()
+    #--------END Command Line argument parser------------------------------------------------------
+    import warnings
+    warnings.filterwarnings('ignore')
+    utilities.instrument.setup_logging(args.log_level)
+
+    if not os.path.isdir(args.tle_folder):
+        print 'ERROR: invalid TLE folder: {:s}'.format(args.tle_folder)
+        sys.exit()
+
+    dcache = utilities.cache.doppler_cache(args.cache_folder, int(args.cache_size*1024*1024), \
+                                           int(args.mem_size*1024*1024))
+    service = match_service(args.tle_folder, args.tle_file, args.meas_folder, dcache, \
+                            args.engine, args.workers)
+    if args.poll > 0:
+        watcher = threading.Thread(target=service.watch, args=(args.poll,))
+        watcher.daemon = True
+        watcher.start()
+
+    server = match_server((args.host, args.port), service)
+    print 'TLE Match server listening on http://{:s}:{:d}'.format(args.host, args.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print 'Shutting down'
+    server.server_close()
+
+if __name__ == '__main__':
+    main()
@@ -8,31 +8,21 @@
 import os
 import sys
 import math
-import ephem
 import argparse
 import json
 import datetime as dt
 
-import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
 
-
-import utilities.satellite
-import utilities.plotting
-import utilities.poly
+import utilities.match
+import utilities.columnar
+import utilities.evidence
+import utilities.instrument
 #from utilities import *
 
 deg2rad = math.pi / 180
 rad2deg = 180 / math.pi
 
-def json_serial(obj):
-    """JSON serializer for objects not serializable by default json code"""
-
-    if isinstance(obj, dt.datetime):
-        return obj.__str__()
-    raise TypeError ("Type %s not serializable" % type(obj))
-
 def main():
     """ Main entry point """
     os.system('reset')
@@ -49,6 +39,84 @@ def main():
                         default='FOX-1D.json',
                         help="Polynomial Data JSON File",
                         action="store")
+    parser.add_argument('--rank_by',
+                        dest='rank_by',
+                        type=str,
+                        default='tca_delta',
+                        choices=['tca_delta', 'l1', 'l2', 'ncc', 'l2_fit', 'lag', 'xcorr'],
+                        help="Score used to rank candidates, tca_delta = original TCA only match",
+                        action="store")
+    parser.add_argument('--fit_bias',
+                        dest='fit_bias',
+                        type=int,
+                        default=0,
+                        help="Estimate a constant transmitter frequency bias per candidate, 0=N, 1=Y",
+                        action="store")
+    parser.add_argument('--fit_shift',
+                        dest='fit_shift',
+                        type=int,
+                        default=0,
+                        help="Also estimate a time shift per candidate (implies --fit_bias), 0=N, 1=Y. \
+                              Objects from one launch differ mostly by a time offset, so the shift \
+                              absorbs much of what separates them, use for timing error estimates",
+                        action="store")
+    parser.add_argument('--xcorr',
+                        dest='xcorr',
+                        type=int,
+                        default=0,
+                        help="FFT cross correlation time lag search per candidate, 0=N, 1=Y",
+                        action="store")
+    parser.add_argument('--max_lag',
+                        dest='max_lag',
+                        type=float,
+                        default=60.0,
+                        help="Cross correlation lag search range [s]",
+                        action="store")
+    parser.add_argument('--meas_data',
+                        dest='meas_data',
+                        type=str,
+                        default=None,
+                        help="Converted measurement (.dcol/.json/.csv), the cross correlation \
+                              uses its measured samples instead of the measurement fit",
+                        action="store")
+    parser.add_argument('--top',
+                        dest='top',
+                        type=int,
+                        default=None,
+                        help="Number of ranked candidates to print, default all",
+                        action="store")
+
+    evd = parser.add_argument_group('Multi Pass Related Configurations')
+    evd.add_argument('--state_file',
+                        dest='state_file',
+                        type=str,
+                        default=None,
+                        help="Multi pass evidence state (JSON), this pass is folded in, default none",
+                        action="store")
+    evd.add_argument('--sigma',
+                        dest='sigma',
+                        type=float,
+                        default=None,
+                        help="Score uncertainty for the evidence update, default per metric (tca_delta 1 s, l2 50 Hz)",
+                        action="store")
+    evd.add_argument('--confidence',
+                        dest='confidence',
+                        type=float,
+                        default=0.99,
+                        help="Posterior needed to declare the match",
+                        action="store")
+    evd.add_argument('--station',
+                        dest='station',
+                        type=str,
+                        default=None,
+                        help="Ground station of this pass, default from --meas_md",
+                        action="store")
+    evd.add_argument('--meas_md',
+                        dest='meas_md',
+                        type=str,
+                        default=None,
+                        help="Measurement metadata file (.md), ground station of this pass",
+                        action="store")
 
     plot = parser.add_argument_group('Plotting Related Configurations')
     fig_fp_default = '/'.join([cwd, 'figures'])
@@ -65,10 +133,19 @@ def main():
                         help="Save Figure Flag, 0=N, 1=Y",
                         action="store")
 
+    parser.add_argument('--log_level',
+                        dest='log_level',
+                        type=str,
+                        default='info',
+                        choices=utilities.instrument.log_levels,
+                        help="Console detail, debug adds per candidate detail",
+                        action="store")
+
     args = parser.parse_args()
     #--------END Command Line argument parser------------------------------------------------------
     import warnings
     warnings.filterwarnings('ignore')
+    utilities.instrument.setup_logging(args.log_level)
 
     #--Read in polynomial data
 
@@ -81,38 +158,61 @@ def main():
         poly_data = json.load(f)
 
 
-    reg_x = np.arange(0,5000)
+    ts_format = "%Y-%m-%d %H:%M:%S.%f"
     for idx, pd in enumerate(poly_data):
         #print pd['pf']['polynomial']
-        ts_format = "%Y-%m-%d %H:%M:%S.%f"
         pd['pf']['tca_utc'] = dt.datetime.strptime(pd['pf']['tca_utc'],ts_format)
-        reg_x = np.arange(0,pd['pf']['len_reg_x'])
-        pd['pf']['equation'] = np.polyval(pd['pf']['polynomial'], reg_x)
-        #print pd['pf']['equation']
-
+        if 'start_utc' in pd['pf']:
+            pd['pf']['start_utc'] = dt.datetime.strptime(pd['pf']['start_utc'],ts_format)
 
     print len(poly_data)
     meas_sat = poly_data.pop(0)
     print len(poly_data)
     print meas_sat['name']
-    for idx, pd in enumerate(poly_data):
-        tca_delta = (meas_sat['pf']['tca_utc']-pd['pf']['tca_utc']).total_seconds()
-        pd['tca_delta'] = tca_delta
-        print pd['tca_delta']
-        #fig_idx = utilities.plotting.plot_2poly_ts(0, reg_x, \
-        #                                        meas_sat, \
-        #                                        pd, \
-        #                                        args.fig_path,0)
-
-    tle_match = None
-    last_delta = 1e6
-    for idx, pd in enumerate(poly_data):
-        if abs(pd['tca_delta']) < last_delta:
-            last_delta = abs(pd['tca_delta'])
-            tle_match = pd
-    print tle_match['tca_delta']
+    meas_df = None
+    if args.meas_data:
+        if not os.path.isfile(args.meas_data) == True:
+            print 'ERROR: invalid Measurement Data file: {:s}'.format(args.meas_data)
+            sys.exit()
+        meas_df = utilities.columnar.read_doppler(args.meas_data)
+    #--TCA delta and full curve scores over the measured time span, all candidates at once
+    table, keys, rank_by = utilities.match.match_poly_data(meas_sat, poly_data, args.rank_by, \
+                                                           args.fit_bias, args.fit_shift, \
+                                                           args.xcorr, args.max_lag, meas_df)
+    print 'Candidates ranked by: {:s}'.format(rank_by)
+    utilities.match.print_rank_table(table, keys, args.top)
+
+    tle_match = table[0]
     print 'Matching Satellite for {:s} is: {:s}'.format(meas_sat['name'], tle_match['name'])
     print 'TCA Delta of matching satellite [s]: {:3.3f}'.format(tle_match['tca_delta'])
+    if 'bias' in tle_match:
+        print 'Estimated transmitter bias of matching satellite [Hz]: {:3.3f}'.format(tle_match['bias'])
+    if 'lag' in tle_match:
+        print 'Cross correlation lag of matching satellite [s]: {:3.3f}'.format(tle_match['lag'])
+    if 'shift' in tle_match:
+        print 'Estimated time shift of matching satellite [s]: {:3.3f}'.format(tle_match['shift'])
+
+    #--Fold this pass into the multi pass evidence
+    if args.state_file:
+        station = args.station
+        if station is None and args.meas_md:
+            with open(args.meas_md, 'r') as f:
+                station = utilities.evidence.station_label(json.load(f))
+        if 'start_utc' not in meas_sat['pf']:
+            print 'ERROR: polynomial data has no start_utc, re-run doppler_polynomial.py for --state_file'
+            sys.exit()
+        state = utilities.evidence.match_state(args.state_file)
+        pass_id = utilities.evidence.pass_key(meas_sat['name'], meas_sat['pf']['start_utc'], \
+                                              meas_sat['pf']['len'], station)
+        try:
+            folded = state.update(table, rank_by, pass_id, station, args.sigma, meas_sat['name'])
+        except ValueError as e:
+            print 'ERROR: {:s}'.format(str(e))
+            sys.exit()
+        if not folded:
+            print 'Pass already in state file, not folded again: {:s}'.format(pass_id)
+        state.save()
+        utilities.evidence.print_summary(state, args.confidence, args.top)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,423 @@
+#!/usr/bin/env python
+#################################################
+#   Title: TLE Match Pipeline
+# Project: TLE Match
+#    Date: Jan 2018
+#  Author: Zach Leffke, KJ4QLP
+#    Desc:
+#       Runs convert, generate, polynomial fit and match in one process,
+#       GNU Radio .f32 recording in, ranked candidate table out.
+#       Intermediate files are only written with --out_folder.
+#################################################
+import os
+import sys
+import math
+import argparse
+import datetime as dt
+
+import utilities.catalog
+import utilities.cache
+import utilities.match
+import utilities.pipeline
+import utilities.evidence
+import utilities.orbit_fit
+import utilities.instrument
+
+deg2rad = math.pi / 180
+rad2deg = 180 / math.pi
+
+def main():
+    """ Main entry point """
+    startup_ts = dt.datetime.utcnow().strftime("%Y%m%d_%H%M%S")
+    cwd = os.getcwd()
+    #--------START Command Line argument parser------------------------------------------------------
+    parser = argparse.ArgumentParser(description="TLE Doppler Match, single process pipeline",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    meas = parser.add_argument_group('Measurement Related Configurations')
+    meas_fp_default = '/'.join([cwd, 'measurements'])
+    meas.add_argument('--meas_file',
+                        dest='meas_file',
+                        type=str,
+                        default='FOX-1D_USRP_20180113_161106.862011_UTC_10sps.f32',
+                        help="Doppler offset measurement file from GNU Radio",
+                        action="store")
+    meas.add_argument('--meas_folder',
+                        dest='meas_folder',
+                        type=str,
+                        default=meas_fp_default,
+                        help="Doppler offset measurement file location",
+                        action="store")
+    meas.add_argument('--rx_center_freq',
+                        dest='rx_center_freq',
+                        type=float,
+                        default=145.880e6,
+                        help="Receiver Center Frequency [Hz]",
+                        action="store")
+    meas.add_argument('--start',
+                        dest='start',
+                        type=int,
+                        default=550,
+                        help="Start Sample Offset from meas_file start for start of valid data",
+                        action="store")
+    meas.add_argument('--stop',
+                        dest='stop',
+                        type=int,
+                        default=1450,
+                        help="Stop Sample Offset from meas_file end for valid data",
+                        action="store")
+    meas.add_argument('--auto_trim',
+                        dest='auto_trim',
+                        type=int,
+                        default=0,
+                        help="Find the valid lock span automatically inside --start/--stop, 0=N, 1=Y",
+                        action="store")
+    meas.add_argument('--trim_window',
+                        dest='trim_window',
+                        type=float,
+                        default=3.0,
+                        help="Auto trim rolling window length [s]",
+                        action="store")
+    meas.add_argument('--trim_k',
+                        dest='trim_k',
+                        type=float,
+                        default=4.0,
+                        help="Auto trim threshold, multiple of the rolling std noise floor",
+                        action="store")
+
+    gs = parser.add_argument_group('Ground Station Related Configurations')
+    gs.add_argument('--gs_lat',
+                        dest='gs_lat',
+                        type=float,
+                        default=37.229976,
+                        help="Ground Station Latitude [deg], N=+, S=-",
+                        action="store")
+    gs.add_argument('--gs_lon',
+                        dest='gs_lon',
+                        type=float,
+                        default=-80.439627,
+                        help="Ground Station Longitude [deg], E=+, W=-",
+                        action="store")
+    gs.add_argument('--gs_alt',
+                        dest='gs_alt',
+                        type=float,
+                        default=610,
+                        help="Ground Station Altitude [m]",
+                        action="store")
+
+    tle = parser.add_argument_group('TLE related configurations')
+    tle_fp_default = '/'.join([cwd, 'tle'])
+    tle.add_argument('--tle_file',
+                    dest='tle_file',
+                    type=str,
+                    default='pslv40_st.tle',
+                    help="TLE File of candidate satellites",
+                    action="store")
+    tle.add_argument('--tle_folder',
+                    dest='tle_folder',
+                    type=str,
+                    default=tle_fp_default,
+                    help="Folder containing TLE file",
+                    action="store")
+    tle.add_argument('--norad',
+                    dest='norad',
+                    type=str,
+                    default=None,
+                    help="Comma separated NORAD IDs to use as candidates, default all",
+                    action="store")
+    tle.add_argument('--intl_des',
+                    dest='intl_des',
+                    type=str,
+                    default=None,
+                    help="International designator prefix of candidates, ex: 2018-004",
+                    action="store")
+
+    gen = parser.add_argument_group('Generated Doppler Related Configurations')
+    gen.add_argument('--engine',
+                        dest='engine',
+                        type=str,
+                        default='batch',
+                        choices=['batch', 'interp', 'ephem'],
+                        help="Doppler engine, batch=vectorized SGP4, interp=Chebyshev ephemeris from coarse SGP4, \
+                              ephem=per sample pyephem reference",
+                        action="store")
+    gen.add_argument('--workers',
+                        dest='workers',
+                        type=int,
+                        default=1,
+                        help="Number of worker processes for candidate Doppler generation, 1=serial",
+                        action="store")
+    gen.add_argument('--el_mask',
+                        dest='el_mask',
+                        type=float,
+                        default=0.0,
+                        help="Elevation mask [deg], candidates never above it during the measurement are skipped",
+                        action="store")
+    gen.add_argument('--screen_step',
+                        dest='screen_step',
+                        type=float,
+                        default=30.0,
+                        help="Time step of the coarse visibility screen [s], 0=no screening",
+                        action="store")
+    gen.add_argument('--cache',
+                        dest='cache',
+                        type=int,
+                        default=1,
+                        help="Reuse previously generated Doppler curves, 0=N, 1=Y",
+                        action="store")
+    gen.add_argument('--cache_folder',
+                        dest='cache_folder',
+                        type=str,
+                        default='/'.join([cwd, 'cache']),
+                        help="Doppler cache location",
+                        action="store")
+    gen.add_argument('--cache_size',
+                        dest='cache_size',
+                        type=float,
+                        default=512.0,
+                        help="Doppler cache size limit [MB], least recently used curves are evicted",
+                        action="store")
+
+    mat = parser.add_argument_group('Matching Related Configurations')
+    mat.add_argument('--interp',
+                        dest='interp',
+                        type=int,
+                        default=1,
+                        help="Polynomial regression interpolation factor",
+                        action="store")
+    mat.add_argument('--degree',
+                        dest='degree',
+                        type=int,
+                        default=3,
+                        help="Regression polynomial degree, 0=pick per curve by --criterion",
+                        action="store")
+    mat.add_argument('--criterion',
+                        dest='criterion',
+                        type=str,
+                        default='bic',
+                        choices=['aic', 'bic'],
+                        help="Information criterion for --degree 0",
+                        action="store")
+    mat.add_argument('--robust',
+                        dest='robust',
+                        type=str,
+                        default=None,
+                        choices=['huber', 'bisquare'],
+                        help="Outlier resistant fit of the measurement, default plain least squares",
+                        action="store")
+    mat.add_argument('--rank_by',
+                        dest='rank_by',
+                        type=str,
+                        default='tca_delta',
+                        choices=['tca_delta', 'l1', 'l2', 'ncc'],
+                        help="Score used to rank candidates, tca_delta = original TCA only match",
+                        action="store")
+    mat.add_argument('--top',
+                        dest='top',
+                        type=int,
+                        default=None,
+                        help="Number of ranked candidates to print, default all",
+                        action="store")
+    mat.add_argument('--state_file',
+                        dest='state_file',
+                        type=str,
+                        default=None,
+                        help="Multi pass evidence state (JSON), this pass is folded in, default none",
+                        action="store")
+    mat.add_argument('--sigma',
+                        dest='sigma',
+                        type=float,
+                        default=None,
+                        help="Score uncertainty for the evidence update, default per metric (tca_delta 1 s, l2 50 Hz)",
+                        action="store")
+    mat.add_argument('--confidence',
+                        dest='confidence',
+                        type=float,
+                        default=0.99,
+                        help="Posterior needed to declare the match",
+                        action="store")
+    mat.add_argument('--refine',
+                        dest='refine',
+                        type=int,
+                        default=0,
+                        help="Refine the best candidate's TLE against the measured Doppler, 0=N, 1=Y",
+                        action="store")
+    mat.add_argument('--refine_params',
+                        dest='refine_params',
+                        type=str,
+                        default='mo,bstar',
+                        help="Comma separated elements to adjust: mo, bstar, no_kozai, nodeo, inclo, argpo, ecco",
+                        action="store")
+    mat.add_argument('--refine_drift',
+                        dest='refine_drift',
+                        type=int,
+                        default=1,
+                        help="Also fit a linear transmitter frequency drift, 0=N, 1=Y",
+                        action="store")
+    mat.add_argument('--refine_out',
+                        dest='refine_out',
+                        type=str,
+                        default=None,
+                        help="Write the refined TLE to this file, default print only",
+                        action="store")
+    mat.add_argument('--out_folder',
+                        dest='out_folder',
+                        type=str,
+                        default=None,
+                        help="Write intermediate files (measurement, generated, polynomial JSON) here, default none",
+                        action="store")
+
+    plot = parser.add_argument_group('Plotting Related Configurations')
+    plot.add_argument('--fig_report',
+                        dest='fig_report',
+                        type=str,
+                        default=None,
+                        help="Render a comparison figure per ranked candidate into this folder, default none",
+                        action="store")
+    plot.add_argument('--fig_workers',
+                        dest='fig_workers',
+                        type=int,
+                        default=1,
+                        help="Number of worker processes for figure rendering, 1=serial",
+                        action="store")
+    plot.add_argument('--fig_points',
+                        dest='fig_points',
+                        type=int,
+                        default=2000,
+                        help="Downsample plotted series longer than this (min/max per bucket), 0=never",
+                        action="store")
+
+    ins = parser.add_argument_group('Instrumentation Related Configurations')
+    ins.add_argument('--log_level',
+                        dest='log_level',
+                        type=str,
+                        default='info',
+                        choices=utilities.instrument.log_levels,
+                        help="Console detail, debug adds per candidate fit output",
+                        action="store")
+    ins.add_argument('--report',
+                        dest='report',
+                        type=str,
+                        default=None,
+                        help="Write a JSON run report (stage spans, counters, peak memory) to this file",
+                        action="store")
+    ins.add_argument('--profile',
+                        dest='profile',
+                        type=str,
+                        default=None,
+                        choices=utilities.instrument.profilers,
+                        help="Profile the run, default none",
+                        action="store")
+    ins.add_argument('--profile_out',
+                        dest='profile_out',
+                        type=str,
+                        default=None,
+                        help="Profile output file (pstats for cprofile, text for pyinstrument), default log the top functions",
+                        action="store")
+
+    args = parser.parse_args()
+    #--------END Command Line argument parser------------------------------------------------------
+    import warnings
+    warnings.filterwarnings('ignore')
+    utilities.instrument.setup_logging(args.log_level)
+    report = utilities.instrument.run_report('tle_pipeline')
+
+    try:
+        cat = utilities.catalog.tle_catalog_input(args.tle_folder, args.tle_file)
+    except IOError as e:
+        print 'ERROR: {:s}'.format(str(e))
+        sys.exit()
+
+    dcache = None
+    if args.cache:
+        dcache = utilities.cache.doppler_cache(args.cache_folder, int(args.cache_size*1024*1024))
+
+    gs = {'gs_lat':args.gs_lat, 'gs_lon':args.gs_lon, 'gs_alt':args.gs_alt}
+    norad_ids = args.norad.split(',') if args.norad else None
+    refine_params = None
+    if args.refine:
+        refine_params = args.refine_params.split(',')
+        for p in refine_params:
+            if p not in utilities.orbit_fit.param_step:
+                print 'ERROR: unknown refinement element: {:s}'.format(p)
+                sys.exit()
+    try:
+        with utilities.instrument.profile(args.profile, args.profile_out):
+            res = utilities.pipeline.run(args.meas_folder, args.meas_file, args.rx_center_freq, gs, cat, \
+                                         args.start, args.stop, norad_ids, args.intl_des, args.engine, \
+                                         args.workers, args.el_mask, args.screen_step, dcache, \
+                                         args.interp, args.rank_by, args.out_folder, \
+                                         degree=args.degree, criterion=args.criterion, robust=args.robust, \
+                                         auto_trim=args.auto_trim, refine_params=refine_params, \
+                                         refine_drift=args.refine_drift, report=report, \
+                                         trim_window=args.trim_window, trim_k=args.trim_k)
+    except (IOError, ValueError, ImportError) as e:
+        print 'ERROR: {:s}'.format(str(e))
+        sys.exit()
+
+    if args.auto_trim:
+        print 'Auto trim bounds: --start {:d} --stop {:d}'.format(res['md']['trim_start'], res['md']['trim_stop'])
+    print 'Candidates ranked by: {:s}'.format(res['rank_by'])
+    utilities.match.print_rank_table(res['table'], res['keys'], args.top)
+    if len(res['table']) > 0:
+        tle_match = res['table'][0]
+        print 'Matching Satellite for {:s} is: {:s}'.format(res['md']['sat_name'], tle_match['name'])
+        print 'TCA Delta of matching satellite [s]: {:3.3f}'.format(tle_match['tca_delta'])
+    if 'refined' in res and 'error' in res['refined']:
+        print 'WARNING: TLE refinement of {:s} failed: {:s}'.format(res['refined']['name'], res['refined']['error'])
+    elif 'refined' in res:
+        ref = res['refined']
+        print 'Refined TLE of {:s}, {:d} iterations:'.format(ref['name'], ref['iterations'])
+        for k in sorted(ref['delta'].keys()):
+            print '  {:>10s}: {:+.6g} +/- {:.2g} {:s}'.format(k, ref['delta'][k], ref['sigma'][k], ref['units'][k])
+        print '  Residual RMS after bias/drift [Hz], input TLE: {:3.3f}, refined: {:3.3f}, emitted TLE: {:3.3f}, noise: {:3.3f}'.format( \
+                ref['rms_before'], ref['rms_after'], ref['rms_tle'], ref['noise'])
+        print ref['sat_name']
+        print ref['line1']
+        print ref['line2']
+        if args.refine_out:
+            with open(args.refine_out, 'w') as f:
+                f.write('\n'.join([ref['sat_name'], ref['line1'], ref['line2']]) + '\n')
+            print 'Refined TLE written to: {:s}'.format(args.refine_out)
+    if args.state_file and len(res['table']) > 0:
+        station = utilities.evidence.station_label(res['md'])
+        state = utilities.evidence.match_state(args.state_file)
+        meas_pf = res['poly_data'][0]['pf']
+        pass_id = utilities.evidence.pass_key(res['md']['sat_name'], meas_pf['start_utc'], meas_pf['len'], station)
+        try:
+            folded = state.update(res['table'], res['rank_by'], pass_id, station, args.sigma, \
+                                  res['md']['sat_name'])
+        except ValueError as e:
+            print 'ERROR: {:s}'.format(str(e))
+            sys.exit()
+        if not folded:
+            print 'Pass already in state file, not folded again: {:s}'.format(pass_id)
+        state.save()
+        utilities.evidence.print_summary(state, args.confidence, args.top)
+    if args.fig_report is not None:
+        from utilities import plotting #matplotlib only loaded when figures are wanted
+        with report.span('figures', candidates=len(res['table'])):
+            paths = plotting.render_report(res['measurement'], res['dopplers'], res['table'], \
+                                           args.fig_report, args.fig_workers, args.fig_points, args.top)
+        print 'Rendered {:d} figures to: {:s}'.format(len(paths), args.fig_report)
+    print 'Stage timing [s]:'
+    for stage, elapsed in report.timing():
+        print '  {:>10s}: {:3.3f}'.format(stage, elapsed)
+    print 'Peak RSS [MB]: {:3.1f}'.format(utilities.instrument.peak_rss_mb())
+    if dcache is not None:
+        print 'Doppler cache: {:d} hit(s), {:d} miss(es)'.format(dcache.hits, dcache.misses)
+        report.info['cache'] = {'hits':dcache.hits, 'misses':dcache.misses}
+    if args.report:
+        report.info['sat_name'] = res['md']['sat_name']
+        report.info['rank_by'] = res['rank_by']
+        report.info['ranked'] = len(res['table'])
+        if len(res['table']) > 0:
+            report.info['match'] = res['table'][0]['name']
+            report.info['tca_delta'] = res['table'][0]['tca_delta']
+        if 'refined' in res and 'error' not in res['refined']:
+            report.info['refined_rms'] = res['refined']['rms_after']
+        report.save(args.report)
+        print 'Run report written to: {:s}'.format(args.report)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+#############################################
+#   Title: Generated Doppler curve cache    #
+# Project: TLE Match                        #
+#    Date: Jan 2018                         #
+#  Author: Zach Leffke, KJ4QLP              #
+#############################################
+#   Content addressed on-disk cache of generated Doppler curves.  The key
+#   is a hash of everything the curve depends on (TLE lines, ground station,
+#   downlink frequency, time grid, engine), entries are .dcol files named by
+#   key.  Least recently used entries are evicted once the cache grows past
+#   its size limit, file mtime is the 'last used' time.  Long running
+#   processes can also keep the most recent curves in memory (mem_bytes).
+import os
+import time
+import hashlib
+import threading
+import collections
+import numpy as np
+
+from . import columnar
+
+class doppler_cache(object):
+    low_water = 0.9 #fraction of max_bytes left after a put triggered eviction
+
+    def __init__(self, path, max_bytes=512*1024*1024, mem_bytes=0):
+        #path      : cache folder, created if needed
+        #max_bytes : size limit of cache folder [bytes]
+        #mem_bytes : size limit of recent curves also kept in memory [bytes], 0=none
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.mem_bytes = mem_bytes
+        self._mem = collections.OrderedDict() #key: (df, size)
+        self._mem_size = 0 #[bytes]
+        self._lock = threading.Lock()
+        self._size = 0 #folder size estimate [bytes], rescanned by evict
+        if not os.path.isdir(path): os.makedirs(path)
+        self.evict() #limit may have been lowered since last run
+
+    def key(self, line1, line2, gs_lat, gs_lon, gs_alt, rx_freq, timestamp, engine='batch'):
+        #input:
+        #   line1, line2   : TLE lines
+        #   gs_lat, gs_lon : ground station [deg], gs_alt [m], as in the .md file
+        #   rx_freq        : downlink center frequency [Hz]
+        #   timestamp      : numpy datetime64 time grid of the curve
+        #   engine         : Doppler engine, batch and ephem differ slightly
+        #output: hex digest
+        ns = np.asarray(timestamp).astype('datetime64[ns]').astype(np.int64)
+        fields = [line1.strip(), line2.strip(), repr(float(gs_lat)), repr(float(gs_lon)), \
+                  repr(float(gs_alt)), repr(float(rx_freq)), engine, str(len(ns))]
+        if len(ns) > 0:
+            fields.append(str(ns[0]))
+            step = np.diff(ns)
+            if len(step) > 0 and np.all(step == step[0]): #uniform grid: start, spacing, length
+                fields.append(str(step[0]))
+            else: #irregular grid, ex: burst measurements, hash the time stamps
+                fields.append(hashlib.sha1(ns.tobytes()).hexdigest())
+        return hashlib.sha1('|'.join(fields)).hexdigest()
+
+    def _path(self, key):
+        return '/'.join([self.path, key]) + columnar.ext
+
+    def get(self, key):
+        #output: cached dataframe or None
+        with self._lock:
+            if key in self._mem:
+                entry = self._mem.pop(key)
+                self._mem[key] = entry #most recent last
+                self.hits += 1
+                return entry[0]
+        fp = self._path(key)
+        if not os.path.isfile(fp):
+            self.misses += 1
+            return None
+        try:
+            df = columnar.read_columnar(fp)
+        except (ValueError, IOError): #truncated or foreign file, drop it
+            os.remove(fp)
+            self.misses += 1
+            return None
+        now = time.time()
+        os.utime(fp, (now, now)) #mark as recently used
+        self.hits += 1
+        self._remember(key, df)
+        return df
+
+    def _remember(self, key, df):
+        if self.mem_bytes <= 0: return
+        size = int(df.memory_usage(index=True).sum())
+        if size > self.mem_bytes: return #would evict everything else
+        with self._lock:
+            old = self._mem.pop(key, None)
+            if old is not None: self._mem_size -= old[1]
+            self._mem[key] = (df, size)
+            self._mem_size += size
+            while self._mem_size > self.mem_bytes:
+                self._mem_size -= self._mem.popitem(last=False)[1][1]
+
+    def put(self, key, df):
+        #write to temp file and rename, so a crash never leaves a partial entry
+        #   the folder is only rescanned (evict) once the running size estimate
+        #   passes the limit, not on every put, and then trimmed to low_water
+        #   of the limit so the next rescan is some puts away
+        fp = self._path(key)
+        tmp = fp + '.tmp{:d}_{:d}'.format(os.getpid(), threading.current_thread().ident)
+        columnar.write_columnar(tmp, df)
+        size = os.path.getsize(tmp)
+        old = os.path.getsize(fp) if os.path.isfile(fp) else 0
+        os.rename(tmp, fp)
+        self._remember(key, df)
+        with self._lock:
+            self._size += size - old
+            full = self._size > self.max_bytes
+        if full: self.evict(int(self.max_bytes * self.low_water))
+
+    def evict(self, target=None):
+        #remove least recently used entries until cache fits in target [bytes],
+        #default max_bytes
+        #output: number of entries removed
+        if target is None: target = self.max_bytes
+        entries = []
+        for fn in os.listdir(self.path):
+            if not fn.endswith(columnar.ext): continue
+            fp = '/'.join([self.path, fn])
+            st = os.stat(fp)
+            entries.append((st.st_mtime, st.st_size, fp))
+        total = sum([e[1] for e in entries])
+        removed = 0
+        for mtime, size, fp in sorted(entries):
+            if total <= target: break
+            os.remove(fp)
+            total -= size
+            removed += 1
+        with self._lock:
+            self._size = total
+        return removed
@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+#############################################
+#   Title: TLE catalog utilities            #
+# Project: TLE Match                        #
+#    Date: Jan 2018                         #
+#  Author: Zach Leffke, KJ4QLP              #
+#############################################
+#   In memory TLE catalog for files from a single launch up to full
+#   space-track catalogs.  Handles 2 line and 3 line (optionally '0 ' name
+#   prefixed) files, validates checksums and indexes entries by NORAD ID,
+#   international designator and epoch.
+import os
+import bisect
+import numpy as np
+
+from . import propagator
+
+def tle_checksums(lines):
+    #vectorized version of propagator.tle_checksum for a list of lines
+    #output: (M,) int array of computed checksums
+    if len(lines) == 0: return np.zeros(0, dtype=int)
+    raw = np.array([l[:68].ljust(68) for l in lines], dtype='S68')
+    b = raw.view(np.uint8).reshape(len(lines), 68)
+    digit = (b >= ord('0')) & (b <= ord('9'))
+    val = np.where(digit, b.astype(int) - ord('0'), 0) + (b == ord('-'))
+    return np.sum(val, axis=1) % 10
+
+def tle_epochs(lines):
+    #vectorized propagator.tle_epoch for a list of line 1s
+    #output: (M,) datetime64[ns] array, NaT where the epoch doesn't parse
+    try:
+        year = np.array([l[18:20] for l in lines]).astype(int)
+        days = np.array([l[20:32] for l in lines]).astype(float)
+    except ValueError: #at least one bad line, do them one at a time
+        epochs = np.empty(len(lines), dtype='datetime64[ns]')
+        for i, l in enumerate(lines):
+            try: epochs[i] = propagator.tle_epoch(l)
+            except ValueError: epochs[i] = np.datetime64('NaT')
+        return epochs
+    year = np.where(year < 57, year + 2000, year + 1900)
+    start = (year - 1970).astype('datetime64[Y]').astype('datetime64[ns]')
+    return start + np.round((days - 1.0) * 86400e9).astype(np.int64).astype('timedelta64[ns]')
+
+def intl_designator(line1):
+    #'18004A  ' -> '2018-004A'
+    field = line1[9:17].strip()
+    if len(field) < 5 or not field[:5].isdigit(): return field
+    year = int(field[:2])
+    year += 2000 if year < 57 else 1900
+    return '{:04d}-{:s}'.format(year, field[2:])
+
+class tle_catalog(object):
+    def __init__(self):
+        self.entries = []   #list of dicts: name, line1, line2, norad_id, intl_des, epoch
+        self.errors = []    #list of (source, line number, message) for skipped entries
+        self._indexed = False
+
+    def __len__(self):
+        return len(self.entries)
+
+    def load(self, path, strict=False):
+        #desc:  parse TLE file and add entries to catalog
+        #input:
+        #   path   : full path to TLE file
+        #   strict : raise ValueError on first bad entry instead of skipping
+        #output: number of entries added
+        with open(path, 'r') as f: text = f.read()
+        return self.loads(text, source=path, strict=strict)
+
+    def loads(self, text, source='', strict=False):
+        #same as load, TLE data passed as string
+        lines = [l.rstrip() for l in text.splitlines()]
+        lines = [(i+1, l) for i, l in enumerate(lines) if l.strip() != '']
+
+        #--group lines into (name, line1, line2, line number)
+        groups = []
+        i = 0
+        while i < len(lines):
+            lno, l = lines[i]
+            if l.startswith('1 ') and i+1 < len(lines) and lines[i+1][1].startswith('2 '):
+                groups.append((None, l, lines[i+1][1], lno))
+                i += 2
+            elif (not l.startswith('1 ')) and (not l.startswith('2 ')) and i+2 < len(lines) and \
+                 lines[i+1][1].startswith('1 ') and lines[i+2][1].startswith('2 '):
+                name = l[2:] if l.startswith('0 ') else l
+                groups.append((name.strip(), lines[i+1][1], lines[i+2][1], lno))
+                i += 3
+            else:
+                self._error(source, lno, 'unexpected line: {:s}'.format(l), strict)
+                i += 1
+
+        #--checksums, all lines at once
+        l1 = [g[1] for g in groups]
+        l2 = [g[2] for g in groups]
+        ck1 = tle_checksums(l1)
+        ck2 = tle_checksums(l2)
+
+        epochs = tle_epochs(l1)
+
+        added = 0
+        for k, (name, line1, line2, lno) in enumerate(groups):
+            if len(line1) < 69 or len(line2) < 69:
+                self._error(source, lno, 'short TLE line', strict)
+                continue
+            if not (line1[68].isdigit() and int(line1[68]) == ck1[k]) or \
+               not (line2[68].isdigit() and int(line2[68]) == ck2[k]):
+                self._error(source, lno, 'checksum mismatch', strict)
+                continue
+            if line1[2:7] != line2[2:7]:
+                self._error(source, lno, 'NORAD ID mismatch between lines', strict)
+                continue
+            epoch = epochs[k]
+            if np.isnat(epoch):
+                self._error(source, lno, 'invalid epoch', strict)
+                continue
+            entry = {}
+            entry['norad_id'] = line1[2:7].strip()
+            entry['name'] = name if name else entry['norad_id']
+            entry['line1'] = line1[:69]
+            entry['line2'] = line2[:69]
+            entry['intl_des'] = intl_designator(line1)
+            entry['epoch'] = epoch
+            self.entries.append(entry)
+            added += 1
+        self._indexed = False
+        return added
+
+    def _error(self, source, lno, msg, strict):
+        if strict:
+            raise ValueError('{:s}:{:d}: {:s}'.format(source, lno, msg))
+        self.errors.append((source, lno, msg))
+
+    def _reindex(self):
+        #build lookup indexes, done lazily after loading
+        self._norad = {}
+        for idx, e in enumerate(self.entries):
+            self._norad.setdefault(e['norad_id'].zfill(5), []).append(idx)
+        epochs = np.array([e['epoch'].astype(np.int64) for e in self.entries], dtype=np.int64)
+        for k in self._norad.keys(): #oldest to newest per object
+            self._norad[k].sort(key=lambda i: epochs[i])
+        self._intl = sorted([(e['intl_des'], idx) for idx, e in enumerate(self.entries)])
+        self._intl_keys = [k for k, idx in self._intl]
+        self._epoch_order = np.argsort(epochs, kind='mergesort')
+        self._epochs_sorted = epochs[self._epoch_order]
+        self._indexed = True
+
+    def get(self, norad_id, epoch=None):
+        #desc:  entry for NORAD ID, newest one or newest at/before epoch
+        #output: entry dict or None
+        if not self._indexed: self._reindex()
+        idxs = self._norad.get(str(norad_id).strip().zfill(5), [])
+        if epoch is not None:
+            ep = np.datetime64(epoch, 'ns')
+            idxs = [i for i in idxs if self.entries[i]['epoch'] <= ep]
+        if len(idxs) == 0: return None
+        return self.entries[idxs[-1]]
+
+    def select(self, norad_ids=None, intl_des=None, epoch_start=None, epoch_stop=None, latest=True):
+        #desc:  candidate subset from the indexes, no rescan of the file
+        #input:
+        #   norad_ids   : list of NORAD IDs
+        #   intl_des    : international designator prefix, ex: '2018-004'
+        #   epoch_start : datetime64 / datetime, entries with epoch >= start
+        #   epoch_stop  : datetime64 / datetime, entries with epoch <= stop
+        #   latest      : keep only the newest matching entry per object
+        #output: list of entry dicts, ordered by name
+        if not self._indexed: self._reindex()
+        sel = None
+        if norad_ids is not None:
+            idxs = set()
+            for n in norad_ids:
+                idxs.update(self._norad.get(str(n).strip().zfill(5), []))
+            sel = idxs
+        if intl_des is not None:
+            lo = bisect.bisect_left(self._intl_keys, intl_des)
+            hi = bisect.bisect_left(self._intl_keys, intl_des + '\xff')
+            idxs = set([idx for k, idx in self._intl[lo:hi]])
+            sel = idxs if sel is None else sel & idxs
+        if epoch_start is not None or epoch_stop is not None:
+            lo, hi = 0, len(self._epochs_sorted)
+            if epoch_start is not None:
+                lo = np.searchsorted(self._epochs_sorted, np.datetime64(epoch_start, 'ns').astype(np.int64), 'left')
+            if epoch_stop is not None:
+                hi = np.searchsorted(self._epochs_sorted, np.datetime64(epoch_stop, 'ns').astype(np.int64), 'right')
+            idxs = set(self._epoch_order[lo:hi].tolist())
+            sel = idxs if sel is None else sel & idxs
+        if sel is None: sel = set(range(len(self.entries)))
+        entries = [self.entries[i] for i in sel]
+        if latest:
+            newest = {}
+            for e in entries:
+                if e['norad_id'] not in newest or e['epoch'] > newest[e['norad_id']]['epoch']:
+                    newest[e['norad_id']] = e
+            entries = newest.values()
+        return sorted(entries, key=lambda e: (e['name'], e['epoch']))
+
+def tle_catalog_input(fp, fn, strict=False):
+    #input:
+    #   fp : path to tle file
+    #   fn : tle file name
+    #output: tle_catalog object, prints summary like tle_file_input
+    path = '/'.join([fp,fn])
+    print 'Importing TLE data from: {:s}'.format(path)
+    if not os.path.isfile(path):
+        raise IOError('Invalid TLE source file: ' + path)
+    cat = tle_catalog()
+    cat.load(path, strict)
+    print "Found {:d} satellites".format(len(cat))
+    if len(cat.errors) > 0:
+        print "WARNING: skipped {:d} invalid TLE entries".format(len(cat.errors))
+        for src, lno, msg in cat.errors[:10]:
+            print "    line {:d}: {:s}".format(lno, msg)
+    return cat
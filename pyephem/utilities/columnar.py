@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+#############################################
+#   Title: Columnar Doppler file utilities  #
+# Project: TLE Match                        #
+#    Date: Jan 2018                         #
+#  Author: Zach Leffke, KJ4QLP              #
+#############################################
+#   Compact binary container for Doppler series (.dcol):
+#       8 bytes : magic 'DOPCOL01'
+#       4 bytes : little endian uint32, header length
+#       header  : JSON, name, length, column names, dtypes and byte offsets
+#       columns : raw little endian arrays, one after another, 8 byte aligned
+#   Timestamps are stored as int64 nanoseconds since unix epoch, so reading
+#   is a memory map instead of a parse.
+import os
+import json
+import struct
+import numpy as np
+
+magic = 'DOPCOL01'
+ext = '.dcol'
+
+def _header_bytes(name, length, columns, attrs):
+    #columns: list of (name, dtype string) tuples
+    #returns the padded header and the byte offset of each column
+    hdr = {}
+    hdr['name'] = name
+    hdr['length'] = int(length)
+    hdr['attrs'] = attrs if attrs else {}
+    hdr['columns'] = [{'name':cn, 'dtype':dtype} for cn, dtype in columns]
+    #offsets depend on header size, iterate until header size settles
+    hdr_len = 0
+    while True:
+        data_start = 12 + hdr_len
+        data_start += (-data_start) % 8
+        offset = data_start
+        for col in hdr['columns']:
+            col['offset'] = offset
+            offset += np.dtype(str(col['dtype'])).itemsize * hdr['length']
+            offset += (-offset) % 8
+        hdr_str = json.dumps(hdr, sort_keys=True)
+        if len(hdr_str) <= hdr_len: break
+        hdr_len = len(hdr_str)
+    hdr_str = hdr_str.ljust(hdr_len) + ' ' * ((-(12 + hdr_len)) % 8)
+    return hdr_str, hdr['columns']
+
+def _column_dtype(values):
+    values = np.asarray(values)
+    if values.dtype.kind == 'M': return '<M8[ns]'
+    if values.dtype.kind in 'iu': return '<i8'
+    return '<f8'
+
+class columnar_writer(object):
+    #Pre-sized writer, lets a stream be written block by block without
+    #holding the whole series in memory.
+    def __init__(self, fp, name, columns, length, attrs=None):
+        #fp      : output file path
+        #name    : series name, ex: 'FOX-1D' or '2018-004A(43111)'
+        #columns : list of (column name, dtype string)
+        #length  : total number of rows
+        self.fp = fp
+        self.length = int(length)
+        hdr_str, self.columns = _header_bytes(name, length, columns, attrs)
+        end = self.columns[-1]['offset'] + np.dtype(str(self.columns[-1]['dtype'])).itemsize * self.length
+        with open(fp, 'wb') as f:
+            f.write(struct.pack('<8sI', magic, len(hdr_str)))
+            f.write(hdr_str)
+            f.truncate(max(end, f.tell()))
+        self.maps = {}
+        for col in self.columns:
+            if self.length == 0: continue
+            self.maps[col['name']] = np.memmap(fp, dtype=str(col['dtype']), mode='r+', \
+                                               offset=col['offset'], shape=(self.length,))
+
+    def write(self, start, data):
+        #start : row index of first row in block
+        #data  : dict of column name -> array
+        for cn in data.keys():
+            values = np.asarray(data[cn])
+            if values.dtype.kind == 'M': values = values.astype('datetime64[ns]')
+            self.maps[cn][start:start + len(values)] = values
+
+    def close(self):
+        for cn in self.maps.keys():
+            self.maps[cn].flush()
+        self.maps = {}
+
+def write_columnar(fp, df, name=None, attrs=None):
+    #desc:  write dataframe columns to a .dcol file, index is not stored
+    #input:
+    #   fp   : output file path
+    #   df   : pandas dataframe, or dict of column name -> array
+    #   name : series name, defaults to df.name
+    if name is None: name = getattr(df, 'name', '')
+    cols = list(df.columns) if hasattr(df, 'columns') else sorted(df.keys())
+    columns = [(cn, _column_dtype(df[cn])) for cn in cols]
+    length = len(df[cols[0]]) if len(cols) > 0 else 0
+    w = columnar_writer(fp, name, columns, length, attrs)
+    w.write(0, dict([(cn, np.asarray(df[cn])) for cn in cols]))
+    w.close()
+
+def read_columnar_arrays(fp, mmap=True):
+    #desc:  read a .dcol file without pandas
+    #output: (header dict, dict of column name -> numpy array)
+    #   with mmap=True the arrays are read only memory maps
+    with open(fp, 'rb') as f:
+        mg, hdr_len = struct.unpack('<8sI', f.read(12))
+        if mg != magic:
+            raise ValueError('Not a columnar Doppler file: {:s}'.format(fp))
+        hdr = json.loads(f.read(hdr_len))
+    data = {}
+    for col in hdr['columns']:
+        dtype = np.dtype(str(col['dtype']))
+        if hdr['length'] == 0:
+            data[col['name']] = np.zeros(0, dtype=dtype)
+        elif mmap:
+            data[col['name']] = np.memmap(fp, dtype=dtype, mode='r', \
+                                          offset=col['offset'], shape=(hdr['length'],))
+        else:
+            with open(fp, 'rb') as f:
+                f.seek(col['offset'])
+                data[col['name']] = np.fromfile(f, dtype=dtype, count=hdr['length'])
+    return hdr, data
+
+def read_columnar(fp):
+    #desc:  read a .dcol file into a pandas dataframe, df.name is restored
+    import pandas as pd
+    hdr, data = read_columnar_arrays(fp, mmap=False)
+    df = pd.DataFrame(data, columns=[col['name'] for col in hdr['columns']])
+    df.name = hdr['name']
+    return df
+
+def read_doppler(fp):
+    #desc:  read a Doppler series in any of the supported formats
+    #   .dcol : binary columnar
+    #   .json : records oriented JSON, legacy
+    #   .csv  : CSV with 'index' column, legacy
+    #output: pandas dataframe, df.name set from file header or file name
+    import pandas as pd
+    if fp.endswith(ext):
+        return read_columnar(fp)
+    if fp.endswith('.json'):
+        df = pd.read_json(fp, orient='records')
+    elif fp.endswith('.csv'):
+        df = pd.read_csv(fp, index_col='index', parse_dates=['timestamp'])
+    else:
+        raise ValueError('Unknown Doppler file format: {:s}'.format(fp))
+    df.name = os.path.basename(fp).split('_')[1]
+    return df
+
+def find_doppler_files(path):
+    #--return sorted list of Doppler series files in 'path', one per series
+    #the same series may exist in several formats, prefer .dcol then .json
+    found = {}
+    for (dirpath, dirnames, filenames) in os.walk(path):
+        for fn in filenames:
+            stem, e = os.path.splitext(fn)
+            if e == ext:
+                found[stem] = fn
+            elif e == '.json' and stem not in found:
+                found[stem] = fn
+        break
+    return sorted(found.values())
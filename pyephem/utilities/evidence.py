@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+#############################################
+#   Title: Multi pass match evidence        #
+# Project: TLE Match                        #
+#    Date: Jan 2018                         #
+#  Author: Zach Leffke, KJ4QLP              #
+#############################################
+#   Accumulates per candidate match scores across passes, possibly from
+#   several ground stations, so identification firms up as passes come in.
+#   Each pass score is turned into a Gaussian log likelihood,
+#       loglik = -0.5 * (score / sigma)**2
+#   and added to the running total of the candidate, a pass is folded in
+#   O(candidates) and earlier passes are never re-scored.  With a uniform
+#   prior the posterior is the normalized exp of the totals.  The state is
+#   a small JSON file.
+import os
+import json
+import numpy as np
+
+#--score uncertainty per metric, seconds for time metrics, Hz for residuals
+metric_sigma = {'tca_delta':1.0, 'lag':1.0, 'shift':1.0,
+                'l1':50.0, 'l2':50.0, 'l2_fit':50.0,
+                'ncc':1e-3, 'xcorr':1e-3}
+#--correlation metrics are scored as 1 - value
+higher_is_better = ['ncc', 'xcorr']
+
+class match_state(object):
+    def __init__(self, path=None):
+        #path : JSON state file, loaded if it exists
+        self.path = path
+        self.target = None
+        self.passes = []    #folded pass records, oldest first
+        self.names = []     #candidate names, index into loglik
+        self.loglik = np.zeros(0)
+        self.scored = np.zeros(0, dtype=int) #passes each candidate was visible in
+        self._idx = {}
+        if path is not None and os.path.isfile(path):
+            self.load(path)
+
+    def load(self, path):
+        with open(path, 'r') as f:
+            st = json.load(f)
+        self.target = st['target']
+        self.passes = st['passes']
+        self.names = [c['name'] for c in st['candidates']]
+        self.loglik = np.array([c['loglik'] for c in st['candidates']], dtype=float)
+        self.scored = np.array([c['scored'] for c in st['candidates']], dtype=int)
+        self._idx = dict([(n, i) for i, n in enumerate(self.names)])
+
+    def save(self, path=None):
+        #write to a temporary file and rename, a crash never leaves a partial state
+        path = path or self.path
+        st = {}
+        st['target'] = self.target
+        st['passes'] = self.passes
+        st['candidates'] = [{'name':n, 'loglik':float(l), 'scored':int(s)} \
+                            for n, l, s in zip(self.names, self.loglik, self.scored)]
+        tmp = '{:s}.{:d}.tmp'.format(path, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(st, f, indent=4)
+        os.rename(tmp, path)
+
+    def has_pass(self, pass_id):
+        return pass_id in [p['id'] for p in self.passes]
+
+    def update(self, table, metric, pass_id, station=None, sigma=None, target=None):
+        #desc:  fold one ranked pass into the state
+        #input:
+        #   table   : ranked candidate table, see match.match_poly_data
+        #   metric  : table column used as evidence
+        #   pass_id : unique pass identifier, a pass is only folded once
+        #   station : ground station label of the pass
+        #   sigma   : score uncertainty, default metric_sigma[metric]
+        #   target  : measured satellite name, must match the state
+        #output: True if folded, False for an already folded pass
+        #   Candidates missing from the pass (below the elevation mask, so
+        #   not heard) get the worst log likelihood of the pass.  Candidates
+        #   seen for the first time start from the current worst total.
+        if self.has_pass(pass_id): return False
+        if target is not None:
+            if self.target is not None and self.target != target:
+                raise ValueError('state is for {:s}, pass is for {:s}'.format(self.target, target))
+            self.target = target
+        if sigma is None: sigma = metric_sigma[metric]
+        score = np.array([row[metric] for row in table], dtype=float)
+        if metric in higher_is_better: score = 1.0 - score
+        ll = -0.5 * (score / sigma)**2
+        finite = np.isfinite(ll)
+        worst = ll[finite].min() if np.any(finite) else 0.0
+        ll[~finite] = worst
+        start = self.loglik.min() if len(self.loglik) > 0 else 0.0
+        new = [row['name'] for row in table if row['name'] not in self._idx]
+        for name in new:
+            self._idx[name] = len(self.names)
+            self.names.append(name)
+        self.loglik = np.concatenate([self.loglik, np.full(len(new), start)])
+        self.scored = np.concatenate([self.scored, np.zeros(len(new), dtype=int)])
+        delta = np.full(len(self.names), worst)
+        idx = np.array([self._idx[row['name']] for row in table], dtype=int)
+        if len(idx) > 0:
+            delta[idx] = ll
+            self.scored[idx] += 1
+        self.loglik += delta
+        rec = {}
+        rec['id'] = pass_id
+        rec['station'] = station
+        rec['metric'] = metric
+        rec['sigma'] = sigma
+        rec['candidates'] = len(table)
+        rec['best'] = table[int(np.argmax(ll))]['name'] if len(table) > 0 else None
+        self.passes.append(rec)
+        return True
+
+    def ranking(self):
+        #output: list of dicts, name, loglik, posterior, scored, best first
+        if len(self.names) == 0: return []
+        p = np.exp(self.loglik - self.loglik.max())
+        p /= p.sum()
+        order = np.argsort(-self.loglik, kind='mergesort')
+        rows = []
+        for rank, i in enumerate(order):
+            rows.append({'rank':rank + 1, 'name':self.names[i], 'loglik':float(self.loglik[i]), \
+                         'posterior':float(p[i]), 'scored':int(self.scored[i])})
+        return rows
+
+    def margin(self):
+        #ambiguity margin, log likelihood ratio of best over runner up,
+        #ln(99) ~ 4.6 means the best candidate is 99 times more likely
+        if len(self.names) < 2: return float('inf')
+        top = np.sort(self.loglik)[-2:]
+        return float(top[1] - top[0])
+
+def station_label(md):
+    #ground station label from measurement metadata, name if given else position
+    if md.get('gs_name'): return md['gs_name']
+    return '{:.6f},{:.6f},{:.1f}'.format(md['gs_lat'], md['gs_lon'], md['gs_alt'])
+
+def pass_key(name, start_utc, samples, station):
+    #one pass of one satellite over one station, keyed on the measurement
+    #(first sample time stamp and length), not on fitted values like the TCA,
+    #so re-running a pass with other fit settings is still the same pass
+    return '|'.join([name, str(start_utc), str(samples), str(station)])
+
+def print_summary(state, confidence=0.99, top=None):
+    #posterior ranking, ambiguity margin and match declaration
+    rows = state.ranking()
+    print 'Accumulated evidence, {:d} pass(es):'.format(len(state.passes))
+    print_ranking(rows, top)
+    if len(rows) == 0: return
+    print 'Ambiguity margin (log likelihood ratio, best / runner up): {:3.3f}'.format(state.margin())
+    if rows[0]['posterior'] >= confidence:
+        print 'Match declared for {:s}: {:s}, posterior {:3.6f}'.format(state.target, rows[0]['name'], \
+                                                                     rows[0]['posterior'])
+    else:
+        print 'Match ambiguous, best posterior {:3.6f} < {:3.3f}'.format(rows[0]['posterior'], confidence)
+
+def print_ranking(rows, top=None):
+    rows = rows if top is None else rows[:top]
+    hdr = '{:>4s}  {:<20s}{:>14s}{:>12s}{:>8s}'.format('Rank', 'Candidate', 'loglik', 'posterior', 'passes')
+    print hdr
+    print '-' * len(hdr)
+    for row in rows:
+        print '{:>4d}  {:<20s}{:>14.3f}{:>12.6f}{:>8d}'.format(row['rank'], row['name'], row['loglik'], \
+                                                             row['posterior'], row['scored'])
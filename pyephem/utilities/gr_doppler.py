@@ -8,17 +8,16 @@
 import sys
 import os
 import math
-import string
-import struct
-import numpy
-import scipy
+import logging
+import numpy as np
 import datetime as dt
-import pandas as pd
 
 deg2rad = math.pi / 180
 rad2deg = 180 / math.pi
 c       = float(299792458)    #[m/s], speed of light
 
+log = logging.getLogger(__name__)
+
 def Import_Doppler_Data(fp, fn):
     #desc:  Imports Doppler data from GNU Radio file
     #input:
@@ -32,27 +31,23 @@ def Import_Doppler_Data(fp, fn):
     #           -sample rate of recording
     #output:
     #   returns pandas dataframe with timestamp for each offset measurement
+    import pandas as pd
     path = '/'.join([fp,fn])
     if not (os.path.isfile(path)):
         print "ERROR: Invalid Doppler Measurement source file: " + path
         sys.exit()
 
-    print 'Importing Doppler data from: {:s}'.format(path)
+    log.info('Importing Doppler data from: %s', path)
     #Extract File metadata from filename
     md = Get_Meas_File_Metadata(fn)
-    print '      Recording Start Time [UTC]: {:s}'.format(str(md['start_ts']))
-    print 'Recording Sample Rate [samp/sec]: {:d}'.format(md['samp_rate'])
-    print ' Inter-Sample Time Spacing [sec]: {:f}'.format(md['samp_spacing'])
+    log.info('      Recording Start Time [UTC]: %s', str(md['start_ts']))
+    log.info('Recording Sample Rate [samp/sec]: %d', md['samp_rate'])
+    log.info(' Inter-Sample Time Spacing [sec]: %f', md['samp_spacing'])
 
     data_pts = gr_f32_file_input(path)
 
-    ts = []
-    idx = []
-    print 'Generating Time Stamps'
-    for idx, dp in enumerate(data_pts):
-        if idx % 1000000 == 0:
-            print "Percentage Complete: {:f}".format(float(idx)/len(data_pts)* 100)
-        ts.append(md['start_ts'] + dt.timedelta(seconds=idx*md['samp_spacing']))
+    log.debug('Generating Time Stamps')
+    ts = Meas_Time_Stamps(md, 0, len(data_pts))
 
     df = pd.DataFrame({ 'timestamp':ts,
                         'doppler_offset':data_pts})
@@ -60,13 +55,146 @@ def Import_Doppler_Data(fp, fn):
     df.name = md['sat_name']
     return df
 
+def Import_Burst_Data(fp, fn, start=0, stop=0):
+    #desc:  Imports burst mode Doppler data, one carrier frequency offset
+    #       per decoded packet, so time stamps are irregular and come from
+    #       the file instead of the sample rate.
+    #input:
+    #   fp : path to burst measurement file
+    #   fn : burst measurement file, CSV with columns
+    #           timestamp      : ISO 8601 UTC or unix time [s]
+    #           doppler_offset : carrier frequency offset [Hz]
+    #       other columns (snr, packet id, ...) are ignored
+    #       File name follows the .f32 naming with 'burst' as the rate:
+    #           <SAT NAME>_<RECEIVER TYPE>_YYYYMMDD_HHMMSS.ssssss_UTC_burst.csv
+    #   start : packets to drop at start of file
+    #   stop  : packets to drop at end of file
+    #output:
+    #   returns pandas dataframe sorted by time, duplicate time stamps and
+    #   invalid offsets dropped
+    import pandas as pd
+    path = '/'.join([fp,fn])
+    if not (os.path.isfile(path)):
+        print "ERROR: Invalid Doppler Measurement source file: " + path
+        sys.exit()
+    raw = pd.read_csv(path)
+    if raw['timestamp'].dtype.kind in 'iuf':
+        ts = (raw['timestamp'].values * 1e9).round().astype(np.int64).astype('datetime64[ns]')
+    else:
+        ts = pd.to_datetime(raw['timestamp'].str.rstrip('Z')).values.astype('datetime64[ns]')
+    offsets = raw['doppler_offset'].values.astype(float)
+    valid = np.isfinite(offsets) & ~np.isnat(ts)
+    ts, offsets = ts[valid], offsets[valid]
+    order = np.argsort(ts, kind='mergesort')
+    ts, offsets = ts[order], offsets[order]
+    keep = np.ones(len(ts), dtype=bool)
+    keep[1:] = ts[1:] != ts[:-1]
+    ts, offsets = ts[keep], offsets[keep]
+    ts, offsets = ts[start:len(ts) - stop], offsets[start:len(offsets) - stop]
+    df = pd.DataFrame({ 'timestamp':ts,
+                        'doppler_offset':offsets},
+                      columns=['doppler_offset', 'timestamp'])
+    df.name = Get_Meas_File_Metadata(fn)['sat_name']
+    return df
+
+def Stream_Doppler_Data(fp, fn, start=0, stop=0, chunk_size=1048576):
+    #desc:  Streaming version of Import_Doppler_Data for long recordings.
+    #       The file is memory mapped and handed out in fixed size blocks,
+    #       so the full recording is never held in memory.
+    #input:
+    #   fp, fn     : same as Import_Doppler_Data
+    #   start      : samples to skip at start of file
+    #   stop       : samples to drop at end of file
+    #   chunk_size : samples per block
+    #output:
+    #   generator of (timestamps, offsets) tuples, numpy datetime64[ns] and
+    #   float32 arrays, last block may be short
+    path = '/'.join([fp,fn])
+    if not (os.path.isfile(path)):
+        print "ERROR: Invalid Doppler Measurement source file: " + path
+        sys.exit()
+    md = Get_Meas_File_Metadata(fn)
+    data_pts = gr_f32_file_mmap(path)
+    for idx in range(start, len(data_pts) - stop, chunk_size):
+        end = min(idx + chunk_size, len(data_pts) - stop)
+        yield Meas_Time_Stamps(md, idx, end - idx), np.array(data_pts[idx:end])
+
+def Auto_Trim(offsets, samp_rate, window=3.0, k=4.0, jump=20.0):
+    #desc:  find the contiguous span of valid FLL lock in a Doppler offset
+    #       stream, replaces picking --start / --stop by eye.  In lock the
+    #       sample to sample change of the offset is small and steady, out
+    #       of lock (noise, no signal) it is large and erratic.  One pass:
+    #       rolling standard deviation of the first difference (centered,
+    #       from cumulative sums) plus a derivative continuity test that
+    #       breaks the span at single sample steps far off the rolling mean
+    #       step (lock slips).
+    #       Defaults reproduce the hand picked FOX-1D bounds within 1 s.
+    #input:
+    #   offsets   : Doppler offset array [Hz]
+    #   samp_rate : samples per second
+    #   window    : rolling window length [s]
+    #   k         : valid if rolling std < k * noise floor, floor = 10th
+    #               percentile of the rolling std (needs >10% of the
+    #               recording in lock)
+    #   jump      : sample steps deviating from the rolling mean step by
+    #               more than jump * floor break the span
+    #output: dict
+    #   start, stop : index of first valid sample, index after the last one
+    #   floor, threshold : rolling std noise floor and valid threshold [Hz]
+    x = np.asarray(offsets, dtype=float)
+    w = max(int(round(window * samp_rate)), 3)
+    if len(x) < 2 * w:
+        raise ValueError('recording shorter than two trim windows')
+    d = np.diff(x)
+    c1 = np.concatenate([[0.0], np.cumsum(d)])
+    c2 = np.concatenate([[0.0], np.cumsum(d * d)])
+    mean = (c1[w:] - c1[:-w]) / w
+    std = np.sqrt(np.maximum((c2[w:] - c2[:-w]) / w - mean * mean, 0.0))
+    floor = max(np.percentile(std, 10), np.finfo(float).eps)
+    threshold = k * floor
+    valid = np.zeros(len(x), dtype=bool)
+    #window i spans samples i..i+w, its statistic is assigned to the center
+    valid[w // 2:w // 2 + len(std)] = std < threshold
+    #continuity on the deviation from the rolling mean, not the raw step:
+    #   near closest approach the Doppler slope alone is many times the floor
+    mi = np.clip(np.arange(len(d)) - w // 2, 0, len(mean) - 1)
+    steps = np.nonzero(np.abs(d - mean[mi]) > jump * floor)[0]
+    valid[steps] = False
+    valid[steps + 1] = False
+    #longest run of valid samples
+    edges = np.diff(np.concatenate([[0], valid.view(np.int8), [0]]))
+    starts = np.nonzero(edges == 1)[0]
+    stops = np.nonzero(edges == -1)[0]
+    if len(starts) == 0:
+        raise ValueError('no valid lock found, threshold {:3.1f} Hz'.format(threshold))
+    best = np.argmax(stops - starts)
+    res = {}
+    res['start'] = int(starts[best])
+    res['stop'] = int(stops[best])
+    res['floor'] = float(floor)
+    res['threshold'] = float(threshold)
+    return res
+
+def Meas_Time_Stamps(md, start_idx, count):
+    #desc:  vectorized sample time stamps from file metadata
+    #input:
+    #   md        : dict from Get_Meas_File_Metadata
+    #   start_idx : sample index of first time stamp
+    #   count     : number of time stamps
+    #output: numpy datetime64[ns] array
+    #   offsets are computed in integer nanoseconds from the sample rate so
+    #   blocks line up exactly no matter where the stream is split
+    idx = np.arange(start_idx, start_idx + count, dtype=np.int64)
+    t0 = np.datetime64(md['start_ts'], 'ns')
+    return t0 + (idx * 1000000000 // md['samp_rate']).astype('timedelta64[ns]')
+
 def Get_Meas_File_Metadata(filename):
     #input: Doppler Measurement File
     #Filename Format expected, no checks in this function:
     #<SAT NAME>_<RECEIVER TYPE>_YYYYMMDD_HHMMSS.ssssss_<TIME ZONE>_<SAMPLE RATE>.dop
 
-    data = filename.split("_")
-    data[-1] = data[-1].strip('.f32')
+    data = os.path.basename(filename).split("_")
+    data[-1] = os.path.splitext(data[-1])[0]
     md = {} #metadata dict
     md['sat_name'] = data[0]
     md['receiver'] = data[1]
@@ -80,8 +208,10 @@ def Get_Meas_File_Metadata(filename):
         md['samp_rate']=int(md['samp_rate_str'].strip('M'))*1000000
     elif 'sps' in data[5]:
         md['samp_rate']=int(md['samp_rate_str'].strip('sps'))
+    elif 'burst' in data[5]: #one measurement per packet, no fixed rate
+        md['samp_rate']=0
 
-    md['samp_spacing'] = 1/float(md['samp_rate'])
+    md['samp_spacing'] = 1/float(md['samp_rate']) if md['samp_rate'] else 0.0
     return md
 
 def gr_f32_file_input(fp, verbose = 0):
@@ -89,7 +219,17 @@ def gr_f32_file_input(fp, verbose = 0):
     #input:  full path to file, assumes is valid
     #output: list of floats for doppler data
 
-    #import gnuradio float32 type, uses scipy
-    f = scipy.fromfile(open(fp, 'r'), dtype=scipy.float32)
-    if verbose: print "Found {:d} 32 bit floats".format(len(f))
+    #import gnuradio float32 type
+    f = np.fromfile(fp, dtype=np.float32)
+    if verbose: log.info("Found %d 32 bit floats", len(f))
+    return f
+
+def gr_f32_file_mmap(fp, verbose = 0):
+    #desc:  Memory maps GNU Radio Float32 File, read only
+    #input:  full path to file, assumes is valid
+    #output: numpy memmap of float32 doppler data
+    if os.path.getsize(fp) < 4: #np.memmap refuses empty files
+        return np.zeros(0, dtype=np.float32)
+    f = np.memmap(fp, dtype=np.float32, mode='r')
+    if verbose: log.info("Found %d 32 bit floats", len(f))
     return f
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+#############################################
+#   Title: Run instrumentation              #
+# Project: TLE Match                        #
+#    Date: Jan 2018                         #
+#  Author: Zach Leffke, KJ4QLP              #
+#############################################
+#   Span timers, counters and peak memory snapshots for the pipeline stages,
+#   collected in a run_report and written as a JSON run report.  Console
+#   output of the utilities goes through the logging module: stage and file
+#   messages at INFO, per sample and per candidate detail at DEBUG, so large
+#   runs are not slowed down by stdout.  Optional profiling with cProfile or
+#   pyinstrument (only imported when asked for).
+import os
+import sys
+import json
+import time
+import logging
+import platform
+import resource
+import contextlib
+import datetime as dt
+
+log_levels = ['debug', 'info', 'warning', 'error']
+profilers = ['cprofile', 'pyinstrument']
+
+def setup_logging(level='info'):
+    #console logging for the scripts, plain messages on stdout like the prints they replace
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    root = logging.getLogger()
+    root.handlers = [handler]
+    root.setLevel(getattr(logging, level.upper()))
+
+def peak_rss_mb():
+    #peak resident set size of this process [MB], ru_maxrss is KB on Linux, bytes on OS X
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024.0 * 1024.0) if sys.platform == 'darwin' else rss / 1024.0
+
+class run_report(object):
+    def __init__(self, name=None):
+        #name : run label, usually the script name
+        self.name = name
+        self.started = dt.datetime.utcnow()
+        self.t0 = time.time()
+        self.spans = []     #finished spans, in completion order
+        self.counters = {}
+        self.snapshots = []
+        self.info = {}      #free form run results, JSON serializable
+        self._depth = 0
+
+    @contextlib.contextmanager
+    def span(self, name, **counts):
+        #desc:  time a stage, yields the span record so the stage can add
+        #       counts (samples, candidates, ...) once it knows them
+        rec = {'name':name, 'depth':self._depth, 'start':time.time() - self.t0, \
+               'counts':dict(counts)}
+        self._depth += 1
+        t0 = time.time()
+        try:
+            yield rec
+        finally:
+            self._depth -= 1
+            rec['elapsed'] = time.time() - t0
+            rec['peak_rss_mb'] = peak_rss_mb()
+            self.spans.append(rec)
+            logging.getLogger(__name__).debug('%s: %.3f s, peak RSS %.1f MB', name, rec['elapsed'], \
+                                              rec['peak_rss_mb'])
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def snapshot(self, label):
+        #peak RSS at a point of the run
+        self.snapshots.append({'label':label, 'time':time.time() - self.t0, 'peak_rss_mb':peak_rss_mb()})
+
+    def timing(self):
+        #list of (stage, elapsed [s]) of the top level spans
+        return [(s['name'], s['elapsed']) for s in sorted(self.spans, key=lambda s: s['start']) \
+                if s['depth'] == 0]
+
+    def to_dict(self):
+        import numpy as np
+        rep = {}
+        rep['name'] = self.name
+        rep['started_utc'] = self.started.strftime("%Y-%m-%d %H:%M:%S.%f")
+        rep['elapsed'] = time.time() - self.t0
+        rep['peak_rss_mb'] = peak_rss_mb()
+        rep['argv'] = sys.argv
+        rep['python'] = sys.version.split()[0]
+        rep['numpy'] = np.__version__
+        rep['host'] = platform.node()
+        rep['spans'] = sorted(self.spans, key=lambda s: s['start'])
+        rep['counters'] = self.counters
+        rep['snapshots'] = self.snapshots
+        rep['info'] = self.info
+        return rep
+
+    def save(self, path, default=None):
+        #write to a temporary file and rename, default as in json.dump
+        tmp = '{:s}.{:d}.tmp'.format(path, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(self.to_dict(), f, indent=4, default=default)
+        os.rename(tmp, path)
+
+@contextlib.contextmanager
+def profile(kind=None, path=None):
+    #desc:  profile the enclosed block
+    #input:
+    #   kind : None, 'cprofile' or 'pyinstrument'
+    #   path : cprofile: pstats file (snakeviz, pstats), pyinstrument: text
+    #          report, None = top functions logged at INFO
+    if kind is None:
+        yield
+        return
+    log = logging.getLogger(__name__)
+    if kind == 'cprofile':
+        import cProfile
+        import pstats
+        import StringIO
+        prof = cProfile.Profile()
+        prof.enable()
+        try:
+            yield
+        finally:
+            prof.disable()
+            if path:
+                prof.dump_stats(path)
+                log.info('Profile written to: %s', path)
+            else:
+                out = StringIO.StringIO()
+                pstats.Stats(prof, stream=out).sort_stats('cumulative').print_stats(25)
+                log.info(out.getvalue())
+    elif kind == 'pyinstrument':
+        try:
+            from pyinstrument import Profiler
+        except ImportError:
+            raise ImportError('pyinstrument profiling needs the pyinstrument package')
+        prof = Profiler()
+        prof.start()
+        try:
+            yield
+        finally:
+            prof.stop()
+            if path:
+                with open(path, 'w') as f:
+                    f.write(prof.output_text())
+                log.info('Profile written to: %s', path)
+            else:
+                log.info(prof.output_text())
+    else:
+        raise ValueError('unknown profiler: {:s}'.format(kind))
@@ -0,0 +1,325 @@
+#!/usr/bin/env python
+#############################################
+#   Title: Doppler curve matching utilities #
+# Project: TLE Match                        #
+#    Date: Jan 2018                         #
+#  Author: Zach Leffke, KJ4QLP              #
+#############################################
+#   Scores a measured Doppler curve against every candidate curve at once.
+#   Candidate curves are rows of an (N, T) array on a shared time grid, a
+#   boolean mask of the same shape marks where each candidate is valid.
+import math
+import numpy as np
+
+#--metrics where a larger value is the better match
+higher_is_better = ['ncc', 'xcorr']
+#--signed metrics ranked by magnitude
+rank_by_magnitude = ['tca_delta', 'lag', 'shift']
+#--print format per metric, default '{:>12.3f}'
+metric_fmt = {'ncc':'{:>12.6f}', 'overlap':'{:>12d}', 'shift':'{:>12.4f}', 'lag':'{:>12.4f}', \
+              'xcorr':'{:>12.6f}'}
+
+def pad_coeffs(coeff_list):
+    #stack polynomial coefficient lists of any degree into (N, d+1),
+    #highest power first, lower degree polynomials get leading zeros
+    d = max([len(c) for c in coeff_list])
+    coeffs = np.zeros((len(coeff_list), d))
+    for i, c in enumerate(coeff_list):
+        coeffs[i, d - len(c):] = c
+    return coeffs
+
+def polyval_batch(coeffs, x):
+    #Horner's method for N polynomials at once
+    #input:
+    #   coeffs : (N, d+1), highest power first
+    #   x      : (T,) shared or (N, T) per polynomial
+    #output: (N, T)
+    coeffs = np.asarray(coeffs, dtype=float)
+    x = np.asarray(x, dtype=float)
+    y = np.zeros(np.broadcast(coeffs[:, :1], x).shape)
+    for k in range(coeffs.shape[1]):
+        y = y * x + coeffs[:, k:k+1]
+    return y
+
+def polyder_batch(coeffs):
+    #derivative of N polynomials, (N, d+1) -> (N, d), highest power first
+    coeffs = np.asarray(coeffs, dtype=float)
+    d = coeffs.shape[1] - 1
+    if d == 0: return np.zeros((coeffs.shape[0], 1))
+    return coeffs[:, :-1] * np.arange(d, 0, -1)
+
+def poly_time_axis(pfs, t_ref, t):
+    #desc:  polynomial x for times t, x = x0 + (t - start) / t_step
+    #input:  as poly_time_curves, t can also be (N, T), one row per polynomial
+    #output: x (N, T), mask (N, T) True inside fitted span, t_step (N, 1)
+    start = np.array([(pf['start_utc'] - t_ref).total_seconds() for pf in pfs])[:, np.newaxis]
+    step = np.array([pf['t_step'] for pf in pfs], dtype=float)[:, np.newaxis]
+    x0 = np.array([pf['x0'] for pf in pfs], dtype=float)[:, np.newaxis]
+    n = np.array([pf['len'] for pf in pfs], dtype=float)[:, np.newaxis]
+    x = x0 + (np.asarray(t, dtype=float) - start) / step
+    mask = (x >= x0) & (x <= x0 + n - 1)
+    return x, mask, step
+
+def poly_time_curves(pfs, t_ref, t):
+    #desc:  evaluate fitted Doppler polynomials on a common time grid
+    #input:
+    #   pfs   : list of polyfit dicts, need polynomial, start_utc, t_step, x0, len
+    #   t_ref : datetime, reference for t
+    #   t     : (T,) seconds since t_ref
+    #output: Y (N, T) Doppler offset [Hz], mask (N, T) True inside fitted span
+    coeffs = pad_coeffs([pf['polynomial'] for pf in pfs])
+    x, mask, step = poly_time_axis(pfs, t_ref, t)
+    return polyval_batch(coeffs, x), mask
+
+def fit_offsets(pfs, t_ref, t, y, shift=False, max_shift=60.0, iterations=10):
+    #desc:  per candidate constant frequency bias, and optionally time shift,
+    #       that best explain the measurement, all candidates at once
+    #       model: y(t) = Y_i(t + tau_i) + b_i
+    #       bias only is the closed form weighted mean of the residual, with
+    #       the shift the model is linearized in tau and the 2x2 normal
+    #       equations are solved for every candidate in one vectorized step
+    #       (Gauss-Newton, the polynomials are re-evaluated each iteration).
+    #input:
+    #   pfs       : candidate polyfit dicts, see poly_time_curves
+    #   t_ref, t  : time grid, see poly_time_curves
+    #   y         : (T,) measured Doppler offset [Hz]
+    #   shift     : also fit the time shift
+    #   max_shift : time shift limit [s]
+    #output: dict of (N,) arrays
+    #   bias    : transmitter frequency offset, measured - predicted [Hz]
+    #   shift   : time shift tau [s], 0 without shift
+    #   l2_fit  : RMS residual after removing bias and shift [Hz]
+    y = np.asarray(y, dtype=float)[np.newaxis, :]
+    t = np.asarray(t, dtype=float)
+    coeffs = pad_coeffs([pf['polynomial'] for pf in pfs])
+    dcoeffs = polyder_batch(coeffs)
+    tau = np.zeros(len(pfs))
+    for it in range(iterations if shift else 1):
+        x, mask, step = poly_time_axis(pfs, t_ref, t[np.newaxis, :] + tau[:, np.newaxis])
+        w = mask.astype(float)
+        r = y - polyval_batch(coeffs, x)
+        if not shift: break
+        dY = polyval_batch(dcoeffs, x) / step #[Hz/s]
+        s0 = np.sum(w, axis=1)
+        s1 = np.sum(w * dY, axis=1)
+        s2 = np.sum(w * dY * dY, axis=1)
+        r0 = np.sum(w * r, axis=1)
+        r1 = np.sum(w * dY * r, axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            dtau = (s0 * r1 - s1 * r0) / (s0 * s2 - s1 * s1)
+        dtau = np.where(np.isfinite(dtau), dtau, 0.0)
+        tau = np.clip(tau + dtau, -max_shift, max_shift)
+        if np.max(np.abs(dtau)) < 1e-6: break
+    if shift: #residual at the final shift
+        x, mask, step = poly_time_axis(pfs, t_ref, t[np.newaxis, :] + tau[:, np.newaxis])
+        w = mask.astype(float)
+        r = y - polyval_batch(coeffs, x)
+    cnt = np.sum(w, axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        bias = np.sum(w * r, axis=1) / cnt
+        d = r - bias[:, np.newaxis]
+        l2_fit = np.sqrt(np.sum(w * d * d, axis=1) / cnt)
+    res = {}
+    res['bias'] = bias
+    res['shift'] = tau
+    res['l2_fit'] = l2_fit
+    return res
+
+def score_curves(y, Y, mask=None):
+    #desc:  compare measured curve against all candidates over the overlap
+    #input:
+    #   y    : (T,) measured Doppler offset [Hz]
+    #   Y    : (N, T) candidate Doppler offsets [Hz]
+    #   mask : (N, T) bool, samples to use per candidate, default all
+    #output: dict of (N,) arrays
+    #   l1      : mean absolute difference [Hz]
+    #   l2      : root mean square difference [Hz]
+    #   ncc     : normalized cross correlation (zero lag), 1 = same shape
+    #   overlap : number of samples compared
+    y = np.asarray(y, dtype=float)[np.newaxis, :]
+    Y = np.asarray(Y, dtype=float)
+    if mask is None: w = np.ones(Y.shape)
+    else: w = np.asarray(mask, dtype=float)
+    cnt = np.sum(w, axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        d = Y - y
+        l1 = np.sum(w * np.abs(d), axis=1) / cnt
+        l2 = np.sqrt(np.sum(w * d * d, axis=1) / cnt)
+        ym = np.sum(w * y, axis=1) / cnt
+        Ym = np.sum(w * Y, axis=1) / cnt
+        yc = y - ym[:, np.newaxis]
+        Yc = Y - Ym[:, np.newaxis]
+        ncc = np.sum(w * yc * Yc, axis=1) / \
+              np.sqrt(np.sum(w * yc * yc, axis=1) * np.sum(w * Yc * Yc, axis=1))
+    scores = {}
+    scores['l1'] = l1
+    scores['l2'] = l2
+    scores['ncc'] = ncc
+    scores['overlap'] = cnt.astype(int)
+    return scores
+
+def grid_series(df, pf):
+    #desc:  measured samples on the regular grid of a polynomial fit
+    #input:
+    #   df : measurement dataframe, timestamp and doppler_offset
+    #   pf : polynomial fit of the measurement, start_utc, t_step, len
+    #output: y (len,) [Hz], mask (len,) True where a measured sample falls
+    #        on the grid point (burst files leave gaps)
+    ts = np.asarray(df['timestamp'].values).astype('datetime64[ns]')
+    t = (ts - np.datetime64(pf['start_utc'], 'ns')).astype(np.int64) * 1e-9 #[s]
+    idx = np.round(t / pf['t_step']).astype(np.int64)
+    v = np.asarray(df['doppler_offset'].values, dtype=float)
+    ok = (idx >= 0) & (idx < pf['len']) & (np.abs(t - idx * pf['t_step']) < 0.25 * pf['t_step']) & \
+         np.isfinite(v)
+    y = np.zeros(int(pf['len']))
+    mask = np.zeros(int(pf['len']), dtype=bool)
+    y[idx[ok]] = v[ok]
+    mask[idx[ok]] = True
+    return y, mask
+
+def xcorr_lag(y, Yp, max_lag, mask=None, min_overlap=0.5, ymask=None):
+    #desc:  time lag between the measurement and every candidate from the FFT
+    #       cross correlation, rffts of the measurement terms, batched rffts
+    #       of the candidates, N multiplies and batched inverses
+    #input:
+    #   y       : (T,) measured curve, the measured samples (see grid_series)
+    #             rather than a fit, a fit invents its shape at the span edges
+    #   Yp      : (N, T + 2*max_lag) candidate curves on the same grid, padded
+    #             by max_lag samples on both sides
+    #   max_lag : search range [samples]
+    #   mask    : (N, T + 2*max_lag) True where the candidate is valid (inside
+    #             its fitted span), None = all.  At each lag only the samples
+    #             where both curves are valid are correlated, a fitted
+    #             polynomial evaluated past its span is extrapolation, not Doppler
+    #   min_overlap : lags with fewer than min_overlap of the valid measured
+    #             samples overlapping are not scored
+    #   ymask   : (T,) True where y is a measured sample, None = all
+    #output: lag (N,) [samples], y(n) ~ Y(n + lag), parabolic sub-sample peak
+    #        peak (N,) normalized correlation at the peak, 1 = same shape
+    y = np.asarray(y, dtype=float)
+    Yp = np.asarray(Yp, dtype=float)
+    T = len(y)
+    L = 2 * max_lag + 1 #number of lags
+    M = np.ones(Yp.shape) if mask is None else np.asarray(mask, dtype=float)
+    W = np.ones(T) if ymask is None else np.asarray(ymask, dtype=float)
+    yc = (y - np.sum(y * W) / max(np.sum(W), 1.0)) * W #centered, zero off the samples
+    cnt_row = np.maximum(M.sum(axis=1, keepdims=True), 1.0)
+    Yc = (Yp - (Yp * M).sum(axis=1, keepdims=True) / cnt_row) * M #centered, zero outside the span
+    nfft = 1
+    while nfft < Yp.shape[1] + T: nfft *= 2 #no circular wrap
+    def xc(a, FB): #correlation of a (T,) with the rows of B at lags 0..L-1
+        return np.fft.irfft(FB * np.conj(np.fft.rfft(a, nfft)), nfft, axis=1)[:, :L]
+    #sums over the samples valid in both curves at each lag
+    FM = np.fft.rfft(M, nfft, axis=1)
+    FY = np.fft.rfft(Yc, nfft, axis=1)
+    c = xc(yc, FY)                                   #y * Y
+    n = np.round(xc(W, FM))                          #overlap count
+    sy = xc(yc, FM)                                  #y
+    syy = xc(yc * yc, FM)                            #y^2
+    s1 = xc(W, FY)                                   #Y
+    s2 = xc(W, np.fft.rfft(Yc * Yc, nfft, axis=1))   #Y^2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ncc = (c - sy * s1 / n) / np.sqrt(np.maximum(syy - sy * sy / n, 0.0) * \
+                                          np.maximum(s2 - s1 * s1 / n, 0.0))
+    ncc = np.where(np.isfinite(ncc) & (n >= min_overlap * np.sum(W)), ncc, -np.inf)
+    k = np.argmax(ncc, axis=1)
+    rows = np.arange(len(k))
+    km, kp = np.maximum(k - 1, 0), np.minimum(k + 1, L - 1)
+    c0, cm, cp = ncc[rows, k], ncc[rows, km], ncc[rows, kp]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        delta = 0.5 * (cm - cp) / (cm - 2.0 * c0 + cp)
+    inner = (k > 0) & (k < L - 1) & np.isfinite(delta)
+    delta = np.where(inner, np.clip(delta, -0.5, 0.5), 0.0)
+    peak = np.where(inner, c0 - 0.25 * (cm - cp) * delta, c0)
+    peak = np.where(np.isfinite(peak), peak, np.nan)
+    return k + delta - max_lag, peak
+
+def rank_candidates(names, scores, rank_by='l2'):
+    #desc:  ranked table of candidates
+    #input:
+    #   names   : list of N candidate names
+    #   scores  : dict of (N,) arrays, ex: from score_curves plus 'tca_delta'
+    #   rank_by : score key to sort on, rank_by_magnitude keys are sorted by magnitude
+    #output: list of dicts, best match first, NaN scores sort last
+    key = np.asarray(scores[rank_by], dtype=float)
+    if rank_by in rank_by_magnitude: key = np.abs(key)
+    if rank_by in higher_is_better: key = -key
+    key = np.where(np.isnan(key), np.inf, key)
+    order = np.argsort(key, kind='mergesort') #stable, ties keep input order
+    table = []
+    for rank, i in enumerate(order):
+        row = {}
+        row['rank'] = rank + 1
+        row['name'] = names[i]
+        for k in scores.keys():
+            row[k] = scores[k][i].item() if hasattr(scores[k][i], 'item') else scores[k][i]
+        table.append(row)
+    return table
+
+def print_rank_table(table, keys, top=None):
+    #print ranked table, keys are the score columns to show
+    rows = table if top is None else table[:top]
+    hdr = '{:>4s}  {:<20s}'.format('Rank', 'Candidate') + ''.join(['{:>12s}'.format(k) for k in keys])
+    print hdr
+    print '-' * len(hdr)
+    for row in rows:
+        line = '{:>4d}  {:<20s}'.format(row['rank'], row['name'])
+        for k in keys:
+            line += metric_fmt.get(k, '{:>12.3f}').format(row[k])
+        print line
+
+def match_poly_data(meas, cands, rank_by='tca_delta', fit_bias=False, fit_shift=False, \
+                    xcorr=False, max_lag=60.0, meas_df=None):
+    #desc:  rank candidates against the measurement, TCA delta plus full
+    #       curve scores when the polynomial data has a time axis
+    #input:
+    #   meas      : polynomial data dict of the measurement, name and pf
+    #   cands     : list of polynomial data dicts of the candidates
+    #   rank_by   : score to rank on, falls back to tca_delta for old format data
+    #   fit_bias  : also estimate a transmitter frequency bias per candidate (l2_fit, bias)
+    #   fit_shift : with fit_bias, also estimate a time shift per candidate (shift)
+    #   xcorr     : cross correlation time lag search (lag, xcorr) over +/- max_lag [s],
+    #               each lag scored on the samples inside the candidate's fitted span
+    #   meas_df   : measurement dataframe, timestamp and doppler_offset, the lag
+    #               search correlates the measured samples, None = the measurement fit
+    #output: ranked table, score keys, score actually used for ranking
+    names = [c['name'] for c in cands]
+    scores = {}
+    scores['tca_delta'] = np.array([(meas['pf']['tca_utc'] - c['pf']['tca_utc']).total_seconds() \
+                                    for c in cands])
+    keys = ['tca_delta']
+    has_curves = ('start_utc' in meas['pf']) and all(['start_utc' in c['pf'] for c in cands])
+    if has_curves and len(cands) > 0:
+        m_pf = meas['pf']
+        t = np.arange(m_pf['len']) * m_pf['t_step'] #[s] since measurement start
+        y = poly_time_curves([m_pf], m_pf['start_utc'], t)[0][0]
+        Y, mask = poly_time_curves([c['pf'] for c in cands], m_pf['start_utc'], t)
+        scores.update(score_curves(y, Y, mask))
+        keys.extend(['l1', 'l2', 'ncc'])
+        if fit_bias or fit_shift:
+            scores.update(fit_offsets([c['pf'] for c in cands], m_pf['start_utc'], t, y, fit_shift))
+            keys.extend(['l2_fit', 'bias'])
+            if fit_shift: keys.append('shift')
+        elif rank_by == 'l2_fit':
+            print 'WARNING: l2_fit needs the bias fit, ranking by l2'
+            rank_by = 'l2'
+        if xcorr:
+            n_lag = int(np.ceil(max_lag / m_pf['t_step']))
+            tp = np.arange(-n_lag, m_pf['len'] + n_lag) * m_pf['t_step']
+            Yp, Mp = poly_time_curves([c['pf'] for c in cands], m_pf['start_utc'], tp)
+            if meas_df is not None:
+                ym, wm = grid_series(meas_df, m_pf)
+                lag, peak = xcorr_lag(ym, Yp, n_lag, Mp, ymask=wm)
+            else:
+                print 'WARNING: no measured samples given, cross correlating the measurement fit'
+                lag, peak = xcorr_lag(y, Yp, n_lag, Mp)
+            scores['lag'] = lag * m_pf['t_step']
+            scores['xcorr'] = peak
+            keys.extend(['lag', 'xcorr'])
+        elif rank_by in ['lag', 'xcorr']:
+            print 'WARNING: {:s} needs the cross correlation search, ranking by ncc'.format(rank_by)
+            rank_by = 'ncc'
+    elif rank_by != 'tca_delta':
+        print 'WARNING: polynomial data has no time axis (old format), ranking by tca_delta'
+        rank_by = 'tca_delta'
+    return rank_candidates(names, scores, rank_by), keys, rank_by
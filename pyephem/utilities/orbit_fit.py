@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+#############################################
+#   Title: TLE refinement, Doppler fit      #
+# Project: TLE Match                        #
+#    Date: Jan 2018                         #
+#  Author: Zach Leffke, KJ4QLP              #
+#############################################
+#   Differential correction of a candidate TLE against a measured Doppler
+#   curve.  Selected mean elements (mean anomaly and B* by default, the
+#   along-track terms launch TLEs get wrong first) plus a constant
+#   transmitter frequency bias, and optionally a linear oscillator drift,
+#   are adjusted by Levenberg-Marquardt to
+#   minimize the Doppler residual.  Over one pass mean anomaly and B* both
+#   mostly shift the satellite along track, so each element also gets a
+#   weak a priori constraint (param_prior) around its TLE value, that keeps
+#   the fit from trading one against the other.  The Jacobian is a central finite
+#   difference: the trial point and its +/- perturbed copies are stacked
+#   into one (2P+1, 1) element set and propagated in a single vectorized
+#   SGP4 call per iteration.
+import math
+import numpy as np
+
+from . import propagator
+
+deg2rad = math.pi / 180
+rad2deg = 180 / math.pi
+
+#--finite difference step per element, element units (rad, rad/min, 1/earth radii)
+param_step = {'mo':1e-5, 'bstar':1e-5, 'no_kozai':1e-8, 'nodeo':1e-5, 'inclo':1e-5, \
+              'argpo':1e-5, 'ecco':1e-6}
+#--a priori 1 sigma of the element corrections, element units
+param_prior = {'mo':1.0*deg2rad, 'bstar':1e-4, 'no_kozai':1e-3/propagator.xpdotp, 'nodeo':0.1*deg2rad, \
+               'inclo':0.1*deg2rad, 'argpo':1.0*deg2rad, 'ecco':1e-4}
+#--report units, scale from element units
+param_units = {'mo':('deg', rad2deg), 'bstar':('1/ER', 1.0), 'no_kozai':('rev/day', propagator.xpdotp), \
+               'nodeo':('deg', rad2deg), 'inclo':('deg', rad2deg), 'argpo':('deg', rad2deg), \
+               'ecco':('', 1.0), 'bias':('Hz', 1.0), 'drift':('Hz/s', 1.0)}
+
+def doppler_model(el, params, X, timestamp, site, rx_freq):
+    #desc:  Doppler offset of K element sets that differ from el in params
+    #input:
+    #   el        : element dict, see propagator.tle_elements
+    #   params    : element names adjusted, columns of X
+    #   X         : (K, P) element deltas
+    #   timestamp : datetime64 array (T,)
+    #   site      : (lat [rad], lon [rad], alt [m])
+    #output: (K, T) Doppler offset [Hz]
+    stacked = propagator.stack_elements([el] * X.shape[0])
+    for j, p in enumerate(params):
+        stacked[p] = stacked[p] + X[:, j:j+1]
+    s = propagator.sgp4_init(stacked)
+    rr = propagator.range_rate_batch(s, timestamp, site[0], site[1], site[2])
+    return -rr / propagator.c * rx_freq
+
+def tle_exp_field(value):
+    #TLE 'assumed decimal point' exponent field, inverse of propagator._tle_float
+    if value == 0: return ' 00000-0'
+    exp = int(math.floor(math.log10(abs(value)))) + 1
+    mant = int(round(abs(value) / 10.0**exp * 1e5))
+    if mant >= 100000: mant, exp = 10000, exp + 1
+    return '{:s}{:05d}{:s}{:d}'.format('-' if value < 0 else ' ', mant, '-' if exp < 0 else '+', abs(exp))
+
+def format_tle(line1, line2, el):
+    #desc:  TLE lines with B*, inclination, RAAN, eccentricity, argument of
+    #       perigee, mean anomaly and mean motion from el, checksums redone
+    line1 = line1[:53] + tle_exp_field(float(el['bstar'])) + line1[61:68]
+    line2 = line2[:8] + '{:8.4f}'.format(float(el['inclo']) * rad2deg % 360.0) + line2[16:17] + \
+            '{:8.4f}'.format(float(el['nodeo']) * rad2deg % 360.0) + line2[25:26] + \
+            '{:07d}'.format(int(round(float(el['ecco']) * 1e7))) + line2[33:34] + \
+            '{:8.4f}'.format(float(el['argpo']) * rad2deg % 360.0) + line2[42:43] + \
+            '{:8.4f}'.format(float(el['mo']) * rad2deg % 360.0) + line2[51:52] + \
+            '{:11.8f}'.format(float(el['no_kozai']) * propagator.xpdotp) + line2[63:68]
+    return line1 + str(propagator.tle_checksum(line1)), line2 + str(propagator.tle_checksum(line2))
+
+def refine_tle(line1, line2, timestamp, doppler, site, rx_freq, params=['mo', 'bstar'], bias=True, \
+               drift=True, iterations=20, tol=1e-6):
+    #desc:  differential correction of a TLE against measured Doppler
+    #input:
+    #   line1, line2 : candidate TLE
+    #   timestamp    : datetime64 array (T,) of the measurement
+    #   doppler      : measured Doppler offset [Hz] (T,)
+    #   site         : (lat [rad], lon [rad], alt [m]) of the ground station
+    #   rx_freq      : downlink center frequency [Hz]
+    #   params       : element names to adjust, see param_step
+    #   bias         : also fit a constant transmitter frequency bias
+    #   drift        : also fit a linear transmitter frequency drift, without
+    #                  it a drifting oscillator is absorbed by the elements
+    #   Residuals are weighted by the measurement noise, estimated from the
+    #   sample to sample differences, the a priori terms by param_prior.
+    #output: dict
+    #   line1, line2       : refined TLE, checksums updated
+    #   delta, sigma       : per parameter correction and 1 sigma, report units
+    #   rms_before, rms_after, rms_tle : residual RMS [Hz] of the input TLE,
+    #                        the fitted elements and the emitted (rounded) TLE,
+    #                        all with the transmitter terms (bias, drift) removed,
+    #                        so the difference is the element correction alone
+    #   iterations, bias [Hz], drift [Hz/s] about the middle of the pass
+    el = propagator.tle_elements(line1, line2)
+    if propagator.sgp4_init(el)['deep']:
+        raise ValueError('deep space object, refinement needs the near earth SGP4 model')
+    timestamp = propagator.to_datetime64(timestamp)
+    y = np.asarray(doppler, dtype=float)
+    dy = np.diff(y)
+    noise = max(1.4826 * np.median(np.abs(dy - np.median(dy))) / math.sqrt(2.0), 1e-3) #[Hz]
+    P = len(params)
+    #--transmitter terms, linear in the residual: bias, drift about mid pass
+    lin_names, lin = [], []
+    t_s = (timestamp - timestamp[len(timestamp) // 2]).astype(np.int64) / 1e9
+    if bias: lin_names.append('bias'); lin.append(np.ones(len(y)))
+    if drift: lin_names.append('drift'); lin.append(t_s)
+    L = np.array(lin).T.reshape(len(y), len(lin))
+    N = P + len(lin)
+    h = np.array([param_step[p] for p in params])
+    prior = np.zeros(N) #inverse variance, transmitter terms unconstrained
+    prior[:P] = 1.0 / np.array([param_prior[p] for p in params])**2
+    stencil = np.vstack([np.zeros(P), np.diag(h), -np.diag(h)])
+
+    def jacobian(F):
+        J = (F[1:P+1] - F[P+1:]).T / (2.0 * h) #(T, P)
+        return np.hstack([J, L]) / noise
+
+    def objective(r, z):
+        return np.sum(((r - np.dot(L, z[P:])) / noise)**2) + np.sum(prior * z * z)
+
+    z = np.zeros(N) #element corrections, then transmitter terms
+    F = doppler_model(el, params, stencil, timestamp, site, rx_freq)
+    r = y - F[0]
+    if len(lin) > 0: z[P:] = np.linalg.lstsq(L, r, rcond=None)[0]
+    r0 = r - np.dot(L, z[P:]) #input TLE, transmitter terms fitted as in the refined model
+    rms_before = math.sqrt(np.mean(r0 * r0))
+    cost = objective(r, z)
+    lam = 1e-3
+    for it in range(iterations):
+        J = jacobian(F)
+        A = np.dot(J.T, J) + np.diag(prior)
+        g = np.dot(J.T, (r - np.dot(L, z[P:])) / noise) - prior * z
+        while True:
+            z_new = z + np.linalg.solve(A + lam * np.diag(np.diag(A)), g)
+            F_new = doppler_model(el, params, z_new[:P] + stencil, timestamp, site, rx_freq)
+            r_new = y - F_new[0]
+            cost_new = objective(r_new, z_new)
+            if cost_new < cost or lam > 1e8: break
+            lam *= 10.0
+        if cost_new >= cost: break #no further descent
+        done = (cost - cost_new) <= tol * cost
+        z, F, r, cost = z_new, F_new, r_new, cost_new
+        lam = max(lam / 10.0, 1e-9)
+        if done: break
+    x = z[:P]
+    fit = np.dot(L, z[P:]) #transmitter part of the residual
+    #--1 sigma from the inverse normal matrix, inflated when the residual is
+    #  larger than the noise estimate (model error)
+    J = jacobian(F)
+    chi2 = np.sum(((r - fit) / noise)**2) / max(len(y) - N, 1)
+    cov = np.linalg.inv(np.dot(J.T, J) + np.diag(prior)) * max(chi2, 1.0)
+    sig = np.sqrt(np.diag(cov))
+    names = list(params) + lin_names
+    values = list(z)
+    res = {}
+    res['delta'] = dict([(n, v * param_units[n][1]) for n, v in zip(names, values)])
+    res['sigma'] = dict([(n, s * param_units[n][1]) for n, s in zip(names, sig)])
+    res['units'] = dict([(n, param_units[n][0]) for n in names])
+    res['bias'] = res['delta'].get('bias', 0.0)
+    res['drift'] = res['delta'].get('drift', 0.0)
+    res['rms_before'] = rms_before
+    res['rms_after'] = math.sqrt(np.mean((r - fit)**2))
+    res['noise'] = noise
+    res['iterations'] = it + 1
+    fitted = dict(el)
+    for j, p in enumerate(params):
+        fitted[p] = el[p] + x[j]
+    res['line1'], res['line2'] = format_tle(line1, line2, fitted)
+    #--residual of the emitted TLE, fields are rounded to TLE precision
+    el_tle = propagator.tle_elements(res['line1'], res['line2'])
+    r_tle = y - doppler_model(el_tle, [], np.zeros((1, 0)), timestamp, site, rx_freq)[0] - fit
+    res['rms_tle'] = math.sqrt(np.mean(r_tle * r_tle))
+    return res
@@ -0,0 +1,345 @@
+#!/usr/bin/env python
+#############################################
+#   Title: TLE Match pipeline               #
+# Project: TLE Match                        #
+#    Date: Jan 2018                         #
+#  Author: Zach Leffke, KJ4QLP              #
+#############################################
+#   Single process version of convert_doppler -> generate_doppler ->
+#   doppler_polynomial -> tle_match.  Stages hand numpy arrays and
+#   dataframes to each other, files are only written when an output
+#   folder is given.
+import os
+import math
+import json
+import logging
+import itertools
+import multiprocessing
+import datetime as dt
+import ephem
+import numpy as np
+
+from . import gr_doppler
+from . import catalog
+from . import satellite
+from . import columnar
+from . import cache
+from . import poly
+from . import match
+from . import orbit_fit
+from . import instrument
+
+deg2rad = math.pi / 180
+rad2deg = 180 / math.pi
+
+log = logging.getLogger(__name__)
+
+def load_measurement(fp, fn, rx_center_freq, start=0, stop=0, gs=None, auto_trim=False, \
+                     trim_window=3.0, trim_k=4.0):
+    #desc:  import and trim a GNU Radio .f32 Doppler recording, or a burst
+    #       (_burst.csv, see gr_doppler.Import_Burst_Data) measurement
+    #input:
+    #   fp, fn         : path and name of measurement file, name carries the metadata
+    #   rx_center_freq : receiver center frequency [Hz]
+    #   start, stop    : samples to drop at start and end of recording
+    #   gs             : dict of gs_* metadata, gs_lat, gs_lon [deg], gs_alt [m] required
+    #   auto_trim      : find the lock span inside start/stop, see gr_doppler.Auto_Trim,
+    #                    .f32 recordings only
+    #   trim_window, trim_k : Auto_Trim window [s] and threshold, as convert_doppler
+    #output: (dataframe, metadata dict), same content as convert_doppler output
+    import pandas as pd
+    path = '/'.join([fp, fn])
+    if not os.path.isfile(path):
+        raise IOError('Invalid Doppler Measurement source file: ' + path)
+    file_md = gr_doppler.Get_Meas_File_Metadata(fn)
+    trim = None
+    if file_md['samp_rate'] == 0: #burst, one offset per packet
+        burst = gr_doppler.Import_Burst_Data(fp, fn, start, stop)
+        offsets, ts = burst['doppler_offset'].values, burst['timestamp'].values
+        if len(offsets) < 4:
+            raise ValueError('too few burst measurements for a cubic fit')
+    else:
+        data_pts = gr_doppler.gr_f32_file_mmap(path)
+        stop_idx = len(data_pts) - stop
+        if stop_idx <= start:
+            raise ValueError('no samples left after trimming')
+        if auto_trim:
+            trim = gr_doppler.Auto_Trim(data_pts[start:stop_idx], file_md['samp_rate'], trim_window, trim_k)
+            start, stop_idx = start + trim['start'], start + trim['stop']
+            stop = len(data_pts) - stop_idx
+        offsets = np.array(data_pts[start:stop_idx], dtype=float)
+        ts = gr_doppler.Meas_Time_Stamps(file_md, start, len(offsets))
+    md = {}
+    md['sat_name']      = file_md['sat_name']
+    md['receiver']      = file_md['receiver']
+    md['samp_rate_str'] = file_md['samp_rate_str']
+    md['samp_rate']     = file_md['samp_rate']
+    md['rx_center_freq']= rx_center_freq
+    md['trim_mode']     = 'auto' if auto_trim and file_md['samp_rate'] != 0 else 'manual'
+    md['trim_start']    = start
+    md['trim_stop']     = stop
+    if trim is not None: md['trim_threshold'] = trim['threshold']
+    if gs: md.update(gs)
+    df = pd.DataFrame({ 'doppler_offset':offsets,
+                        'timestamp':ts,
+                        'measured_freq':offsets + rx_center_freq},
+                      columns=['doppler_offset', 'timestamp', 'measured_freq'])
+    df.name = md['sat_name']
+    return df, md
+
+def load_converted(fp, meas_data, meas_md):
+    #desc:  import a measurement already converted by convert_doppler
+    #input:
+    #   fp        : measurement folder
+    #   meas_data : .dcol / .json / .csv Doppler file
+    #   meas_md   : .md metadata file, JSON format
+    #output: (dataframe, metadata dict)
+    fp_md = '/'.join([fp, meas_md])
+    fp_meas = '/'.join([fp, meas_data])
+    for path in [fp_md, fp_meas]:
+        if not os.path.isfile(path):
+            raise IOError('Invalid measurement file: ' + path)
+    with open(fp_md, 'r') as f:
+        md = json.load(f)
+    df = columnar.read_doppler(fp_meas)
+    df.name = md['sat_name']
+    return df, md
+
+def load_candidates(cat, norad_ids=None, intl_des=None):
+    #desc:  satellite objects for the selected catalog entries, ordered by name
+    return satellites(cat.select(norad_ids=norad_ids, intl_des=intl_des))
+
+def satellites(entries):
+    #satellite objects for a list of catalog entries
+    sats = []
+    for entry in entries:
+        ephem_sat = ephem.readtle(entry['name'], entry['line1'], entry['line2'])
+        sats.append(satellite.satellite(ephem_sat, entry['name'], entry['norad_id'], \
+                                        entry['line1'], entry['line2']))
+    return sats
+
+def generate(sats, md, timestamp, engine='batch', workers=1, el_mask=0.0, screen_step=30.0, dcache=None, \
+             stats=None):
+    #desc:  candidate Doppler curves on the measurement time grid
+    #input:
+    #   sats      : list of satellite objects
+    #   md        : measurement metadata, gs_lat, gs_lon [deg], gs_alt [m], rx_center_freq [Hz]
+    #   timestamp : numpy datetime64 array
+    #   dcache    : cache.doppler_cache or None
+    #   stats     : dict filled with run details, or None
+    #                   visible    : satellite objects that passed the screen
+    #                   max_el     : max elevation [deg] per input satellite, screen only
+    #                   cached     : curves taken from the cache
+    #                   elapsed    : generation time [s] per propagated candidate
+    #                   interp_err : max range rate error [m/s] per candidate, interp engine
+    #output: list of doppler dataframes, visible candidates only, sats order
+    if stats is None: stats = {}
+    gs = ephem.Observer()
+    gs.lat, gs.lon, gs.elevation = md['gs_lat']*deg2rad, md['gs_lon']*deg2rad, md['gs_alt']
+    if screen_step > 0:
+        sats, stats['max_el'] = satellite.Screen_Visibility(sats, gs, timestamp[0], timestamp[-1], \
+                                                            screen_step, el_mask)
+    stats['visible'] = sats
+    dopplers = [None] * len(sats)
+    keys = {}
+    jobs = []
+    job_idx = []
+    for idx, sat in enumerate(sats):
+        if dcache is not None:
+            keys[idx] = dcache.key(sat.line1, sat.line2, md['gs_lat'], md['gs_lon'], md['gs_alt'], \
+                                   md['rx_center_freq'], timestamp, engine)
+            df = dcache.get(keys[idx])
+            if df is not None:
+                #the key has no object name, label from this catalog; copy, the
+                #   in-memory cache hands the same frame to every caller
+                df = df.copy()
+                df.name = sat.sat_name +'('+ sat.norad_id + ')'
+                dopplers[idx] = df
+                continue
+        job = {}
+        job['sat_name'] = sat.sat_name
+        job['norad_id'] = sat.norad_id
+        job['line1']    = sat.line1
+        job['line2']    = sat.line2
+        job['gs_lat']   = float(gs.lat)
+        job['gs_lon']   = float(gs.lon)
+        job['gs_alt']   = float(gs.elevation)
+        job['timestamp']= timestamp
+        job['rx_freq']  = md['rx_center_freq']
+        job['engine']   = engine
+        jobs.append(job)
+        job_idx.append(idx)
+    stats['cached'] = len(sats) - len(jobs)
+    stats['elapsed'] = []
+    stats['interp_err'] = []
+    if workers > 1 and len(jobs) > 1:
+        pool = multiprocessing.Pool(workers)
+        results = pool.imap(satellite.Gen_Doppler_Job, jobs) #ordered
+    else:
+        pool = None
+        results = itertools.imap(satellite.Gen_Doppler_Job, jobs)
+    for k, (idx, res) in enumerate(zip(job_idx, results)):
+        res['doppler'].name = res['name']
+        dopplers[idx] = res['doppler']
+        stats['elapsed'].append(res['elapsed'])
+        if res['interp_err'] is not None: stats['interp_err'].append(res['interp_err'])
+        log.debug("[%3d/%3d] Generated Doppler data for %s: %3.3f [s]", k+1, len(jobs), \
+                  res['name'], res['elapsed'])
+        if dcache is not None: dcache.put(keys[idx], res['doppler'])
+    if pool is not None:
+        pool.close()
+        pool.join()
+    return dopplers
+
+def fit(dfs, interp=1, degree=3, criterion='bic', robust=None):
+    #desc:  polynomial fits, one QR solve when all series share the time grid
+    #   (same time stamps, see poly.same_time_grid), else one fit per curve
+    #   degree 0 picks the degree per curve, see poly.polyfit_adaptive_batch
+    #   robust fits the first series (the measurement) with poly.polyfit_robust,
+    #   generated curves have no outliers and keep the batch fit
+    #output: list of polynomial data dicts, name and pf
+    pfs = []
+    if robust:
+        pfs.append(poly.Doppler_Poly_Regression_idx(dfs[0], interp, False, degree, criterion, robust))
+    rest = dfs[len(pfs):]
+    if len(rest) > 0 and poly.same_time_grid(rest):
+        pfs.extend(poly.Doppler_Poly_Regression_batch(rest, interp, degree, criterion))
+    else: #different start, spacing or length, each curve on its own axis
+        if len(rest) > 1: log.info('Series are not on one time grid, fitting each curve separately')
+        pfs.extend([poly.Doppler_Poly_Regression_idx(df, interp, False, degree, criterion) for df in rest])
+    return [{'name':df.name, 'pf':pf} for df, pf in zip(dfs, pfs)]
+
+def refine(df, md, sats, name, params=['mo', 'bstar'], drift=True):
+    #desc:  differential correction of the named candidate's TLE against the
+    #       measurement, see orbit_fit.refine_tle
+    #output: refine_tle result dict plus name, line1, line2 of the input TLE
+    by_name = dict([('{:s}({:s})'.format(sat.sat_name, sat.norad_id), sat) for sat in sats])
+    if name not in by_name:
+        raise ValueError('unknown candidate: {:s}'.format(name))
+    sat = by_name[name]
+    site = (md['gs_lat']*deg2rad, md['gs_lon']*deg2rad, md['gs_alt'])
+    res = orbit_fit.refine_tle(sat.line1, sat.line2, df['timestamp'].values, df['doppler_offset'].values, \
+                               site, md['rx_center_freq'], params, True, drift)
+    res['name'] = name
+    res['sat_name'] = sat.sat_name
+    res['line1_in'] = sat.line1
+    res['line2_in'] = sat.line2
+    return res
+
+def json_serial(obj):
+    #same timestamp format doppler_polynomial writes and tle_match parses
+    if isinstance(obj, dt.datetime):
+        return obj.strftime("%Y-%m-%d %H:%M:%S.%f")
+    raise TypeError ("Type %s not serializable" % type(obj))
+
+def write_artifacts(out_folder, df, md, dopplers, poly_data):
+    #desc:  same files the four stage scripts produce, for debugging / reuse
+    #   <out_folder>/measurements : .dcol + .md of the trimmed measurement
+    #   <out_folder>/generated    : .dcol per candidate
+    #   <out_folder>/<sat_name>.json : polynomial data, tle_match input
+    meas_folder = '/'.join([out_folder, 'measurements'])
+    gen_folder = '/'.join([out_folder, 'generated'])
+    for folder in [meas_folder, gen_folder]:
+        if not os.path.isdir(folder): os.makedirs(folder)
+    ts = df['timestamp'].iloc[0].strftime("%Y%m%d_%H%M%S.%f_UTC")
+    fn = '_'.join(['DOPPLER', md['sat_name'], ts, md['samp_rate_str']])
+    columnar.write_columnar('/'.join([meas_folder, fn]) + columnar.ext, df)
+    with open('/'.join([meas_folder, fn]) + '.md', 'w') as of:
+        json.dump(md, of)
+    for dop in dopplers:
+        ts = dop['timestamp'].iloc[0].strftime("%Y%m%d_%H%M%S.%f_UTC")
+        fn = '_'.join(['DOPPLER', dop.name, ts, md['samp_rate_str']])
+        columnar.write_columnar('/'.join([gen_folder, fn]) + columnar.ext, dop)
+    with open('/'.join([out_folder, md['sat_name'] + '.json']), 'w') as outfile:
+        json.dump(poly_data, outfile, indent=4, default=json_serial)
+
+def match_measurement(df, md, sats, engine='batch', workers=1, el_mask=0.0, screen_step=30.0, \
+                      dcache=None, interp=1, rank_by='tca_delta', out_folder=None, \
+                      degree=3, criterion='bic', robust=None, refine_params=None, refine_drift=True, \
+                      report=None):
+    #desc:  generate -> fit -> match for an imported measurement
+    #input:
+    #   df, md : measurement dataframe and metadata, see load_measurement
+    #   sats   : candidate satellite objects, see load_candidates
+    #   refine_params : element names, refine the best candidate's TLE, None = no
+    #   report : instrument.run_report the stage spans are added to, None = new one
+    #   remaining arguments as in run
+    #output: dict, see run
+    if report is None: report = instrument.run_report()
+    res = {}
+    n = len(df)
+    hits, misses = (dcache.hits, dcache.misses) if dcache is not None else (0, 0)
+    with report.span('generate', samples=n, candidates=len(sats)) as sp:
+        dopplers = generate(sats, md, df['timestamp'].values, engine, workers, el_mask, screen_step, dcache)
+        sp['counts']['generated'] = len(dopplers)
+        sp['counts']['candidate_samples'] = n * len(dopplers)
+    report.count('candidates', len(sats))
+    report.count('generated', len(dopplers))
+    report.count('candidate_samples', n * len(dopplers))
+    if dcache is not None: #cache counters are cumulative, count this span only
+        sp['counts']['cache_hits'] = dcache.hits - hits
+        sp['counts']['cache_misses'] = dcache.misses - misses
+        report.count('cache_hits', dcache.hits - hits)
+        report.count('cache_misses', dcache.misses - misses)
+
+    with report.span('fit', curves=len(dopplers) + 1, samples=n * (len(dopplers) + 1)):
+        poly_data = fit([df] + dopplers, interp, degree, criterion, robust)
+
+    with report.span('match', candidates=len(dopplers)):
+        table, keys, rank_by = match.match_poly_data(poly_data[0], poly_data[1:], rank_by)
+
+    if refine_params and len(table) > 0:
+        with report.span('refine', samples=n):
+            try:
+                res['refined'] = refine(df, md, sats, table[0]['name'], refine_params, refine_drift)
+            except (ValueError, np.linalg.LinAlgError) as e: #optional stage, keep the ranking
+                log.warning('TLE refinement of %s failed: %s', table[0]['name'], str(e))
+                res['refined'] = {'name':table[0]['name'], 'error':str(e)}
+
+    if out_folder is not None:
+        with report.span('export', curves=len(dopplers) + 1):
+            write_artifacts(out_folder, df, md, dopplers, poly_data)
+
+    res['md'] = md
+    res['measurement'] = df
+    res['dopplers'] = dopplers
+    res['poly_data'] = poly_data
+    res['table'] = table
+    res['keys'] = keys
+    res['rank_by'] = rank_by
+    res['report'] = report
+    res['timing'] = report.timing()
+    return res
+
+def run(meas_folder, meas_file, rx_center_freq, gs, cat, start=0, stop=0, \
+        norad_ids=None, intl_des=None, engine='batch', workers=1, el_mask=0.0, \
+        screen_step=30.0, dcache=None, interp=1, rank_by='tca_delta', out_folder=None, \
+        degree=3, criterion='bic', robust=None, auto_trim=False, refine_params=None, refine_drift=True, \
+        report=None, trim_window=3.0, trim_k=4.0):
+    #desc:  .f32 recording to ranked candidate table in one call
+    #input:
+    #   meas_folder, meas_file : GNU Radio .f32 recording
+    #   rx_center_freq         : receiver center frequency [Hz]
+    #   gs                     : dict of gs_* metadata, gs_lat, gs_lon [deg], gs_alt [m]
+    #   cat                    : catalog.tle_catalog with the candidates
+    #   out_folder             : write intermediate files here, None = in memory only
+    #   report                 : instrument.run_report to add the stage spans to, None = new one
+    #   remaining arguments as in the stage scripts
+    #output: dict
+    #   md, measurement, dopplers, poly_data : stage outputs
+    #   table, keys, rank_by                 : ranked candidates, see match.match_poly_data
+    #   refined                              : refined TLE of the best candidate, see refine,
+    #                                          name and error only if refinement failed
+    #   report                               : instrument.run_report with the stage spans
+    #   timing                               : list of (stage, elapsed [s])
+    if report is None: report = instrument.run_report()
+    with report.span('import') as sp:
+        df, md = load_measurement(meas_folder, meas_file, rx_center_freq, start, stop, gs, auto_trim, \
+                                  trim_window, trim_k)
+        sats = load_candidates(cat, norad_ids, intl_des)
+        sp['counts']['samples'] = len(df)
+        sp['counts']['candidates'] = len(sats)
+    report.count('samples', len(df))
+    return match_measurement(df, md, sats, engine, workers, el_mask, screen_step, dcache, \
+                             interp, rank_by, out_folder, degree, criterion, robust, \
+                             refine_params, refine_drift, report)
@@ -8,27 +8,28 @@
 import sys
 import os
 import math
-import string
-import struct
+import multiprocessing
 import numpy as np
-import scipy
 import datetime as dt
-import pytz
-import pandas as pd
 
-import matplotlib.pyplot as plt
-import matplotlib.mlab as mlab
-from matplotlib.dates import DateFormatter
-from matplotlib.ticker import MultipleLocator, FormatStrFormatter
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 import matplotlib.dates as mdates
-import matplotlib.colors as colors
+#pyplot is imported by the interactive plot_* functions only, it selects a
+#GUI backend on import, the report renderer below uses Agg figures directly
 
 
 deg2rad = math.pi / 180
 rad2deg = 180 / math.pi
 c       = float(299792458)    #[m/s], speed of light
 
+def date_axis(timestamp):
+    #numpy datetime64 array -> matplotlib date numbers, vectorized
+    ns = np.asarray(timestamp).astype('datetime64[ns]').astype(np.int64)
+    return mdates.epoch2num(ns / 1e9)
+
 def plot_2poly_ts(idx, reg_x, p1,p2, o_path, save = 0):
+    import matplotlib.pyplot as plt
     a = p1['name'] + '_' + p2['name']
     x = reg_x
     y1 = p1['pf']['equation']
@@ -86,6 +87,7 @@ def plot_2poly_ts(idx, reg_x, p1,p2, o_path, save = 0):
 
 
 def plot_multi_doppler_ts(idx, dfs, o_path, save=0):
+    import matplotlib.pyplot as plt
     #---- START Figure 1 ----
     xinch = 14
     yinch = 7
@@ -106,7 +108,7 @@ def plot_multi_doppler_ts(idx, dfs, o_path, save=0):
 
     #Plot doppler curves
     for df in dfs:
-        x = [dt.datetime.utcfromtimestamp(element*1e-9) for element in df['timestamp'].values.tolist()] #independent variable, input
+        x = date_axis(df['timestamp'].values) #independent variable, input
         if 'FOX' in df.name: col = 'r'
         else: col = 'b'
         ax1.plot(x, df['doppler_offset'], \
@@ -114,6 +116,7 @@ def plot_multi_doppler_ts(idx, dfs, o_path, save=0):
                     label="{:s}".format(df.name), markersize=1, markeredgewidth=0)
 
     #Formate X Axis Timestamps
+    ax1.xaxis_date()
     ax1.xaxis.set_major_formatter(mdates.DateFormatter("%Y-%m-%d\n %H:%M:%S"))
     #ax1.set_xlim(x2[0] - dt.timedelta(minutes = 30), x2[-1] +  dt.timedelta(minutes=30))
 
@@ -142,6 +145,7 @@ def plot_multi_doppler_ts(idx, dfs, o_path, save=0):
     return idx
 
 def plot_offset_idx(idx, df, o_path, save = 0):
+    import matplotlib.pyplot as plt
     a = df.name
     x = df.index.values.tolist() #independent variable, input
     y = df['doppler_offset'].values.tolist()
@@ -182,8 +186,9 @@ def plot_offset_idx(idx, df, o_path, save = 0):
     return idx
 
 def plot_offset_ts(idx, df, o_path, save = 0):
+    import matplotlib.pyplot as plt
     a = df.name
-    x = [dt.datetime.utcfromtimestamp(element*1e-9) for element in df['timestamp'].values.tolist()] #independent variable, input
+    x = date_axis(df['timestamp'].values) #independent variable, input
     y = df['doppler_offset'].values.tolist()
     #---- START Figure 1 ----
     xinch = 14
@@ -208,6 +213,7 @@ def plot_offset_ts(idx, df, o_path, save = 0):
     ax1.plot(x, df['doppler_offset'], linestyle = '-', label="{:s}".format(a), markersize=1, markeredgewidth=0)
 
     #Formate X Axis Timestamps
+    ax1.xaxis_date()
     ax1.xaxis.set_major_formatter(mdates.DateFormatter("%Y-%m-%d\n %H:%M:%S"))
     #ax1.set_xlim(x2[0] - dt.timedelta(minutes = 30), x2[-1] +  dt.timedelta(minutes=30))
 
@@ -234,3 +240,135 @@ def plot_offset_ts(idx, df, o_path, save = 0):
     #plt.close(fig1)
     idx += 1
     return idx
+
+#-------- Batch report rendering ------------------------------------------------
+def downsample(x, y, max_points):
+    #desc:  min/max decimation for plotting long series, keeps spikes and
+    #       lock slips visible.  Each bucket contributes its min and max
+    #       sample, in time order.
+    #input:  x, y numpy arrays, max_points <= 0 disables
+    #output: (x, y)
+    n = len(y)
+    if max_points <= 0 or n <= max_points:
+        return x, y
+    buckets = max(max_points // 2, 1)
+    size = n // buckets
+    yb = y[:buckets * size].reshape(buckets, size)
+    base = np.arange(buckets) * size
+    idx = np.concatenate([base + np.argmin(yb, axis=1), base + np.argmax(yb, axis=1), \
+                          np.arange(buckets * size, n)])
+    idx = np.unique(idx) #sorted, min == max buckets only once
+    return x[idx], y[idx]
+
+def new_figure(xinch=14, yinch=7):
+    #Agg figure without pyplot, safe in worker processes and headless runs
+    fig = Figure(figsize=(xinch, yinch/.8))
+    FigureCanvasAgg(fig)
+    return fig
+
+def format_time_axis(ax):
+    ax.xaxis_date()
+    ax.xaxis.set_major_formatter(mdates.DateFormatter("%Y-%m-%d\n %H:%M:%S"))
+    for label in ax.xaxis.get_ticklabels():
+        label.set_rotation(45)
+    ax.xaxis.grid(True,'major', linewidth=1)
+    ax.yaxis.grid(True,'major', linewidth=1)
+
+def render_comparison(job):
+    #desc:  measurement vs one candidate, Doppler offset and residual panels
+    #input:  job dict from comparison_jobs
+    #output: figure file path
+    fig = new_figure()
+    ax1 = fig.add_subplot(2,1,1)
+    ax2 = fig.add_subplot(2,1,2, sharex=ax1)
+    ax1.plot(job['meas_x'], job['meas_y'], color='r', linestyle='-', label=job['meas_name'])
+    ax1.plot(job['cand_x'], job['cand_y'], color='b', linestyle='-', label=job['cand_name'])
+    ax1.set_ylabel('Doppler Offset [Hz]')
+    ax1.set_title(job['title'])
+    ax1.legend(loc='upper right', numpoints=1, prop={'size': 9})
+    if job['res_x'] is not None:
+        ax2.plot(job['res_x'], job['res_y'], color='k', linestyle='-', label='Measured - Generated')
+        ax2.legend(loc='upper right', numpoints=1, prop={'size': 9})
+    ax2.set_xlabel('Time [UTC]')
+    ax2.set_ylabel('Residual [Hz]')
+    for ax in [ax1, ax2]: format_time_axis(ax)
+    for label in ax1.get_xticklabels(): label.set_visible(False) #shared with the residual panel
+    fig.subplots_adjust(bottom=0.15, hspace=0.3)
+    fig.savefig(job['path'], dpi=job['dpi'])
+    return job['path']
+
+def render_overview(job):
+    #desc:  measurement and all candidates on one axes, plot_multi_doppler_ts
+    fig = new_figure()
+    ax1 = fig.add_subplot(1,1,1)
+    for name, x, y in job['curves']:
+        ax1.plot(x, y, color='b', linestyle='-', linewidth=0.5)
+    ax1.plot(job['meas_x'], job['meas_y'], color='r', linestyle='-', label=job['meas_name'])
+    ax1.set_xlabel('Time [UTC]')
+    ax1.set_ylabel('Doppler Offset [Hz]')
+    ax1.set_title('{:s} Doppler Offset [Hz], {:d} candidates'.format(job['meas_name'], len(job['curves'])))
+    ax1.legend(loc='upper right', numpoints=1, prop={'size': 9})
+    format_time_axis(ax1)
+    fig.subplots_adjust(bottom=0.2)
+    fig.savefig(job['path'], dpi=job['dpi'])
+    return job['path']
+
+def comparison_jobs(meas, dopplers, table, o_path, max_points=2000, top=None, dpi=100):
+    #desc:  figure jobs for a ranked match, plain numpy arrays so they pickle
+    #       cheaply to worker processes
+    #input:
+    #   meas       : measurement dataframe, timestamp and doppler_offset
+    #   dopplers   : candidate dataframes, name matches the table rows
+    #   table      : ranked candidate table, see match.match_poly_data
+    #   max_points : downsample series longer than this, 0 = never
+    #   top        : number of ranked candidates to render, default all
+    #output: list of job dicts
+    mx = date_axis(meas['timestamp'].values)
+    my = meas['doppler_offset'].values.astype(float)
+    meas_x, meas_y = downsample(mx, my, max_points)
+    by_name = dict([(d.name, d) for d in dopplers])
+    rows = table if top is None else table[:top]
+    jobs = []
+    for row in rows:
+        if row['name'] not in by_name: continue
+        cand = by_name[row['name']]
+        cx = date_axis(cand['timestamp'].values)
+        cy = cand['doppler_offset'].values.astype(float)
+        job = {}
+        job['meas_name'] = meas.name
+        job['cand_name'] = row['name']
+        job['meas_x'], job['meas_y'] = meas_x, meas_y
+        job['cand_x'], job['cand_y'] = downsample(cx, cy, max_points)
+        job['res_x'], job['res_y'] = None, None
+        if len(cy) == len(my): #generated on the measurement grid
+            job['res_x'], job['res_y'] = downsample(mx, my - cy, max_points)
+        job['title'] = '{:s} vs {:s}, Rank {:d}, TCA Delta [s]: {:3.3f}'.format(meas.name, row['name'], \
+                                                                             row['rank'], row['tca_delta'])
+        fn = '{:03d}_{:s}.png'.format(row['rank'], row['name'].replace('/', '_').replace(' ', '_'))
+        job['path'] = '/'.join([o_path, fn])
+        job['dpi'] = dpi
+        jobs.append(job)
+    return jobs
+
+def render_report(meas, dopplers, table, o_path, workers=1, max_points=2000, top=None, dpi=100):
+    #desc:  headless batch report, one comparison figure per ranked candidate
+    #       plus an overview, rendered across a process pool
+    #input:  see comparison_jobs, workers = number of processes, 1 = serial
+    #output: list of written figure paths, overview first
+    if not os.path.isdir(o_path): os.makedirs(o_path)
+    jobs = comparison_jobs(meas, dopplers, table, o_path, max_points, top, dpi)
+    overview = {'meas_name':meas.name, 'dpi':dpi, 'path':'/'.join([o_path, '000_overview.png'])}
+    overview['meas_x'], overview['meas_y'] = downsample(date_axis(meas['timestamp'].values), \
+                                                        meas['doppler_offset'].values.astype(float), max_points)
+    overview['curves'] = [(d.name,) + downsample(date_axis(d['timestamp'].values), \
+                                                 d['doppler_offset'].values.astype(float), max_points) \
+                          for d in dopplers]
+    paths = [render_overview(overview)]
+    if workers > 1 and len(jobs) > 1:
+        pool = multiprocessing.Pool(workers)
+        paths.extend(pool.map(render_comparison, jobs))
+        pool.close()
+        pool.join()
+    else:
+        paths.extend([render_comparison(job) for job in jobs])
+    return paths
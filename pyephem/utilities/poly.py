@@ -8,19 +8,16 @@
 import sys
 import os
 import math
-import string
-import struct
-import numpy
-import scipy
+import logging
 import datetime as dt
-import pandas as pd
-import matplotlib.pyplot as plt
 import numpy as np
-from scipy.interpolate import *
 
 deg2rad = math.pi / 180
 rad2deg = 180 / math.pi
 c       = float(299792458)    #[m/s], speed of light
+max_auto_degree = 8           #highest degree tried by the adaptive fits
+
+log = logging.getLogger(__name__)
 
 def Find_File_Names(path):
     #--return list of all filenames in 'folder'------------
@@ -45,10 +42,11 @@ def Find_Dir_Names(folder):
 
 # Polynomial Regression
 def polyfit(x, y, reg_x, degree):
+    #reg_x = None skips evaluating the regression equation, only needed for plots
     results = {}
     coeffs = np.polyfit(x, y, degree)
-    equation = np.polyval(coeffs, reg_x)
-    results['equation'] = equation
+    if reg_x is not None:
+        results['equation'] = np.polyval(coeffs, reg_x)
     results['degree'] = degree
     # Polynomial Coefficients
     results['polynomial'] = coeffs.tolist()
@@ -62,91 +60,344 @@ def polyfit(x, y, reg_x, degree):
     results['determination'] = ssreg / sstot
     return results
 
+def polyfit_robust(x, y, reg_x, degree, method='huber', max_iter=30, tol=1e-8):
+    #desc:  outlier resistant polyfit, iteratively reweighted least squares.
+    #       Residual scale is the MAD of the current residuals, weights from
+    #       the Huber or Tukey bisquare function.  Each iteration is one QR
+    #       of the weighted, column scaled Vandermonde matrix.
+    #input:
+    #   x, y, reg_x, degree : as polyfit
+    #   method              : 'huber' or 'bisquare'
+    #output: polyfit dict plus
+    #   'rejected' : indices of samples treated as outliers, |residual| above
+    #                the bisquare cutoff / 3 sigma for huber
+    #   'scale'    : robust residual standard deviation
+    #   'iterations'
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    k = 1.345 if method == 'huber' else 4.685 #95% efficiency tuning constants
+    V = np.vander(x, degree + 1)
+    col = np.sqrt(np.sum(V * V, axis=0))
+    Vs = V / col
+    w = np.ones(len(x))
+    coeffs = np.zeros(degree + 1)
+    for it in range(max_iter):
+        sw = np.sqrt(w)
+        Q, R = np.linalg.qr(Vs * sw[:, np.newaxis])
+        new = np.linalg.solve(R, np.dot(Q.T, sw * y)) / col
+        r = y - np.dot(V, new)
+        scale = 1.4826 * np.median(np.abs(r - np.median(r)))
+        if scale <= 0: scale = np.std(r) if np.std(r) > 0 else 1.0
+        u = np.abs(r) / scale
+        if method == 'huber':
+            w = np.where(u <= k, 1.0, k / np.maximum(u, 1e-300))
+        else:
+            w = np.where(u < k, (1.0 - (u / k)**2)**2, 0.0)
+        done = np.max(np.abs(new - coeffs)) <= tol * max(np.max(np.abs(new)), 1.0)
+        coeffs = new
+        if done: break
+    cutoff = k if method == 'bisquare' else 3.0
+    results = {}
+    if reg_x is not None:
+        results['equation'] = np.polyval(coeffs, reg_x)
+    results['degree'] = degree
+    results['polynomial'] = coeffs.tolist()
+    good = u <= cutoff
+    yhat = np.dot(V, coeffs)
+    ybar = np.mean(y[good])
+    results['determination'] = np.sum((yhat[good] - ybar)**2) / np.sum((y[good] - ybar)**2)
+    results['rejected'] = np.nonzero(~good)[0].tolist()
+    results['scale'] = float(scale)
+    results['iterations'] = it + 1
+    return results
+
 def polydiff(x, coeffs):
     results = {}
-    coeffs_prime = []
-    for i in range(len(coeffs)-1):
-        coeffs_prime.append(coeffs[i]*(len(coeffs) - 1 - i))
-    #print len(coeffs), len(coeffs_prime)
-    #print coeffs, coeffs_prime
-    reg_idx = 0
+    coeffs_prime = np.polyder(np.asarray(coeffs, dtype=float))
     results['equation'] = np.polyval(coeffs_prime, x)
-    for i in range(len(results['equation'])):
-        if results['equation'][i] == min(results['equation']):
-            results['min_idx'] = i
-            break
+    results['min_idx'] = int(np.argmin(results['equation'])) #first minimum, like the old loop
+    return results
+
+def polytca(coeffs, x0, x1):
+    #desc:  closed form TCA, location of the minimum of the derivative of the
+    #       doppler polynomial on [x0, x1].  No regression grid is evaluated,
+    #       cost doesn't depend on pass length.
+    #input:
+    #   coeffs : polynomial coefficients, highest power first
+    #   x0, x1 : interval of valid data, same units as the polynomial x
+    #output: x location of TCA, float with sub-sample precision
+    #   candidates are the critical points of the derivative inside the
+    #   interval (real roots of the 2nd derivative) and the interval ends.
+    #   for the cubic fits this is the inflection point x = -b/(3a).
+    coeffs_prime = np.polyder(np.asarray(coeffs, dtype=float))
+    coeffs_2prime = np.polyder(coeffs_prime)
+    cand = [float(x0), float(x1)]
+    if len(coeffs_2prime) > 1 and np.any(coeffs_2prime[:-1] != 0):
+        roots = np.roots(coeffs_2prime)
+        roots = roots[np.abs(roots.imag) < 1e-9].real
+        cand.extend(roots[(roots > x0) & (roots < x1)].tolist())
+    cand = np.array(cand)
+    return float(cand[np.argmin(np.polyval(coeffs_prime, cand))])
+
+def polyfit_batch(x, Y, degree):
+    #desc:  least squares fit of many curves sharing the same x grid.
+    #       The Vandermonde matrix is factored once (QR) and all curves
+    #       are solved together as a multi right hand side problem.
+    #input:
+    #   x      : (n,) shared independent variable
+    #   Y      : (n, N) dependent variable, one curve per column
+    #   degree : polynomial degree
+    #output: dict with
+    #   'polynomial'    : (N, degree+1) coefficients, highest power first
+    #   'determination' : (N,) r-squared, same definition as polyfit
+    x = np.asarray(x, dtype=float)
+    Y = np.asarray(Y, dtype=float)
+    if Y.ndim == 1: Y = Y[:, np.newaxis]
+    V = np.vander(x, degree + 1)
+    scale = np.sqrt(np.sum(V * V, axis=0)) #column scaling, like np.polyfit
+    Q, R = np.linalg.qr(V / scale)
+    QtY = np.dot(Q.T, Y)
+    coeffs = np.linalg.solve(R, QtY) / scale[:, np.newaxis]
+    yhat = np.dot(Q, QtY)
+    ybar = np.mean(Y, axis=0)
+    ssreg = np.sum((yhat - ybar)**2, axis=0)
+    sstot = np.sum((Y - ybar)**2, axis=0)
+    results = {}
+    results['degree'] = degree
+    results['polynomial'] = coeffs.T
+    results['determination'] = ssreg / sstot
+    return results
+
+def polytca_batch(coeffs, x0, x1):
+    #desc:  polytca for many curves, coeffs is (N, degree+1)
+    #       cubic fits are solved in closed form across all curves at once
+    #output: (N,) TCA x locations
+    coeffs = np.asarray(coeffs, dtype=float)
+    if coeffs.shape[1] != 4:
+        return np.array([polytca(c, x0, x1) for c in coeffs])
+    a, b, cc = coeffs[:, 0], coeffs[:, 1], coeffs[:, 2]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        infl = -b / (3.0 * a)
+    infl = np.where(np.isfinite(infl) & (infl > x0) & (infl < x1), infl, x0)
+    cand = np.array([np.full(len(a), float(x0)), np.full(len(a), float(x1)), infl]) #(3,N)
+    slope = 3.0 * a * cand**2 + 2.0 * b * cand + cc
+    return cand[np.argmin(slope, axis=0), np.arange(len(a))]
+
+def cheb_to_power(coeffs, lo, hi):
+    #Chebyshev series on u = (2x - (lo+hi)) / (hi-lo) -> power series in x,
+    #highest power first like np.polyfit
+    a = 2.0 / (hi - lo)
+    b = -(lo + hi) / (hi - lo)
+    pu = np.polynomial.chebyshev.cheb2poly(coeffs) #power series in u, lowest first
+    p = np.array([pu[-1]])
+    for k in range(len(pu) - 2, -1, -1): #Horner in u = a*x + b
+        p = np.polynomial.polynomial.polymul(p, [b, a])
+        p[0] += pu[k]
+    return p[::-1]
+
+def polyfit_adaptive_batch(x, Y, max_degree=max_auto_degree, criterion='bic'):
+    #desc:  least squares fits of every degree up to max_degree from one QR
+    #       factorization of a Chebyshev basis on normalized x, degree picked
+    #       per curve by information criterion.  The first k columns of Q span
+    #       the degree k-1 model, so the residual of every degree comes from
+    #       one cumulative sum instead of a refit.
+    #input:
+    #   x          : (n,) shared independent variable
+    #   Y          : (n, N) dependent variable, one curve per column
+    #   criterion  : 'aic' or 'bic'
+    #output: dict with
+    #   'degree'        : (N,) selected degrees
+    #   'polynomial'    : list of N power series coefficient lists, highest power first
+    #   'chebyshev'     : list of N Chebyshev coefficient lists, lowest first, on 'domain'
+    #   'domain'        : [lo, hi] of x
+    #   'determination' : (N,) r-squared
+    x = np.asarray(x, dtype=float)
+    Y = np.asarray(Y, dtype=float)
+    if Y.ndim == 1: Y = Y[:, np.newaxis]
+    n = len(x)
+    max_degree = max(1, min(max_degree, n - 2))
+    lo, hi = float(np.min(x)), float(np.max(x))
+    u = (2.0 * x - (lo + hi)) / (hi - lo)
+    Q, R = np.linalg.qr(np.polynomial.chebyshev.chebvander(u, max_degree))
+    QtY = np.dot(Q.T, Y) #(D+1, N)
+    rss = np.sum(Y * Y, axis=0) - np.cumsum(QtY * QtY, axis=0) #(D+1, N), rss[d] for degree d
+    rss = np.maximum(rss, 1e-300)
+    k = np.arange(1, max_degree + 2, dtype=float)[:, np.newaxis] #parameters per degree
+    penalty = 2.0 * k if criterion == 'aic' else k * np.log(n)
+    ic = n * np.log(rss / n) + penalty
+    ic[0] = np.inf #constant model never describes a pass
+    degree = np.argmin(ic, axis=0)
+    sstot = np.sum((Y - np.mean(Y, axis=0))**2, axis=0)
+    results = {}
+    results['degree'] = degree
+    results['domain'] = [lo, hi]
+    results['chebyshev'] = [None] * Y.shape[1]
+    results['polynomial'] = [None] * Y.shape[1]
+    for d in np.unique(degree): #one triangular solve per distinct degree
+        cols = np.nonzero(degree == d)[0]
+        cc = np.linalg.solve(R[:d+1, :d+1], QtY[:d+1, cols])
+        for j, col in enumerate(cols):
+            results['chebyshev'][col] = cc[:, j].tolist()
+            results['polynomial'][col] = cheb_to_power(cc[:, j], lo, hi).tolist()
+    results['determination'] = 1.0 - rss[degree, np.arange(Y.shape[1])] / sstot
     return results
 
-def findBestFit(time_stamps, offsets, reg_x):
-    #-Initialize variables---
+def polyfit_adaptive(x, y, reg_x=None, max_degree=max_auto_degree, criterion='bic'):
+    #single curve polyfit_adaptive_batch, same output fields as polyfit
+    fit = polyfit_adaptive_batch(x, y, max_degree, criterion)
     results = {}
-    idx = 1
-    r2 = 0
-    reg_eq = None
-    coeffs = None
-    #-cycle through polyfits trying to maximize r-squared
-    while 1:
-        pf = polyfit(time_stamps, offsets, reg_x, idx)  #do the polyfit
-        r2_last = r2    #save the previous r2 value
-        r2 = pf['determination'] #get the new r2 value from most recent polyfit
-        #print pf['degree'], len(pf['polynomial']), pf['determination']
-        if r2 > r2_last: #compare R2 values, if current is better than previous
-            #print pf['degree'], len(pf['polynomial']), pf['determination']
-            results['polynomial']       = pf['polynomial'] #store coefficients
-            results['equation']         = pf['equation'] #store regresseion equation
-            results['degree']           = pf['degree']
-            results['determination']    = pf['determination']
-            idx = idx + 1 #increment polynomial degree
-        else:break #if most recent R2 value is less than previous, break and keep old values.
-    #os.system('clear')
+    if reg_x is not None:
+        results['equation'] = np.polyval(fit['polynomial'][0], reg_x)
+    results['degree'] = int(fit['degree'][0])
+    results['polynomial'] = fit['polynomial'][0]
+    results['chebyshev'] = fit['chebyshev'][0]
+    results['domain'] = fit['domain']
+    results['determination'] = float(fit['determination'][0])
     return results
 
+def findBestFit(time_stamps, offsets, reg_x, criterion='bic'):
+    #best degree polynomial, see polyfit_adaptive.  Used to refit every
+    #degree and stop when r-squared stopped improving, which on dense
+    #data never stops and keeps adding ill conditioned power terms.
+    pf = polyfit_adaptive(time_stamps, offsets, reg_x, criterion=criterion)
+    results = {}
+    results['polynomial']       = pf['polynomial']
+    results['equation']         = pf['equation']
+    results['degree']           = pf['degree']
+    results['determination']    = pf['determination']
+    return results
+
+
+def Regression_Axis(df, tol_ns=1000):
+    #desc:  regression x axis for a Doppler series
+    #   uniform grid (continuous FLL output): x = data index, t_step = sample spacing
+    #   irregular (burst, one offset per packet): x = seconds since first
+    #       sample, t_step = 1.0, so x still maps to time as start + (x - x0) * t_step
+    #   sample rate time stamps are integer ns, steps may differ by a ns or so
+    #output: x, t_step [s], len (number of t_step spaced points covering the series)
+    ns = df['timestamp'].values.astype('datetime64[ns]').astype(np.int64)
+    step = np.diff(ns)
+    if len(step) == 0: #single sample, no spacing to take
+        return df.index.values.astype(float), 0.0, len(df)
+    if len(step) < 2 or np.all(np.abs(step - step[0]) <= tol_ns):
+        return df.index.values.astype(float), step[0] / 1e9, len(df)
+    x = (ns - ns[0]) / 1e9
+    return x, 1.0, int(np.floor(x[-1])) + 1
 
-def Doppler_Poly_Regression_idx(df, interp=1):
+def check_fit_length(n, degree):
+    #a degree d fit needs d+1 samples, degree 0 (adaptive) at least a line
+    need = max(degree, 1) + 1
+    if n < need:
+        raise ValueError('{:d} sample(s), a degree {:d} fit needs at least {:d}'.format(n, degree, need))
+
+def same_time_grid(dfs, tol_ns=1000):
+    #True if all series have the same time stamps (within tol_ns), so they
+    #share one regression axis and can be fit in one batch
+    if len(dfs) == 0: return True
+    ref = dfs[0]['timestamp'].values.astype('datetime64[ns]').astype(np.int64)
+    for df in dfs[1:]:
+        if len(df) != len(ref): return False
+        ns = df['timestamp'].values.astype('datetime64[ns]').astype(np.int64)
+        if np.any(np.abs(ns - ref) > tol_ns): return False
+    return True
+
+def Doppler_Poly_Regression_idx(df, interp=1, equation=False, degree=3, criterion='bic', robust=None):
     #3rd order polynomail regression of doppler data
     #df = dataframe containing 'doppler_offset' field.
-    #interp is the value to interpolate between data points.
+    #degree = polynomial degree, 0 = pick per curve with criterion ('aic'/'bic')
+    #robust = None, 'huber' or 'bisquare', outlier resistant fit, see polyfit_robust
+    #interp is the value to interpolate between data points, only used
+    #   for the regression equation (plotting), TCA is solved analytically
+    #equation = 1, also return the regression equation on the interp grid
     #Returns polyfit data
 
-    #time step between data points
-    t_step_data = (df['timestamp'][1] - df['timestamp'][0]).total_seconds()
+    #regression x axis, data index, or seconds for burst measurements
+    check_fit_length(len(df), degree)
+    x, t_step_data, length = Regression_Axis(df)
+    reg_x = None
+    if equation:
+        reg_x = np.arange(x[0], x[-1]+1, 1.0/interp)
 
-    #time step between regression points
-    t_step_reg = t_step_data/interp
+    #do the polyfit
+    if robust:
+        if degree == 0: #degree from the plain fit, then reweighted at that degree
+            degree = polyfit_adaptive(x, df['doppler_offset'].values, criterion=criterion)['degree']
+        pf = polyfit_robust(x, df['doppler_offset'].values, reg_x, degree, robust)
+    elif degree == 0:
+        pf = polyfit_adaptive(x, df['doppler_offset'].values, reg_x, criterion=criterion)
+    else:
+        pf = polyfit(x, df['doppler_offset'].values, reg_x, degree)
+    pf['len_reg_x'] = int(np.ceil((x[-1] + 1 - x[0]) * interp))
+    #differentiate the regression to find TCA, fractional data index
+    pf['tca_x'] = polytca(pf['polynomial'], x[0], x[-1])
+    pf['tca_idx'] = int(round((pf['tca_x'] - x[0]) * interp)) #index on interp grid
 
-    #generate regression x axis
-    reg_x = np.arange(df.index.values.tolist()[0], df.index.values.tolist()[-1]+1,1/interp)
+    #grab timestamp, increment with timedelta to account for fractional index
+    t0 = df['timestamp'].iloc[0].to_pydatetime()
+    pf['tca_utc'] = t0 + dt.timedelta(seconds=(pf['tca_x'] - x[0]) * t_step_data)
+    #time axis of the fit, t = start_utc + (x - x0) * t_step, for curve matching
+    pf['start_utc'] = t0
+    pf['t_step'] = t_step_data
+    pf['x0'] = float(x[0])
+    pf['len'] = length
 
-    #do the polyfit
-    pf = polyfit(df.index.values.tolist(), df['doppler_offset'].values.tolist(), reg_x, 3)
-    pf['len_reg_x'] = len(reg_x)
-    #differentiate the regression to find TCA idx
-    pd_reg = polydiff(reg_x, pf['polynomial'])
-    pf['tca_idx'] = pd_reg['min_idx']
+    #log results, fit detail only at debug level
+    if robust:
+        log.info("  Robust fit (%s), rejected samples: %d of %d, scale [Hz]: %3.3f", robust, \
+                 len(pf['rejected']), len(df), pf['scale'])
+    if log.isEnabledFor(logging.DEBUG):
+        log_fit(pf)
+    return pf
 
-    data_idx = pf['tca_idx']//interp #quotient, no remainder
-    reg_rem = pf['tca_idx']%interp*t_step_reg #remainder
+def log_fit(pf):
+    log.debug("         Coefficient of Determination, R-Squared: %s", pf['determination'])
+    log.debug("      Time Stamp of Inflection Point, Regression: %s", pf['tca_x'])
+    log.debug("Frequency Offset at Inflection Point, Regression: %s", np.polyval(pf['polynomial'], pf['tca_x']))
+    log.debug("    Time Stamp of Inflection Point, Interpolated: %s", pf['tca_utc'])
 
-    #grab timestamp, increment with timedelta to account for interpolation
-    pf['tca_utc'] = df['timestamp'][data_idx] + dt.timedelta(seconds=reg_rem)
 
-    #print results
-    print "         Coefficient of Determination, R-Squared: ", pf['determination']
-    print "      Time Stamp of Inflection Point, Regression: ", pf['tca_idx']
-    print "Frequency Offset at Inflection Point, Regression: ", pf['equation'][pf['tca_idx']]
-    print "    Time Stamp of Inflection Point, Interpolated: ", pf['tca_utc']
 
-    #pf_prime is a hack.  Don't need 'equation' in returned data in this function
-    #but too lazy to change other functions
-    pf_prime = {}
-    for k in pf.keys():
-        if k != 'equation': pf_prime[k] = pf[k]
-    return pf_prime
 
+def Doppler_Poly_Regression_batch(dfs, interp=1, degree=3, criterion='bic'):
+    #Batch version of Doppler_Poly_Regression_idx for a list of dataframes
+    #sharing the same time grid (generated curves use the measurement time
+    #stamps), all cubic fits are done in one linear algebra call.
+    #Returns list of polyfit data, same fields as Doppler_Poly_Regression_idx
+    if not same_time_grid(dfs):
+        raise ValueError('Batch regression needs series on the same time grid')
+    check_fit_length(len(dfs[0]), degree)
+    x, t_step_data, length = Regression_Axis(dfs[0]) #candidates use the measurement time stamps
+    Y = np.column_stack([df['doppler_offset'].values for df in dfs])
+    if degree == 0: #degree per curve, still one QR for all of them
+        fit = polyfit_adaptive_batch(x, Y, criterion=criterion)
+        tca_x = np.array([polytca(p, x[0], x[-1]) for p in fit['polynomial']])
+    else:
+        fit = polyfit_batch(x, Y, degree)
+        tca_x = polytca_batch(fit['polynomial'], x[0], x[-1])
 
+    pfs = []
+    for i, df in enumerate(dfs):
+        pf = {}
+        pf['degree'] = int(fit['degree'][i]) if degree == 0 else fit['degree']
+        pf['polynomial'] = np.asarray(fit['polynomial'][i]).tolist()
+        pf['determination'] = float(fit['determination'][i])
+        pf['len_reg_x'] = int(np.ceil((x[-1] + 1 - x[0]) * interp))
+        pf['tca_x'] = float(tca_x[i])
+        pf['tca_idx'] = int(round((pf['tca_x'] - x[0]) * interp))
+        t0 = df['timestamp'].iloc[0].to_pydatetime()
+        pf['tca_utc'] = t0 + dt.timedelta(seconds=(pf['tca_x'] - x[0]) * t_step_data)
+        pf['start_utc'] = t0
+        pf['t_step'] = t_step_data
+        pf['x0'] = float(x[0])
+        pf['len'] = length
 
+        if log.isEnabledFor(logging.DEBUG):
+            log_fit(pf)
+        pfs.append(pf)
+    return pfs
 
 def Doppler_Regression_old(df):
+    import matplotlib.pyplot as plt
     # Input Files:
     #timestamp = [dt.datetime.utcfromtimestamp(element*1e-9) for element in df['timestamp'].values.tolist()]
     timestamp = [(np.datetime64(element, 'ns').astype('uint64')/1e6).astype('uint32') for element in df['timestamp'].values.tolist()]
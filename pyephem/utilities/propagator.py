@@ -0,0 +1,504 @@
+#!/usr/bin/env python
+#############################################
+#   Title: Vectorized SGP4 propagator       #
+# Project: TLE Match                        #
+#    Date: Jan 2018                         #
+#  Author: Zach Leffke, KJ4QLP              #
+#############################################
+#   Array-at-a-time port of the near earth SGP4 model (Vallado, 'Revisiting
+#   Spacetrack Report #3', WGS72 constants).  Times are numpy datetime64
+#   arrays, element sets can be stacked so N candidates x T timestamps are
+#   propagated in one call.  Deep space (SDP4) objects are flagged and left
+#   to pyephem.
+import math
+import numpy as np
+
+deg2rad = math.pi / 180
+rad2deg = 180 / math.pi
+c       = float(299792458)    #[m/s], speed of light
+
+#--WGS72 gravity model, same as Spacetrack Report #3
+mu            = 398600.8            #[km^3/s^2]
+radiusearthkm = 6378.135            #[km]
+xke           = 60.0 / math.sqrt(radiusearthkm**3 / mu)
+j2            = 0.001082616
+j3            = -0.00000253881
+j4            = -0.00000165597
+j3oj2         = j3 / j2
+x2o3          = 2.0 / 3.0
+twopi         = 2.0 * math.pi
+vkmpersec     = radiusearthkm * xke / 60.0
+xpdotp        = 1440.0 / twopi      #[rev/day]/[rad/min]
+
+#--WGS84 ellipsoid, ground station location
+wgs84_a       = 6378.137            #[km]
+wgs84_f       = 1 / 298.257223563
+wgs84_e2      = wgs84_f * (2 - wgs84_f)
+omega_earth   = 7.292115146706979e-5 #[rad/s]
+
+def tle_checksum(line):
+    #Modulo 10 checksum over first 68 characters of a TLE line
+    #digits count face value, '-' counts as 1, everything else 0
+    cksum = 0
+    for ch in line[:68]:
+        if ch.isdigit(): cksum += int(ch)
+        elif ch == '-': cksum += 1
+    return cksum % 10
+
+def _tle_float(field):
+    #TLE 'assumed decimal point' exponent fields, ex: ' 27514-4' -> 0.27514e-4
+    field = field.strip()
+    if field in ['', '0', '00000-0', '00000+0', '-00000-0', '+00000-0']:
+        return 0.0
+    sign = -1.0 if field[0] == '-' else 1.0
+    field = field.lstrip('+-')
+    mant = field[:-2]
+    exp = field[-2:]
+    return sign * float('0.' + mant) * 10**int(exp)
+
+def tle_epoch(line1):
+    #returns TLE epoch as numpy datetime64[ns]
+    year = int(line1[18:20])
+    year += 2000 if year < 57 else 1900
+    days = float(line1[20:32])
+    epoch = np.datetime64('{:04d}-01-01'.format(year), 'ns')
+    return epoch + np.timedelta64(int(round((days - 1.0) * 86400e9)), 'ns')
+
+def tle_elements(line1, line2):
+    #input: TLE lines 1 and 2
+    #output: dict of SGP4 mean elements, angles [rad], mean motion [rad/min]
+    el = {}
+    el['epoch']    = tle_epoch(line1).astype(np.int64) #[ns] since unix epoch
+    el['ndot']     = float(line1[33:43]) / (xpdotp * 1440.0)
+    el['nddot']    = _tle_float(line1[44:52]) / (xpdotp * 1440.0 * 1440.0)
+    el['bstar']    = _tle_float(line1[53:61])
+    el['inclo']    = float(line2[8:16]) * deg2rad
+    el['nodeo']    = float(line2[17:25]) * deg2rad
+    el['ecco']     = float('0.' + line2[26:33].strip())
+    el['argpo']    = float(line2[34:42]) * deg2rad
+    el['mo']       = float(line2[43:51]) * deg2rad
+    el['no_kozai'] = float(line2[52:63]) / xpdotp
+    return el
+
+def ephem_elements(ephem_sat):
+    #Same as tle_elements, pulled from a pyephem EarthSatellite object
+    #pyephem epoch is days since 1899/12/31 12:00 UT, angles already [rad]
+    ep_ns = (float(ephem_sat._epoch) - 25567.5) * 86400e9
+    el = {}
+    el['epoch']    = np.int64(round(ep_ns))
+    el['ndot']     = float(ephem_sat._decay) * 2 / (xpdotp * 1440.0)
+    el['nddot']    = 0.0
+    el['bstar']    = float(ephem_sat._drag)
+    el['inclo']    = float(ephem_sat._inc)
+    el['nodeo']    = float(ephem_sat._raan)
+    el['ecco']     = float(ephem_sat._e)
+    el['argpo']    = float(ephem_sat._ap)
+    el['mo']       = float(ephem_sat._M)
+    el['no_kozai'] = float(ephem_sat._n) / xpdotp
+    return el
+
+def stack_elements(el_list):
+    #stack list of element dicts into dict of (N,1) arrays for broadcasting
+    #against a (T,) timestamp array
+    el = {}
+    for k in el_list[0].keys():
+        dtype = np.int64 if k == 'epoch' else np.float64
+        el[k] = np.array([e[k] for e in el_list], dtype=dtype).reshape(-1, 1)
+    return el
+
+def sgp4_init(el):
+    #SGP4 initialization, near earth branch
+    #input: element dict (scalars or broadcastable arrays)
+    #output: dict of propagation constants
+    s = dict(el)
+    ecco = np.asarray(el['ecco'], dtype=np.float64)
+    inclo = np.asarray(el['inclo'], dtype=np.float64)
+    argpo = np.asarray(el['argpo'], dtype=np.float64)
+    mo = np.asarray(el['mo'], dtype=np.float64)
+    bstar = np.asarray(el['bstar'], dtype=np.float64)
+    no_kozai = np.asarray(el['no_kozai'], dtype=np.float64)
+
+    temp4 = 1.5e-12
+    ss = 78.0 / radiusearthkm + 1.0
+    qzms2t = ((120.0 - 78.0) / radiusearthkm)**4
+
+    #--initl
+    eccsq = ecco * ecco
+    omeosq = 1.0 - eccsq
+    rteosq = np.sqrt(omeosq)
+    cosio = np.cos(inclo)
+    cosio2 = cosio * cosio
+    ak = (xke / no_kozai)**x2o3
+    d1 = 0.75 * j2 * (3.0 * cosio2 - 1.0) / (rteosq * omeosq)
+    del_ = d1 / (ak * ak)
+    adel = ak * (1.0 - del_ * del_ - del_ * (1.0 / 3.0 + 134.0 * del_ * del_ / 81.0))
+    del_ = d1 / (adel * adel)
+    no_unkozai = no_kozai / (1.0 + del_)
+    ao = (xke / no_unkozai)**x2o3
+    sinio = np.sin(inclo)
+    po = ao * omeosq
+    con42 = 1.0 - 5.0 * cosio2
+    con41 = -con42 - cosio2 - cosio2
+    posq = po * po
+    rp = ao * (1.0 - ecco)
+
+    #--perigee dependent drag parameters
+    isimp = rp < (220.0 / radiusearthkm + 1.0)
+    perige = (rp - 1.0) * radiusearthkm
+    sfour = np.where(perige < 156.0, np.where(perige < 98.0, 20.0, perige - 78.0), 0.0)
+    qzms24 = np.where(perige < 156.0, ((120.0 - sfour) / radiusearthkm)**4, qzms2t)
+    sfour = np.where(perige < 156.0, sfour / radiusearthkm + 1.0, ss)
+
+    pinvsq = 1.0 / posq
+    tsi = 1.0 / (ao - sfour)
+    eta = ao * ecco * tsi
+    etasq = eta * eta
+    eeta = ecco * eta
+    psisq = np.abs(1.0 - etasq)
+    coef = qzms24 * tsi**4
+    coef1 = coef / psisq**3.5
+    cc2 = coef1 * no_unkozai * (ao * (1.0 + 1.5 * etasq + eeta * (4.0 + etasq)) +
+          0.375 * j2 * tsi / psisq * con41 * (8.0 + 3.0 * etasq * (8.0 + etasq)))
+    cc1 = bstar * cc2
+    cc3 = np.where(ecco > 1.0e-4, -2.0 * coef * tsi * j3oj2 * no_unkozai * sinio / ecco, 0.0)
+    x1mth2 = 1.0 - cosio2
+    cc4 = 2.0 * no_unkozai * coef1 * ao * omeosq * \
+          (eta * (2.0 + 0.5 * etasq) + ecco * (0.5 + 2.0 * etasq) -
+           j2 * tsi / (ao * psisq) *
+           (-3.0 * con41 * (1.0 - 2.0 * eeta + etasq * (1.5 - 0.5 * eeta)) +
+            0.75 * x1mth2 * (2.0 * etasq - eeta * (1.0 + etasq)) * np.cos(2.0 * argpo)))
+    cc5 = 2.0 * coef1 * ao * omeosq * (1.0 + 2.75 * (etasq + eeta) + eeta * etasq)
+    cosio4 = cosio2 * cosio2
+    temp1 = 1.5 * j2 * pinvsq * no_unkozai
+    temp2 = 0.5 * temp1 * j2 * pinvsq
+    temp3 = -0.46875 * j4 * pinvsq * pinvsq * no_unkozai
+    s['mdot'] = no_unkozai + 0.5 * temp1 * rteosq * con41 + \
+                0.0625 * temp2 * rteosq * (13.0 - 78.0 * cosio2 + 137.0 * cosio4)
+    s['argpdot'] = -0.5 * temp1 * con42 + 0.0625 * temp2 * (7.0 - 114.0 * cosio2 + 395.0 * cosio4) + \
+                   temp3 * (3.0 - 36.0 * cosio2 + 49.0 * cosio4)
+    xhdot1 = -temp1 * cosio
+    s['nodedot'] = xhdot1 + (0.5 * temp2 * (4.0 - 19.0 * cosio2) + 2.0 * temp3 * (3.0 - 7.0 * cosio2)) * cosio
+    s['omgcof'] = bstar * cc3 * np.cos(argpo)
+    s['xmcof'] = np.where(ecco > 1.0e-4, -x2o3 * coef * bstar / np.where(eeta == 0, 1.0, eeta), 0.0)
+    s['nodecf'] = 3.5 * omeosq * xhdot1 * cc1
+    s['t2cof'] = 1.5 * cc1
+    den = np.where(np.abs(cosio + 1.0) > 1.5e-12, 1.0 + cosio, temp4)
+    s['xlcof'] = -0.25 * j3oj2 * sinio * (3.0 + 5.0 * cosio) / den
+    s['aycof'] = -0.5 * j3oj2 * sinio
+    s['delmo'] = (1.0 + eta * np.cos(mo))**3
+    s['sinmao'] = np.sin(mo)
+    s['x7thm1'] = 7.0 * cosio2 - 1.0
+
+    #--isimp == 0 higher order drag terms, zeroed for low perigee
+    cc1sq = cc1 * cc1
+    d2 = 4.0 * ao * tsi * cc1sq
+    temp = d2 * tsi * cc1 / 3.0
+    d3 = (17.0 * ao + sfour) * temp
+    d4 = 0.5 * temp * ao * tsi * (221.0 * ao + 31.0 * sfour) * cc1
+    full = np.logical_not(isimp)
+    s['d2'] = np.where(full, d2, 0.0)
+    s['d3'] = np.where(full, d3, 0.0)
+    s['d4'] = np.where(full, d4, 0.0)
+    s['t3cof'] = np.where(full, d2 + 2.0 * cc1sq, 0.0)
+    s['t4cof'] = np.where(full, 0.25 * (3.0 * d3 + cc1 * (12.0 * d2 + 10.0 * cc1sq)), 0.0)
+    s['t5cof'] = np.where(full, 0.2 * (3.0 * d4 + 12.0 * cc1 * d3 + 6.0 * d2 * d2 +
+                                       15.0 * cc1sq * (2.0 * d2 + cc1sq)), 0.0)
+    s['full'] = full
+
+    s['cc1'] = cc1
+    s['cc4'] = cc4
+    s['cc5'] = cc5
+    s['eta'] = eta
+    s['con41'] = con41
+    s['x1mth2'] = x1mth2
+    s['no_unkozai'] = no_unkozai
+    s['deep'] = (twopi / no_unkozai) >= 225.0
+    return s
+
+def sgp4_propagate(s, tsince):
+    #input:
+    #   s      : dict from sgp4_init
+    #   tsince : minutes since element epoch, broadcastable against elements
+    #output: TEME position [km], velocity [km/s], shape (3,) + broadcast shape
+    #   samples where the model fails (decayed, e >= 1) are NaN
+    t = np.asarray(tsince, dtype=np.float64)
+    xmdf = s['mo'] + s['mdot'] * t
+    argpdf = s['argpo'] + s['argpdot'] * t
+    nodedf = s['nodeo'] + s['nodedot'] * t
+    t2 = t * t
+    nodem = nodedf + s['nodecf'] * t2
+    tempa = 1.0 - s['cc1'] * t
+    tempe = s['bstar'] * s['cc4'] * t
+    templ = s['t2cof'] * t2
+
+    #--higher order drag, d2..t5cof are zero for isimp objects
+    delomg = s['omgcof'] * t
+    delm = s['xmcof'] * ((1.0 + s['eta'] * np.cos(xmdf))**3 - s['delmo'])
+    temp = np.where(s['full'], delomg + delm, 0.0)
+    mm = xmdf + temp
+    argpm = argpdf - temp
+    t3 = t2 * t
+    t4 = t3 * t
+    tempa = tempa - s['d2'] * t2 - s['d3'] * t3 - s['d4'] * t4
+    tempe = tempe + np.where(s['full'], s['bstar'] * s['cc5'] * (np.sin(mm) - s['sinmao']), 0.0)
+    templ = templ + s['t3cof'] * t3 + t4 * (s['t4cof'] + t * s['t5cof'])
+
+    nm = s['no_unkozai']
+    am = (xke / nm)**x2o3 * tempa * tempa
+    nm = xke / am**1.5
+    em = s['ecco'] - tempe
+    bad = (em >= 1.0) | (em < -0.001) | (am < 0.95)
+    em = np.where(em < 1.0e-6, 1.0e-6, em)
+    mm = mm + s['no_unkozai'] * templ
+    xlm = mm + argpm + nodem
+    nodem = np.fmod(nodem, twopi)
+    argpm = np.fmod(argpm, twopi)
+    xlm = np.fmod(xlm, twopi)
+    mm = np.fmod(xlm - argpm - nodem, twopi)
+
+    sinip = np.sin(s['inclo'])
+    cosip = np.cos(s['inclo'])
+
+    #--long period periodics
+    axnl = em * np.cos(argpm)
+    temp = 1.0 / (am * (1.0 - em * em))
+    aynl = em * np.sin(argpm) + temp * s['aycof']
+    xl = mm + argpm + nodem + temp * s['xlcof'] * axnl
+
+    #--solve kepler's equation, fixed iteration count so it vectorizes
+    u = np.fmod(xl - nodem, twopi)
+    eo1 = u
+    for ktr in range(10):
+        sineo1 = np.sin(eo1)
+        coseo1 = np.cos(eo1)
+        tem5 = 1.0 - coseo1 * axnl - sineo1 * aynl
+        tem5 = (u - aynl * coseo1 + axnl * sineo1 - eo1) / tem5
+        eo1 = eo1 + np.clip(tem5, -0.95, 0.95)
+    sineo1 = np.sin(eo1)
+    coseo1 = np.cos(eo1)
+
+    #--short period preliminary quantities
+    ecose = axnl * coseo1 + aynl * sineo1
+    esine = axnl * sineo1 - aynl * coseo1
+    el2 = axnl * axnl + aynl * aynl
+    pl = am * (1.0 - el2)
+    bad = bad | (pl < 0.0)
+    pl = np.abs(pl)
+    rl = am * (1.0 - ecose)
+    rdotl = np.sqrt(am) * esine / rl
+    rvdotl = np.sqrt(pl) / rl
+    betal = np.sqrt(1.0 - el2)
+    temp = esine / (1.0 + betal)
+    sinu = am / rl * (sineo1 - aynl - axnl * temp)
+    cosu = am / rl * (coseo1 - axnl + aynl * temp)
+    su = np.arctan2(sinu, cosu)
+    sin2u = (cosu + cosu) * sinu
+    cos2u = 1.0 - 2.0 * sinu * sinu
+    temp = 1.0 / pl
+    temp1 = 0.5 * j2 * temp
+    temp2 = temp1 * temp
+
+    #--update for short period periodics
+    mrt = rl * (1.0 - 1.5 * temp2 * betal * s['con41']) + 0.5 * temp1 * s['x1mth2'] * cos2u
+    su = su - 0.25 * temp2 * s['x7thm1'] * sin2u
+    xnode = nodem + 1.5 * temp2 * cosip * sin2u
+    xinc = s['inclo'] + 1.5 * temp2 * cosip * sinip * cos2u
+    mvt = rdotl - nm * temp1 * s['x1mth2'] * sin2u / xke
+    rvdot = rvdotl + nm * temp1 * (s['x1mth2'] * cos2u + 1.5 * s['con41']) / xke
+
+    #--orientation vectors
+    sinsu = np.sin(su)
+    cossu = np.cos(su)
+    snod = np.sin(xnode)
+    cnod = np.cos(xnode)
+    sini = np.sin(xinc)
+    cosi = np.cos(xinc)
+    xmx = -snod * cosi
+    xmy = cnod * cosi
+    ux = xmx * sinsu + cnod * cossu
+    uy = xmy * sinsu + snod * cossu
+    uz = sini * sinsu
+    vx = xmx * cossu - cnod * sinsu
+    vy = xmy * cossu - snod * sinsu
+    vz = sini * cossu
+
+    r = np.array([ux, uy, uz]) * (mrt * radiusearthkm)
+    v = (np.array([ux, uy, uz]) * mvt + np.array([vx, vy, vz]) * rvdot) * vkmpersec
+    bad = bad | (mrt < 1.0)
+    r = np.where(bad, np.nan, r)
+    v = np.where(bad, np.nan, v)
+    return r, v
+
+def to_datetime64(timestamp):
+    #accept datetime64 array, int64 [ns] list/array or list of datetime
+    ts = np.asarray(timestamp)
+    if ts.dtype.kind == 'M': return ts.astype('datetime64[ns]')
+    if ts.dtype.kind in 'iu': return ts.astype(np.int64).astype('datetime64[ns]')
+    return ts.astype('datetime64[ns]')
+
+def gstime(ts):
+    #Greenwich Mean Sidereal Time [rad], IAU-82, UTC used for UT1
+    ns = to_datetime64(ts).astype(np.int64)
+    tut1 = ((ns - np.int64(946728000000000000)) / 86400e9) / 36525.0 #since J2000
+    temp = -6.2e-6 * tut1**3 + 0.093104 * tut1**2 + \
+           (876600.0 * 3600 + 8640184.812866) * tut1 + 67310.54841 #[sec]
+    temp = np.fmod(temp * deg2rad / 240.0, twopi)
+    return np.where(temp < 0.0, temp + twopi, temp)
+
+def teme_to_ecef(r, v, ts):
+    #rotate TEME position/velocity into earth fixed frame (no polar motion)
+    #velocity includes earth rotation term
+    theta = gstime(ts)
+    ct = np.cos(theta)
+    st = np.sin(theta)
+    x = ct * r[0] + st * r[1]
+    y = -st * r[0] + ct * r[1]
+    vx = ct * v[0] + st * v[1] + omega_earth * y
+    vy = -st * v[0] + ct * v[1] - omega_earth * x
+    return np.array([x, y, r[2]]), np.array([vx, vy, v[2]])
+
+def site_ecef(lat, lon, alt):
+    #input: geodetic lat, lon [rad], alt [m]
+    #output: WGS84 earth fixed position [km]
+    h = alt / 1000.0
+    slat = math.sin(lat)
+    N = wgs84_a / math.sqrt(1.0 - wgs84_e2 * slat * slat)
+    return np.array([(N + h) * math.cos(lat) * math.cos(lon),
+                     (N + h) * math.cos(lat) * math.sin(lon),
+                     (N * (1.0 - wgs84_e2) + h) * slat])
+
+def _bcast_site(site, r):
+    return site.reshape((3,) + (1,) * (r.ndim - 1))
+
+def range_rate(r_ecef, v_ecef, site):
+    #topocentric range rate [m/s], negative means approaching
+    rho = r_ecef - _bcast_site(site, r_ecef)
+    rng = np.sqrt(np.sum(rho * rho, axis=0))
+    return np.sum(rho * v_ecef, axis=0) / rng * 1000.0
+
+def elevation(r_ecef, site, lat, lon):
+    #topocentric elevation angle [rad] of satellite above ground station
+    rho = r_ecef - _bcast_site(site, r_ecef)
+    up = np.array([math.cos(lat) * math.cos(lon),
+                   math.cos(lat) * math.sin(lon),
+                   math.sin(lat)])
+    rng = np.sqrt(np.sum(rho * rho, axis=0))
+    return np.arcsin(np.sum(rho * _bcast_site(up, rho), axis=0) / rng)
+
+def propagate_ecef(s, timestamp):
+    #propagate initialized elements to timestamps, earth fixed frame
+    ts = to_datetime64(timestamp)
+    tsince = (ts.astype(np.int64) - s['epoch']) / 60e9
+    r, v = sgp4_propagate(s, tsince)
+    return teme_to_ecef(r, v, ts)
+
+def range_rate_batch(s, timestamp, lat, lon, alt):
+    #input:
+    #   s         : dict from sgp4_init, scalar or stacked (N,1) elements
+    #   timestamp : datetime64 array (T,)
+    #   lat, lon  : ground station geodetic [rad], alt [m]
+    #output: range rate [m/s], shape (T,) or (N,T)
+    r, v = propagate_ecef(s, timestamp)
+    return range_rate(r, v, site_ecef(lat, lon, alt))
+
+#-------- Interpolated ephemeris ------------------------------------------------
+#   Range rate over a pass is smooth, so instead of SGP4 at every sample the
+#   earth fixed position and velocity are fit with piecewise Chebyshev
+#   polynomials on Chebyshev nodes, and samples (any spacing) are
+#   evaluated from the polynomials.  Segments are checked against direct
+#   propagation between the nodes and split until the range rate error is
+#   below tolerance.
+def _cheb_matrix(u, degree):
+    #Chebyshev polynomials T_0..T_degree at u in [-1, 1], shape (degree+1,) + u.shape
+    u = np.asarray(u, dtype=float)
+    T = np.empty((degree + 1,) + u.shape)
+    T[0] = 1.0
+    if degree > 0: T[1] = u
+    for k in range(2, degree + 1):
+        T[k] = 2.0 * u * T[k-1] - T[k-2]
+    return T
+
+def ephemeris_fit(s, t_start, t_stop, site, tol=0.01, degree=8, seg_len=600.0, min_len=1.0):
+    #desc:  piecewise Chebyshev ephemeris of one near earth satellite
+    #input:
+    #   s              : dict from sgp4_init, one satellite
+    #   t_start, t_stop: interval to cover, datetime64
+    #   site           : ground station, site_ecef, the error check is on its range rate
+    #   tol            : range rate tolerance [m/s], 0.01 m/s ~ 5 mHz at 145 MHz
+    #   degree         : Chebyshev degree per segment
+    #   seg_len        : initial segment length [s]
+    #   min_len        : segments are not split below this length [s]
+    #output: dict
+    #   start, stop : segment bounds [ns], sorted, (S,)
+    #   coeffs      : (6, S, degree+1), x, y, z [km], vx, vy, vz [km/s] earth fixed
+    #   max_err     : max range rate error at the check points [m/s]
+    #   evals       : number of SGP4 evaluations used
+    t0 = np.int64(np.datetime64(t_start, 'ns').astype(np.int64))
+    t1 = np.int64(np.datetime64(t_stop, 'ns').astype(np.int64))
+    if t1 <= t0: t1 = t0 + np.int64(1e9)
+    n_seg = max(int(math.ceil((t1 - t0) / (seg_len * 1e9))), 1)
+    edges = t0 + np.round(np.linspace(0.0, 1.0, n_seg + 1) * (t1 - t0)).astype(np.int64)
+    pending_a, pending_b = edges[:-1], edges[1:]
+    nodes = np.cos(math.pi * (np.arange(degree + 1) + 0.5) / (degree + 1))[::-1]
+    Vinv = np.linalg.inv(_cheb_matrix(nodes, degree).T)
+    #--check between the nodes and at the segment ends, where the error peaks
+    check = np.cos(math.pi * np.arange(degree + 2) / (degree + 1))[::-1]
+    Vchk = _cheb_matrix(check, degree).T
+    start, stop, coeffs = [], [], []
+    max_err = 0.0
+    evals = 0
+    while len(pending_a) > 0:
+        half = (pending_b - pending_a) / 2.0
+        mid = pending_a + half
+        u = np.concatenate([nodes, check])
+        ts = (mid[:, np.newaxis] + half[:, np.newaxis] * u).astype(np.int64) #(S, 2*degree+3)
+        r, v = propagate_ecef(s, ts.astype('datetime64[ns]').ravel())
+        evals += ts.size
+        rv = np.concatenate([r, v]).reshape(6, len(mid), -1)
+        C = np.einsum('ij,csj->csi', Vinv, rv[:, :, :degree + 1]) #(6, S, degree+1)
+        fit = np.einsum('csi,ji->csj', C, Vchk)
+        rr_fit = range_rate(fit[:3], fit[3:], site)
+        rr_true = range_rate(rv[:3, :, degree + 1:], rv[3:, :, degree + 1:], site)
+        err = np.max(np.abs(rr_fit - rr_true), axis=1)
+        err = np.where(np.isnan(err), np.inf, err)
+        ok = (err <= tol) | (half * 2 <= min_len * 1e9)
+        start.append(pending_a[ok])
+        stop.append(pending_b[ok])
+        coeffs.append(C[:, ok])
+        if np.any(ok): max_err = max(max_err, float(np.max(err[ok])))
+        split = mid[~ok].astype(np.int64)
+        pending_a = np.concatenate([pending_a[~ok], split])
+        pending_b = np.concatenate([split, pending_b[~ok]])
+    start = np.concatenate(start)
+    order = np.argsort(start)
+    eph = {}
+    eph['start'] = start[order]
+    eph['stop'] = np.concatenate(stop)[order]
+    eph['coeffs'] = np.concatenate(coeffs, axis=1)[:, order]
+    eph['max_err'] = max_err
+    eph['evals'] = evals
+    return eph
+
+def ephemeris_eval(eph, timestamp):
+    #desc:  earth fixed position [km] and velocity [km/s] from ephemeris_fit,
+    #       timestamps in any order and spacing inside the fitted interval
+    #output: r, v, each (3, T)
+    ns = to_datetime64(timestamp).astype(np.int64)
+    idx = np.clip(np.searchsorted(eph['stop'], ns, 'left'), 0, len(eph['stop']) - 1)
+    a = eph['start'][idx]
+    b = eph['stop'][idx]
+    u = 2.0 * (ns - a) / (b - a).astype(float) - 1.0
+    degree = eph['coeffs'].shape[2] - 1
+    V = _cheb_matrix(u, degree)
+    rv = np.empty((6, len(ns)))
+    if np.all(idx[1:] >= idx[:-1]): #time ordered, segments are contiguous slices
+        bounds = np.searchsorted(idx, np.arange(len(eph['start']) + 1))
+        for k in range(len(eph['start'])):
+            sel = slice(bounds[k], bounds[k+1])
+            rv[:, sel] = np.dot(eph['coeffs'][:, k], V[:, sel])
+    else:
+        for k in np.unique(idx):
+            sel = idx == k
+            rv[:, sel] = np.dot(eph['coeffs'][:, k], V[:, sel])
+    return rv[:3], rv[3:]
+
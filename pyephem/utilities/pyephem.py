@@ -8,12 +8,7 @@
 import sys
 import os
 import math
-import string
-import struct
-import numpy
-import scipy
 import datetime as dt
-import pandas as pd
 
 deg2rad = math.pi / 180
 rad2deg = 180 / math.pi
@@ -8,17 +8,12 @@
 import sys
 import os
 import math
-import string
-import struct
-import numpy
-import scipy
 import ephem
+import time
 import datetime as dt
-import pandas as pd
-
-import matplotlib.pyplot as plt
 import numpy as np
-from scipy.interpolate import *
+
+from . import propagator
 
 
 deg2rad = math.pi / 180
@@ -74,14 +69,155 @@ def lin_inv_xpndr_map_reverse(dn, up_min = 145.900e6, up_max = 146.000e6, dn_min
     return up
 
 
+def Screen_Visibility(sats, gs, t_start, t_stop, step=30.0, el_mask=0.0):
+    #desc:  coarse visibility screen before full rate Doppler generation.
+    #       All candidates are propagated together on a low rate grid over
+    #       the measurement window, objects that never clear the elevation
+    #       mask are dropped.
+    #input:
+    #   sats    : list of satellite objects
+    #   gs      : pyephem GS object
+    #   t_start : window start, numpy datetime64
+    #   t_stop  : window stop, numpy datetime64
+    #   step    : screening time step [s]
+    #   el_mask : elevation mask [deg]
+    #output: list of visible satellites (input order), max elevation [deg] per input satellite
+    if len(sats) == 0: return [], np.zeros(0)
+    t_start = np.datetime64(t_start, 'ns')
+    t_stop = np.datetime64(t_stop, 'ns')
+    step_ns = np.timedelta64(int(step * 1e9), 'ns')
+    ts = np.arange(t_start, t_stop, step_ns)
+    ts = np.append(ts, t_stop) #always check the end of the window
+
+    lat, lon, alt = float(gs.lat), float(gs.lon), float(gs.elevation)
+    site = propagator.site_ecef(lat, lon, alt)
+    max_el = np.full(len(sats), -90.0)
+    deep = np.array([bool(sat.get_sgp4()['deep']) for sat in sats])
+    near = np.flatnonzero(~deep)
+    if len(near) > 0: #all near earth objects in one (N, T) propagation
+        el = propagator.stack_elements([sats[i].get_elements() for i in near])
+        r, v = propagator.propagate_ecef(propagator.sgp4_init(el), ts)
+        elev = propagator.elevation(r, site, lat, lon) * rad2deg
+        max_el[near] = np.nanmax(np.where(np.isnan(elev), -90.0, elev), axis=1)
+    for i in np.flatnonzero(deep): #deep space, pyephem
+        sat = sats[i]
+        for t in ts.astype(np.int64):
+            gs.date = ephem.Date(dt.datetime.utcfromtimestamp(t*1e-9))
+            sat.ephem_sat.compute(gs)
+            max_el[i] = max(max_el[i], float(sat.ephem_sat.alt) * rad2deg)
+    visible = [sat for i, sat in enumerate(sats) if max_el[i] >= el_mask]
+    return visible, max_el
+
+def Gen_Doppler_Job(job):
+    #Process pool worker for generating one candidate Doppler curve.
+    #pyephem objects don't pickle, so the satellite and ground station are
+    #rebuilt here from the TLE lines and ground station location.
+    #input: dict with keys
+    #   sat_name, norad_id, line1, line2 : TLE data
+    #   gs_lat, gs_lon [rad], gs_alt [m] : ground station location
+    #   timestamp                        : numpy datetime64 array
+    #   rx_freq                          : downlink center frequency [Hz]
+    #   engine                           : 'batch', 'interp' or 'ephem'
+    #output: dict with name, doppler dataframe, elapsed time [s],
+    #   interp_err, max interpolation error [m/s] ('interp' engine, else None)
+    #   dataframe .name doesn't survive pickling, so it's returned separately
+    t0 = time.time()
+    ephem_sat = ephem.readtle(job['sat_name'], job['line1'], job['line2'])
+    sat = satellite(ephem_sat, job['sat_name'], job['norad_id'], job['line1'], job['line2'])
+    gs = ephem.Observer()
+    gs.lat, gs.lon, gs.elevation = job['gs_lat'], job['gs_lon'], job['gs_alt']
+    if job['engine'] == 'batch':
+        df = sat.gen_doppler_batch(gs, job['timestamp'], job['rx_freq'])
+    elif job['engine'] == 'interp':
+        df = sat.gen_doppler_batch(gs, job['timestamp'], job['rx_freq'], interp=True)
+    else:
+        df = sat.gen_doppler(gs, job['timestamp'].astype('int64').tolist(), job['rx_freq'])
+    result = {}
+    result['name'] = df.name
+    result['doppler'] = df
+    result['interp_err'] = sat.ephemeris['max_err'] if job['engine'] == 'interp' and sat.ephemeris else None
+    result['elapsed'] = time.time() - t0
+    return result
+
 class satellite(object):
-    def __init__(self, ephem_sat, sat_name, norad_id):
+    def __init__(self, ephem_sat, sat_name, norad_id, line1=None, line2=None):
         self.ephem_sat  = ephem_sat     #PyEphem Satellite object for use in computations
         self.sat_name   = sat_name #Common Name of spacecraft
         self.norad_id   = norad_id #NORAD ID of spacecraft
+        self.line1      = line1 #TLE line 1, optional
+        self.line2      = line2 #TLE line 2, optional
+        self.sgp4       = None #vectorized propagator state, built on first use
+        self.ephemeris  = None #last interpolated ephemeris, see range_rate_interp
+
+    def get_elements(self):
+        #SGP4 mean elements from TLE lines if we have them,
+        #otherwise from the elements stored in the pyephem object
+        if self.line1 and self.line2:
+            return propagator.tle_elements(self.line1, self.line2)
+        return propagator.ephem_elements(self.ephem_sat)
+
+    def get_sgp4(self):
+        #initialize vectorized SGP4 constants, done once per satellite
+        if self.sgp4 is None:
+            self.sgp4 = propagator.sgp4_init(self.get_elements())
+        return self.sgp4
+
+    def range_rate_batch(self, gs, timestamp):
+        #input:
+        #   gs        : pyephem GS object, only lat, lon, elevation are used
+        #   timestamp : numpy datetime64 array (or int64 [ns] since epoch)
+        #output: numpy array of range rate [m/s], one per timestamp
+        timestamp = propagator.to_datetime64(timestamp)
+        s = self.get_sgp4()
+        if s['deep']: #SDP4 not vectorized, fall back to pyephem
+            range_rate = np.empty(len(timestamp))
+            for i, ts in enumerate(timestamp.astype(np.int64)):
+                gs.date = ephem.Date(dt.datetime.utcfromtimestamp(ts*1e-9))
+                self.ephem_sat.compute(gs)
+                range_rate[i] = self.ephem_sat.range_velocity
+            return range_rate
+        return propagator.range_rate_batch(s, timestamp, float(gs.lat), float(gs.lon), float(gs.elevation))
+
+    def range_rate_interp(self, gs, timestamp, tol=0.01):
+        #Same as range_rate_batch, evaluated from a piecewise Chebyshev
+        #ephemeris fit over the time span instead of SGP4 at every sample,
+        #see propagator.ephemeris_fit.  The ephemeris (segments, SGP4
+        #evaluations, max range rate error [m/s] vs direct propagation) is
+        #kept in self.ephemeris.
+        #input: as range_rate_batch, tol = range rate tolerance [m/s]
+        timestamp = propagator.to_datetime64(timestamp)
+        s = self.get_sgp4()
+        if s['deep'] or len(timestamp) == 0:
+            self.ephemeris = None
+            return self.range_rate_batch(gs, timestamp)
+        site = propagator.site_ecef(float(gs.lat), float(gs.lon), float(gs.elevation))
+        self.ephemeris = propagator.ephemeris_fit(s, timestamp.min(), timestamp.max(), site, tol)
+        r, v = propagator.ephemeris_eval(self.ephemeris, timestamp)
+        return propagator.range_rate(r, v, site)
+
+    def gen_doppler_batch(self, gs, timestamp, rx_freq, interp=False):
+        #Array-at-a-time version of gen_doppler, same output dataframe.
+        #gen_doppler is kept as the per sample pyephem reference.
+        #input:
+        #   gs        : pyephem GS object
+        #   timestamp : numpy datetime64 array (or int64 [ns] since epoch)
+        #   rx_freq   : downlink center frequency [Hz]
+        #   interp    : evaluate from an interpolated ephemeris, see range_rate_interp
+        import pandas as pd
+        timestamp = propagator.to_datetime64(timestamp)
+        if interp: range_rate = self.range_rate_interp(gs, timestamp)
+        else: range_rate = self.range_rate_batch(gs, timestamp)
+        doppler = Doppler_Shift(rx_freq, range_rate)
+
+        df = pd.DataFrame({ 'timestamp':timestamp,
+                            'doppler_offset':doppler['offset'],
+                            'measured_freq':doppler['center']})
+        df.name = self.sat_name +'('+ self.norad_id + ')'
+        return df
 
     def gen_doppler(self, gs, timestamp, rx_freq):
             #input:  pyephem GS object
+        import pandas as pd
         #--convert timestamp to useable datetime format
         timestamp=[dt.datetime.utcfromtimestamp(element*1e-9) for element in timestamp]
         #print timestamp